@@ -175,6 +175,9 @@ _C.DATASETS.SEPARATION_TOKENS = " "
 # LVIS
 _C.DATASETS.LVIS_USE_NORMAL_AP = False
 _C.DATASETS.LVIS_TOPK = 10000
+# "loop" or "vectorized" (same results); the vectorized engine can shard categories across processes
+_C.DATASETS.LVIS_EVAL_ENGINE = "loop"
+_C.DATASETS.LVIS_EVAL_NUM_WORKERS = 0
 _C.DATASETS.SPECIAL_SAFEGUARD_FOR_COCO_GROUNDING = False
 
 # Caption
@@ -247,6 +250,16 @@ _C.DATALOADER.MIN_KPS_PER_IMS = 0
 _C.DATALOADER.USE_RANDOM_SEED = False
 
 _C.DATALOADER.DISTRIBUTE_CHUNK_AMONG_NODE = False
+# Tokenize the captions of the training batches in the dataloader workers (BatchCollator)
+# instead of in the model forward
+_C.DATALOADER.PRETOKENIZE = False
+# Number of training batches pinned and copied to the device by a background thread ahead of the training step
+# (maskrcnn_benchmark/data/prefetcher.py), 0 disables the prefetching
+_C.DATALOADER.PREFETCH_DEPTH = 0
+# Directory of the image size caches of the aspect ratio grouping (maskrcnn_benchmark/data/image_size_cache.py),
+# computed with IMAGE_SIZE_CACHE_WORKERS processes on the first run. Empty disables the caching
+_C.DATALOADER.IMAGE_SIZE_CACHE_DIR = ""
+_C.DATALOADER.IMAGE_SIZE_CACHE_WORKERS = 8
 # ---------------------------------------------------------------------------- #
 # Backbone options
 # ---------------------------------------------------------------------------- #
@@ -303,6 +316,11 @@ _C.MODEL.LANGUAGE_BACKBONE.MAX_QUERY_LEN = 256
 _C.MODEL.LANGUAGE_BACKBONE.N_LAYERS = 1
 _C.MODEL.LANGUAGE_BACKBONE.UNUSED_TOKEN = 106
 _C.MODEL.LANGUAGE_BACKBONE.MASK_SPECIAL = False
+# cache the tokenized prompts and the language features of repeated captions (e.g. detection prompts);
+# only used when the language backbone is frozen or in eval mode
+_C.MODEL.LANGUAGE_BACKBONE.PROMPT_CACHE = False
+_C.MODEL.LANGUAGE_BACKBONE.PROMPT_CACHE_SIZE = 256
+_C.MODEL.LANGUAGE_BACKBONE.PROMPT_CACHE_DIR = ""
 
 _C.MODEL.LANGUAGE_BACKBONE.RNN_TYPE = "lstm"
 _C.MODEL.LANGUAGE_BACKBONE.VARIABLE_LENGTH = True
@@ -465,6 +483,8 @@ _C.MODEL.ATSS.USE_SE = False
 _C.MODEL.ATSS.INFERENCE_TH_TRAIN = 0.0
 _C.MODEL.ATSS.PRE_NMS_TOP_N_TRAIN = 3000
 _C.MODEL.ATSS.POST_NMS_TOP_N_TRAIN = 1000
+# "loop": per-image / per-gt assignment; "batched": the whole batch is assigned with tensor ops
+_C.MODEL.ATSS.TARGET_ASSIGNMENT = "loop"
 # ---------------------------------------------------------------------------- #
 # DYHEAD Options
 # ---------------------------------------------------------------------------- #
@@ -484,6 +504,8 @@ _C.MODEL.DYHEAD.USE_DFCONV = False
 _C.MODEL.DYHEAD.TOPK = 9
 
 _C.MODEL.DYHEAD.SCORE_AGG = "MEAN"  # MEAN or MAX, for binary focal loss score aggregation
+# aggregate the token scores of all the classes at once with a label -> token matrix cached per prompt
+_C.MODEL.DYHEAD.SCORE_AGG_MATRIX = False
 
 _C.MODEL.DYHEAD.LOG_SCALE = 0.0  # temperature (dot product)
 _C.MODEL.DYHEAD.SHALLOW_LOG_SCALE = 0.0  # # temperature (shallow contrastive)
@@ -523,6 +545,12 @@ _C.MODEL.DYHEAD.FUSE_CONFIG.DOT_PRODUCT_TOKEN_LOSS_WEIGHT = 1.0
 _C.MODEL.DYHEAD.FUSE_CONFIG.USE_LAYER_SCALE = True
 _C.MODEL.DYHEAD.FUSE_CONFIG.SEPARATE_BIDIRECTIONAL = False
 _C.MODEL.DYHEAD.FUSE_CONFIG.STABLE_SOFTMAX_2D = False
+# Compute the image-text attention of BiMultiHeadAttention over chunks of this many image tokens
+# instead of the full (pixels x text tokens) matrix, to reduce the peak memory (0 to disable)
+_C.MODEL.DYHEAD.FUSE_CONFIG.BI_ATTN_CHUNK_SIZE = 0
+# MHA-B: run the bidirectional attention once over the image tokens of all the FPN levels flattened together
+# (per level text->image softmax with SEPARATE_BIDIRECTIONAL) instead of passing and splitting the levels separately
+_C.MODEL.DYHEAD.FUSE_CONFIG.FUSED_LEVELS = False
 
 _C.MODEL.DYHEAD.FUSE_CONFIG.DO_LANG_PROJ_OUTSIDE_CHECKPOINT = False
 
@@ -633,6 +661,9 @@ _C.MODEL.RPN.USE_RELATIVE_SIZE = False
 # Remove RPN anchors that go outside the image by RPN_STRADDLE_THRESH pixels
 # Set to -1 or a large value, e.g. 100000, to disable pruning anchors
 _C.MODEL.RPN.STRADDLE_THRESH = 0
+# Number of (feature map sizes, image size) anchor sets kept by AnchorGenerator, reused
+# across iterations instead of regenerating the anchors (0 to disable)
+_C.MODEL.RPN.ANCHOR_CACHE_SIZE = 0
 # Anchor scales per octave for complex anchors
 _C.MODEL.RPN.OCTAVE = 2.0
 _C.MODEL.RPN.SCALES_PER_OCTAVE = 3
@@ -809,6 +840,9 @@ _C.MODEL.SWINT.APE = False
 _C.MODEL.SWINT.VERSION = "v1"
 _C.MODEL.SWINT.OUT_NORM = True
 _C.MODEL.SWINT.LAYER_SCALE = 0
+# Number of SW-MSA attention masks (one per padded feature map size, window and shift) kept across
+# forward calls, e.g. for multi-scale testing; also caches the gathered relative position bias (0 to disable)
+_C.MODEL.SWINT.WINDOW_CACHE_SIZE = 0
 
 # ---------------------------------------------------------------------------- #
 # CVT SPEC
@@ -917,6 +951,19 @@ _C.SOLVER.USE_EMA_FOR_MONITOR = False
 _C.SOLVER.WEIGHT_DECAY_SCHEDULE = False
 _C.SOLVER.WEIGHT_DECAY_SCHEDULE_RATIO = 0.667
 _C.SOLVER.RESUME_SKIP_SCHEDULE = False # when we resume from a checkpoint, we can skip 
+# Print the training meters every LOG_PERIOD iterations
+_C.SOLVER.LOG_PERIOD = 20
+# If > 1, the loss terms are accumulated on the device and only reduced / brought to the host every LOSS_SYNC_PERIOD
+# iterations (and when printing), and NaN / too large losses are zeroed on the device and counted instead of being
+# checked on the host. Without AMP, the gradients of such an iteration are zeroed too instead of stopping the
+# training. 1 syncs every iteration
+_C.SOLVER.LOSS_SYNC_PERIOD = 1
+# The training data is dumped to OUTPUT_DIR/train_visualize/train.tsv: at most TRAIN_VISUALIZE_NUM images (<= 0
+# disables), one batch out of TRAIN_VISUALIZE_PERIOD. With TRAIN_VISUALIZE_QUEUE_SIZE > 0 they are encoded and
+# written by a background thread, and the batches which find its queue full are dropped
+_C.SOLVER.TRAIN_VISUALIZE_NUM = 1000
+_C.SOLVER.TRAIN_VISUALIZE_PERIOD = 1
+_C.SOLVER.TRAIN_VISUALIZE_QUEUE_SIZE = 0
 
 # ---------------------------------------------------------------------------- #
 # Specific test options
@@ -961,7 +1008,13 @@ _C.TEST.SUBSET = -1
 _C.TEST.CHUNKED_EVALUATION = -1
 _C.TEST.MDETR_STYLE_AGGREGATE_CLASS_NUM = -1
 _C.TEST.CHUNK_METHOD = "random" # or similar
-_C.TEST.CHUNK_INFERENCE_VERSION = "v1" # v2: modify the ATSS inference code slightly to make 
+_C.TEST.CHUNK_INFERENCE_VERSION = "v1" # v2: modify the ATSS inference code slightly to make
+# run the image-only stages (backbone + FPN) once per image and reuse them for every query chunk;
+# only takes effect when the visual backbone does not fuse language features
+_C.TEST.REUSE_VISUAL_FEATURES = False
+# number of query chunks of one image that are run through the language backbone / VLDyHead in a single
+# forward pass (RPN-only models, one image per GPU)
+_C.TEST.CHUNKS_PER_BATCH = 1
 # ---------------------------------------------------------------------------- #
 # Misc options
 # ---------------------------------------------------------------------------- #
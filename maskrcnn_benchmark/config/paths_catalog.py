@@ -503,6 +503,13 @@ class DatasetCatalog(object):
     @staticmethod
     def get(name):
 
+        if name.endswith("_shard"):
+            # same dataset, read from the binary shards written by tools/convert_tsv_to_shard.py
+            data = DatasetCatalog.get(name[: -len("_shard")])
+            assert "yaml_file" in data["args"], "{} is not a TSV dataset".format(name)
+            data["args"]["yaml_file"] = os.path.splitext(data["args"]["yaml_file"])[0] + ".shard.yaml"
+            return data
+
         if name.endswith("_bg"):
             attrs = DatasetCatalog.DATASETS[name]
             data_dir = try_to_find(attrs["ann_file"], return_dir=True)
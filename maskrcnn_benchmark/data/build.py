@@ -1,9 +1,9 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
-import bisect
 import copy
 import logging
 import os
 
+import numpy as np
 import torch.utils.data
 import torch.distributed as dist
 from maskrcnn_benchmark.utils.comm import get_world_size
@@ -13,6 +13,7 @@ from . import datasets as D
 from . import samplers
 
 from .collate_batch import BatchCollator, BBoxAugCollator
+from .image_size_cache import load_image_sizes
 from .transforms import build_transforms
 
 from transformers import AutoTokenizer
@@ -73,25 +74,28 @@ def build_dataset(cfg, dataset_list, transforms, dataset_catalog, is_train=True,
         args["transforms"] = transforms
         args.update(extra_args)
 
-        if "flickr30k_train" in dataset_name: #dataset_name == "flickr30k_train":
+        # shards are copied like the TSV dataset they were converted from
+        copy_name = dataset_name[: -len("_shard")] if dataset_name.endswith("_shard") else dataset_name
+
+        if "flickr30k_train" in copy_name: #dataset_name == "flickr30k_train":
             copy = cfg.DATASETS.FLICKR_COPY
-        elif "mixed_train" in dataset_name: #dataset_name in ["mixed_train", "mixed_train_no_coco"]:
+        elif "mixed_train" in copy_name: #dataset_name in ["mixed_train", "mixed_train_no_coco"]:
             copy = cfg.DATASETS.MIXED_COPY
-        elif dataset_name in ["COCO_odinw_train_8copy_dt_train", "coco_dt_train", "coco_grounding_train"]:
+        elif copy_name in ["COCO_odinw_train_8copy_dt_train", "coco_dt_train", "coco_grounding_train"]:
             copy = cfg.DATASETS.COCO_COPY
-        elif dataset_name in ["LVIS_odinw_train_8copy_dt_train", "lvisv1_dt_train", "lvis_grounding_train"]:
+        elif copy_name in ["LVIS_odinw_train_8copy_dt_train", "lvisv1_dt_train", "lvis_grounding_train"]:
             copy = cfg.DATASETS.LVIS_COPY
-        elif dataset_name in ["object365_odinw_2copy_dt_train", "object365_dt_train"]:
+        elif copy_name in ["object365_odinw_2copy_dt_train", "object365_dt_train"]:
             copy = cfg.DATASETS.OBJECT365_COPY
-        elif dataset_name == "vg_odinw_clipped_8copy_dt_train":
+        elif copy_name == "vg_odinw_clipped_8copy_dt_train":
             copy = cfg.DATASETS.VG_COPY
-        elif dataset_name == "vg_vgoi6_clipped_8copy_dt_train":
+        elif copy_name == "vg_vgoi6_clipped_8copy_dt_train":
             copy = cfg.DATASETS.VG_COPY
-        elif dataset_name == "imagenetod_train_odinw_2copy_dt":
+        elif copy_name == "imagenetod_train_odinw_2copy_dt":
             copy = cfg.DATASETS.IN_COPY
-        elif dataset_name == "oi_train_odinw_dt":
+        elif copy_name == "oi_train_odinw_dt":
             copy = cfg.DATASETS.OI_COPY
-        elif "refcoco" in dataset_name:
+        elif "refcoco" in copy_name:
             copy = cfg.DATASETS.REFCOCO_COPY
         elif is_train:
             copy = cfg.DATASETS.GENERAL_COPY
@@ -218,11 +222,15 @@ def make_data_sampler(dataset, shuffle, distributed, num_replicas=None, rank=Non
 def _quantize(x, bins):
     bins = copy.copy(bins)
     bins = sorted(bins)
-    quantized = list(map(lambda y: bisect.bisect_right(bins, y), x))
+    # same as bisect.bisect_right(bins, y) for every y
+    quantized = np.searchsorted(bins, np.asarray(x, dtype=np.float64), side="right").tolist()
     return quantized
 
 
-def _compute_aspect_ratios(dataset):
+def _compute_aspect_ratios(dataset, image_size_cache_dir=None, image_size_workers=0):
+    if image_size_cache_dir:
+        sizes = load_image_sizes(dataset, image_size_cache_dir, num_workers=image_size_workers)
+        return (sizes[:, 0].astype(np.float64) / sizes[:, 1]).tolist()
     aspect_ratios = []
     for i in range(len(dataset)):
         img_info = dataset.get_img_info(i)
@@ -232,12 +240,20 @@ def _compute_aspect_ratios(dataset):
 
 
 def make_batch_data_sampler(
-    dataset, sampler, aspect_grouping, images_per_batch, num_iters=None, start_iter=0, drop_last=False
+    dataset,
+    sampler,
+    aspect_grouping,
+    images_per_batch,
+    num_iters=None,
+    start_iter=0,
+    drop_last=False,
+    image_size_cache_dir=None,
+    image_size_workers=0,
 ):
     if aspect_grouping:
         if not isinstance(aspect_grouping, (list, tuple)):
             aspect_grouping = [aspect_grouping]
-        aspect_ratios = _compute_aspect_ratios(dataset)
+        aspect_ratios = _compute_aspect_ratios(dataset, image_size_cache_dir, image_size_workers)
         group_ids = _quantize(aspect_ratios, aspect_grouping)
         batch_sampler = samplers.GroupedBatchSampler(sampler, group_ids, images_per_batch, drop_uneven=drop_last)
     else:
@@ -499,12 +515,33 @@ def make_data_loader(cfg, is_train=True, is_distributed=False, num_replicas=None
                 use_random_seed=cfg.DATALOADER.USE_RANDOM_SEED,
             )
         batch_sampler = make_batch_data_sampler(
-            dataset, sampler, aspect_grouping, images_per_gpu, num_iters, start_iter, drop_last=is_train
+            dataset,
+            sampler,
+            aspect_grouping,
+            images_per_gpu,
+            num_iters,
+            start_iter,
+            drop_last=is_train,
+            image_size_cache_dir=cfg.DATALOADER.IMAGE_SIZE_CACHE_DIR,
+            image_size_workers=cfg.DATALOADER.IMAGE_SIZE_CACHE_WORKERS,
+        )
+        # with a "v2" SPAN_VERSION, the collator also splits the captions into the pieces used by the span pooling
+        span_version = cfg.MODEL.DYHEAD.FUSE_CONFIG.SPAN_VERSION
+        pretokenize = (
+            is_train
+            and cfg.DATALOADER.PRETOKENIZE
+            and (span_version is None or span_version.startswith("v2"))
         )
         collator = (
             BBoxAugCollator()
             if not is_train and cfg.TEST.USE_MULTISCALE
-            else BatchCollator(cfg.DATALOADER.SIZE_DIVISIBILITY)
+            else BatchCollator(
+                cfg.DATALOADER.SIZE_DIVISIBILITY,
+                tokenizer=extra_args["tokenizer"] if pretokenize else None,
+                max_query_len=cfg.MODEL.LANGUAGE_BACKBONE.MAX_QUERY_LEN,
+                pad_max=cfg.MODEL.LANGUAGE_BACKBONE.PAD_MAX,
+                span_version=span_version,
+            )
         )
         num_workers = cfg.DATALOADER.NUM_WORKERS
         data_loader = torch.utils.data.DataLoader(
@@ -1,6 +1,7 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 import torch
 from maskrcnn_benchmark.structures.image_list import to_image_list
+from maskrcnn_benchmark.utils.span_pooling import split_captions_by_spans, add_span_token_ranges
 
 import pdb
 
@@ -12,8 +13,16 @@ class BatchCollator(object):
     This should be passed to the DataLoader
     """
 
-    def __init__(self, size_divisible=0):
+    def __init__(self, size_divisible=0, tokenizer=None, max_query_len=256, pad_max=False, span_version=None):
         self.size_divisible = size_divisible
+        # if a tokenizer is given, the captions are tokenized here (i.e. in the dataloader workers) with the
+        # same arguments as GeneralizedVLRCNN.forward, and the batch gets a 7th element with the result
+        self.tokenizer = tokenizer
+        self.max_query_len = max_query_len
+        self.pad_max = pad_max
+        # with MODEL.DYHEAD.FUSE_CONFIG.SPAN_VERSION "v2*", the captions are split into pieces around their spans
+        # before the tokenization, as in GeneralizedVLRCNN.forward
+        self.span_version = span_version
 
     def __call__(self, batch):
         transposed_batch = list(zip(*batch))
@@ -63,8 +72,47 @@ class BatchCollator(object):
             assert cur_count == len(batched_pos_map)
             # assert batched_pos_map.sum().item() == sum([v["positive_map"].sum().item() for v in batch[1]])
             positive_map_eval = batched_pos_map.float()
+
+        if self.tokenizer is not None:
+            return images, targets, img_ids, positive_map, positive_map_eval, greenlight_map, self.tokenize(targets)
         return images, targets, img_ids, positive_map, positive_map_eval, greenlight_map
 
+    def tokenize(self, targets):
+        """
+        Returns a dict with the input_ids, attention_mask, special_tokens_mask and offset_mapping of the captions
+        of targets, or None if there are no captions. With a "v2" span_version, the dict also has a "span_split"
+        entry (see maskrcnn_benchmark.utils.span_pooling) and the tokenized captions are the caption pieces.
+        """
+        captions = [t.get_field("caption") for t in targets if "caption" in t.fields()]
+        if len(captions) == 0:
+            return None
+        span_split = None
+        padding = "max_length" if self.pad_max else "longest"
+        if self.span_version is not None and self.span_version.startswith("v2"):
+            if len(captions) != len(targets):
+                return None
+            spans = [t.get_field("spans") if "spans" in t.fields() else [] for t in targets]
+            span_split = split_captions_by_spans(captions, spans, independent="independent" in self.span_version)
+            captions = span_split["captions"]
+            padding = "longest"
+        tokenized = self.tokenizer.batch_encode_plus(
+            captions,
+            max_length=self.max_query_len,
+            padding=padding,
+            return_special_tokens_mask=True,
+            return_offsets_mapping=True,
+            return_tensors="pt",
+            truncation=True,
+        )
+        if span_split is not None:
+            # needs the encodings, which are not sent back from the workers
+            span_split = add_span_token_ranges(span_split, tokenized)
+        # plain dict of tensors, cheap to send back from the workers
+        tokenized = dict(tokenized)
+        if span_split is not None:
+            tokenized["span_split"] = span_split
+        return tokenized
+
 
 class BBoxAugCollator(object):
     """
@@ -15,7 +15,8 @@ import pdb
 from copy import deepcopy
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
-from maskrcnn_benchmark.data.datasets.parse_gpt import GPTOutputParser
+from maskrcnn_benchmark.data.datasets.parse_gpt import GPTOutputParser, gpt_outputs_of, load_description_index
+from maskrcnn_benchmark.data.datasets.od_to_grounding import count_tokens
 def find_only_noun(caption: str):
     caption = caption.lower()
     tokens = nltk.word_tokenize(caption)
@@ -246,6 +247,11 @@ class AugmentationV3():
         with open(caption_vocab_file, 'r') as f:
             self.vocab = json.load(f)
         self.vocab_keys = list(self.vocab.keys())
+        # the GPT outputs of the vocab are parsed once (see load_description_index), not at every sample
+        self.parsed_vocab = load_description_index(
+            caption_vocab_file, caption_augmentation_version.split(".")[-1], gpt_outputs_of(self.vocab)
+        )
+        self.normalized_nouns = {}
         self.stop_words = set(stopwords.words('english'))
         self.do_augment_prob = 1.0
         self.include_name_prob = 0.5
@@ -253,38 +259,46 @@ class AugmentationV3():
         self.length_limit = 800 if "span" in caption_augmentation_version else 180
         self.gpt_parser = GPTOutputParser(caption_augmentation_version.split(".")[-1])
 
+    def normalize(self, noun):
+        # memoized remove_stop_words
+        if noun not in self.normalized_nouns:
+            if len(self.normalized_nouns) > 100000:
+                self.normalized_nouns.clear()
+            self.normalized_nouns[noun] = remove_stop_words(noun, self.stop_words)
+        return self.normalized_nouns[noun]
+
     def parse_info(self, noun):
         # given a noun, return the category and other info
         '''
         {'type': 'human', 'description': 'female; could have long hair; could wear dresses', 'similar objects': ['girl', 'lady', 'mother']}
         '''
-        noun = remove_stop_words(noun, self.stop_words)
+        noun = self.normalize(noun)
         if noun not in self.vocab:
             return 0, [], [], ""
         info = self.vocab[noun]
-        descriptions = self.gpt_parser(info[0])
+        descriptions = self.gpt_parser(self.parsed_vocab.get(noun, info[0]))
 
         return info[1], descriptions["description"], descriptions["similar objects"], descriptions["type"]
 
     def get_freq(self, noun):
-        noun = remove_stop_words(noun, self.stop_words)
+        noun = self.normalize(noun)
         if noun not in self.vocab:
             return 0
         info = self.vocab[noun]
         return info[1]
 
     def get_similar_things(self, noun):
-        noun = remove_stop_words(noun, self.stop_words)
+        noun = self.normalize(noun)
         if noun not in self.vocab:
             return []
         info = self.vocab[noun]
-        descriptions = self.gpt_parser(info[0])
+        descriptions = self.gpt_parser(self.parsed_vocab.get(noun, info[0]))
         return descriptions["similar objects"]
 
     def form_span(self, noun):
-        noun = remove_stop_words(noun, self.stop_words)
+        noun = self.normalize(noun)
         info = self.vocab[noun]
-        description = info[0]
+        description = self.parsed_vocab.get(noun, info[0])
         if random.random() < self.include_name_prob:
             #postive_span = "{}, {}".format(noun, type_of_thing)
             #final_span = "{}, {}, {}".format(noun, type_of_thing, ", ".join(similar_visual_feature_descriptions))
@@ -437,44 +451,57 @@ class AugmentationV4():
         with open(caption_vocab_file, 'r') as f:
             self.vocab = json.load(f)
         self.vocab_keys = list(self.vocab.keys())
+        # the GPT outputs of the vocab are parsed once (see load_description_index), not at every sample
+        self.parsed_vocab = load_description_index(
+            caption_vocab_file, caption_augmentation_version.split(".")[-1], gpt_outputs_of(self.vocab)
+        )
+        self.normalized_nouns = {}
         self.include_v3_augmentation = "include_v3" in caption_augmentation_version
 
         # do a stat
         from ._pos_rate import PosRateController, PosRateControllerLength, PosRateControllerV2
         self.pos_rate_controller = PosRateControllerV2(max_length=35, center_length = 20)
 
+    def normalize(self, noun):
+        # memoized remove_stop_words
+        if noun not in self.normalized_nouns:
+            if len(self.normalized_nouns) > 100000:
+                self.normalized_nouns.clear()
+            self.normalized_nouns[noun] = remove_stop_words(noun, self.stop_words)
+        return self.normalized_nouns[noun]
+
     def parse_info(self, noun):
         # given a noun, return the category and other info
         '''
         {'type': 'human', 'description': 'female; could have long hair; could wear dresses', 'similar objects': ['girl', 'lady', 'mother']}
         '''
-        noun = remove_stop_words(noun, self.stop_words)
+        noun = self.normalize(noun)
         if noun not in self.vocab:
             return 0, [], [], ""
         info = self.vocab[noun]
-        descriptions = self.gpt_parser(info[0])
+        descriptions = self.gpt_parser(self.parsed_vocab.get(noun, info[0]))
 
         return info[1], descriptions["description"], descriptions["similar objects"], descriptions["type"]
 
     def get_freq(self, noun):
-        noun = remove_stop_words(noun, self.stop_words)
+        noun = self.normalize(noun)
         if noun not in self.vocab:
             return 0
         info = self.vocab[noun]
         return info[1]
 
     def get_similar_things(self, noun):
-        noun = remove_stop_words(noun, self.stop_words)
+        noun = self.normalize(noun)
         if noun not in self.vocab:
             return []
         info = self.vocab[noun]
-        descriptions = self.gpt_parser(info[0])
+        descriptions = self.gpt_parser(self.parsed_vocab.get(noun, info[0]))
         return descriptions["similar objects"]
 
     def form_span(self, noun):
-        noun = remove_stop_words(noun, self.stop_words)
+        noun = self.normalize(noun)
         info = self.vocab[noun]
-        description = info[0]
+        description = self.parsed_vocab.get(noun, info[0])
         if random.random() < self.include_name_prob:
             #postive_span = "{}, {}".format(noun, type_of_thing)
             #final_span = "{}, {}, {}".format(noun, type_of_thing, ", ".join(similar_visual_feature_descriptions))
@@ -950,18 +977,14 @@ def random_resemble_captions(
     # 2. create a mapping from original locations
     length_limit = 254
     current_caption = ""
-    # need to avoid calling the tokenizer too many times
+    # need to avoid calling the tokenizer too many times: count the tokens of all the kept captions in one call
+    indexes = [index for index in indexes if index in kep_indexes]
+    token_lengths = count_tokens(tokenizer, [all_captions[index] for index in indexes])
 
     for i in range(len(indexes)):
         caption = all_captions[indexes[i]]
 
-        if indexes[i] not in kep_indexes: # will not be kept
-            continue
-
-        tokenized = tokenizer.tokenize(caption)
-        #tokenized = caption.split(" ")
-
-        length_limit -= len(tokenized)
+        length_limit -= token_lengths[i]
         if length_limit < 0:
             break # we have reached the length limit
 
@@ -6,8 +6,9 @@ from maskrcnn_benchmark.structures.bounding_box import BoxList
 from maskrcnn_benchmark.data.datasets.tsv import load_from_yaml_file
 from collections import defaultdict
 from tqdm import tqdm
-from maskrcnn_benchmark.data.datasets.parse_gpt import GPTOutputParser
+from maskrcnn_benchmark.data.datasets.parse_gpt import GPTOutputParser, gpt_outputs_of, load_description_index
 from ._pos_rate import PosRateController, PosRateControllerLength, PosRateControllerV2
+from maskrcnn_benchmark.utils.token_offsets import build_positive_dict
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
     all_ = []
@@ -77,13 +78,19 @@ class DescriptionConverter():
                 self.description_list = json.load(f)
 
             self.gpt_parser = GPTOutputParser(od_to_grounding_version.split(".")[-1])
-            #self.preparse_descriptions()
+            # the GPT outputs are parsed once (see load_description_index), not at every sample
+            self.category_name_to_parsed_description = load_description_index(
+                description_file, od_to_grounding_version.split(".")[-1], gpt_outputs_of(self.description_list)
+            )
 
             self.category_name_to_description = {}
             for i in self.description_list:
                 # {'object': 'aerosol_can', 'object_id': 1, 'gpt3_output': '"\n{\"type\": \"vegetable\", \n\"description\": \"cylindrical, green, smooth; could have brown and rough stems; could be sliced into round pieces; could has green leaves\", \n\"similar objects\": [\"cucumber\", \"eggplant\", \"green bean\"]}"}'}
                 self.category_name_to_description[i["object"]] = i
 
+        # token lengths of the generated label sentences (a label only has a few variants of its sentence)
+        self.sentence_token_lengths = {}
+
         # stats to print warning
         self.drop_label_count = 0
         self.all_count = 0
@@ -200,38 +207,8 @@ class DescriptionConverter():
 
     def _infer_create_positive_dict(self, tokenized, tokens_positive, labels):
         """construct a dictionary such that positive_map[i] = j, iff token i is mapped to j label"""
-        positive_map = defaultdict(int)
-
         # Additionally, have positive_map_label_to_tokens
-        positive_map_label_to_token = defaultdict(list)
-
-        for j, tok_list in enumerate(tokens_positive):
-            for (beg, end) in tok_list:
-                beg_pos = tokenized.char_to_token(beg)
-                end_pos = tokenized.char_to_token(end - 1)
-                if beg_pos is None:
-                    try:
-                        beg_pos = tokenized.char_to_token(beg + 1)
-                        if beg_pos is None:
-                            beg_pos = tokenized.char_to_token(beg + 2)
-                    except:
-                        beg_pos = None
-                if end_pos is None:
-                    try:
-                        end_pos = tokenized.char_to_token(end - 2)
-                        if end_pos is None:
-                            end_pos = tokenized.char_to_token(end - 3)
-                    except:
-                        end_pos = None
-                if beg_pos is None or end_pos is None:
-                    continue
-
-                assert beg_pos is not None and end_pos is not None
-                for i in range(beg_pos, end_pos + 1):
-                    positive_map[i] = labels[j]  # because the labels starts from 1
-                    positive_map_label_to_token[labels[j]].append(i)
-                # positive_map[j, beg_pos : end_pos + 1].fill_(1)
-        return positive_map, positive_map_label_to_token  # / (positive_map.sum(-1)[:, None] + 1e-6)
+        return build_positive_dict(tokenized, tokens_positive, labels)
 
     def _infer_create_span_map(self, all_spans, label_to_positive_spans):
         # input: boxes, num_box to spans mapping
@@ -351,6 +328,10 @@ class DescriptionConverter():
 
         return screened_label_list
 
+    def _parsed_description(self, category_name):
+        gpt3_output = self.category_name_to_description[category_name]["gpt3_output"]
+        return self.category_name_to_parsed_description.get(category_name, gpt3_output)
+
     def _generate_sentence(self, label, ind_to_class, pheso_caption = "", force_mode = None, negative_label=None, negative_index=None):
         start_index = len(pheso_caption)
         category_name = ind_to_class[label]
@@ -363,7 +344,7 @@ class DescriptionConverter():
         if od_to_grounding_version == "description.gpt.v10":
             if negative_label is not None:
                 if negative_index == 0:
-                    description = self.category_name_to_description[category_name]["gpt3_output"]
+                    description = self._parsed_description(category_name)
                 else:
                     from copy import deepcopy
                     description = deepcopy(self.category_name_to_description[category_name]["gpt3_output"])
@@ -375,7 +356,7 @@ class DescriptionConverter():
                     description['description'] = neg_desc
                     description = json.dumps(description)
             else:
-                description = self.category_name_to_description[category_name]["gpt3_output"]
+                description = self._parsed_description(category_name)
             if "infer" in self.od_to_grounding_version:
                 prob = 0.0
             else:
@@ -498,14 +479,19 @@ class DescriptionConverter():
         greenlight_span_for_masked_lm_objective = [value for value in label_to_positions.values()]
         return new_target, greenlight_span_for_masked_lm_objective, new_target_boxlist
 
+    def _token_length(self, sentence, tokenizer):
+        if sentence not in self.sentence_token_lengths:
+            if len(self.sentence_token_lengths) > 100000:
+                self.sentence_token_lengths.clear()
+            self.sentence_token_lengths[sentence] = len(tokenizer.tokenize(sentence))
+        return self.sentence_token_lengths[sentence]
+
     def _label_drop_with_length_limit(self, label_list, ind_to_class, length_limit, tokenizer):
         screened_label_list = []
         random.shuffle(label_list) # randomly drop labels
         for label in label_list:
             pheso_caption, *_ = self._generate_sentence(label, ind_to_class, "")
-            tokenized = tokenizer.tokenize(pheso_caption)
-
-            length_limit -= len(tokenized)
+            length_limit -= self._token_length(pheso_caption, tokenizer)
             if length_limit > 0:
                 screened_label_list.append(label) # keep this label
             else:
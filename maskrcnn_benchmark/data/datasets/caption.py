@@ -1,6 +1,8 @@
 import torch
 import torch.distributed as dist
 import time
+import json
+import os.path as op
 from torchvision.ops import nms
 import random
 import numpy as np
@@ -8,7 +10,7 @@ from PIL import Image, ImageDraw
 import pdb
 from maskrcnn_benchmark.structures.bounding_box import BoxList
 from .modulated_coco import ConvertCocoPolysToMask
-from .tsv import ODTSVDataset, TSVYamlDataset
+from .tsv import ODTSVDataset, TSVYamlDataset, MMapTSVFile, caption_index_file
 from .od_to_grounding import sanity_check_target_after_processing
 from maskrcnn_benchmark.data.datasets._caption_aug import CaptionAugmentation
 from collections import defaultdict
@@ -66,6 +68,16 @@ class CaptionTSV(TSVYamlDataset):
             self.rank = dist.get_rank()
         except:
             self.rank = 0
+        # captions of the label rows (see tools/build_caption_index.py), to sample the negative captions without
+        # reading the images and the annotations
+        self.caption_index = None
+        if self.label_file is not None:
+            caption_file = caption_index_file(self.label_file)
+            if op.isfile(caption_file) and op.isfile(op.splitext(caption_file)[0] + ".lineidx.8b"):
+                self.caption_index = MMapTSVFile(caption_file)
+                if self.caption_index.num_rows() != self.label_tsv.num_rows():
+                    print("Ignoring {}: its number of rows does not match {}".format(caption_file, self.label_file))
+                    self.caption_index = None
         self.caption_augmentation_version = cc_caption_augmentation_version
         if self.caption_augmentation_version is not None:
             self.caption_augmentation = CaptionAugmentation(
@@ -119,8 +131,12 @@ class CaptionTSV(TSVYamlDataset):
     def __get_negative_captions__(self, idx, negative_size=7):
         negative_captions = []
         for i in range(negative_size):
-            img, anno, _, scale = super(CaptionTSV, self).__getitem__(np.random.choice(len(self)))
-            caption = anno["caption"]
+            negative_idx = np.random.choice(len(self))
+            if self.caption_index is not None:
+                caption = json.loads(self.caption_index.seek_first_column(self.get_line_no(negative_idx)))
+            else:
+                # only the caption is needed, do not decode the image
+                caption = self.get_annotations(negative_idx)["caption"]
             negative_captions.append(caption)
 
         return negative_captions
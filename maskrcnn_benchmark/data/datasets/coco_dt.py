@@ -13,7 +13,7 @@ from .tsv import ODTSVDataset
 from pycocotools.coco import COCO
 from maskrcnn_benchmark.structures.bounding_box import BoxList
 import random
-from .od_to_grounding import convert_object_detection_to_grounding_optimized_for_od, check_for_positive_overflow, sanity_check_target_after_processing, od_to_grounding_optimized_streamlined
+from .od_to_grounding import convert_object_detection_to_grounding_optimized_for_od, check_for_positive_overflow, sanity_check_target_after_processing, od_to_grounding_optimized_streamlined, build_label_token_lengths
 from ._od_to_description import DescriptionConverter
 import pdb
 from collections import defaultdict
@@ -57,6 +57,10 @@ class CocoDetectionTSV(ODTSVDataset):
             return_masks=False, return_tokens=return_tokens, tokenizer=tokenizer, max_query_len=max_query_len
         )
         self.tokenizer = tokenizer
+        # token length of every class name, so that the prompt length limits do not tokenize them at every sample
+        self.label_token_lengths = None
+        if tokenizer is not None and hasattr(self, "ind_to_class"):
+            self.label_token_lengths = build_label_token_lengths(self.ind_to_class, tokenizer)
 
         self.control_probabilities = control_probabilities
         self.random_sample_negative = random_sample_negative
@@ -113,7 +117,7 @@ class CocoDetectionTSV(ODTSVDataset):
         original_box_num = len(target)
 
         target, positive_caption_length = check_for_positive_overflow(
-            target, self.ind_to_class, self.tokenizer, self.max_query_len - 2
+            target, self.ind_to_class, self.tokenizer, self.max_query_len - 2, label_token_lengths=self.label_token_lengths
         )  # leave some space for the special tokens
 
         if len(target) < original_box_num:
@@ -144,6 +148,7 @@ class CocoDetectionTSV(ODTSVDataset):
                     positive_caption_length=positive_caption_length,
                     tokenizer=self.tokenizer,
                     max_seq_length=self.max_query_len - 2,
+                    label_token_lengths=self.label_token_lengths,
                 )
         elif "description" in self.od_to_grounding_version:
             annotations, caption, greenlight_span_for_masked_lm_objective, label_to_positions, target = self.od_grounding_converter.train_od_to_grounding(
@@ -160,6 +165,7 @@ class CocoDetectionTSV(ODTSVDataset):
                 ind_to_class=self.ind_to_class,
                 tokenizer=self.tokenizer,
                 od_to_grounding_version=self.od_to_grounding_version,
+                label_token_lengths=self.label_token_lengths,
             )
         else:
             annotations, caption, greenlight_span_for_masked_lm_objective, label_to_positions = convert_object_detection_to_grounding_optimized_for_od(
@@ -177,6 +183,7 @@ class CocoDetectionTSV(ODTSVDataset):
             positive_caption_length=positive_caption_length,
             tokenizer=self.tokenizer,
             max_seq_length=self.max_query_len - 2,
+            label_token_lengths=self.label_token_lengths,
         )
 
         # assert(len(self.tokenizer.tokenize(caption)) <= self.max_query_len-2)
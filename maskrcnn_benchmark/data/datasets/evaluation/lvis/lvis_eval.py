@@ -3,6 +3,8 @@
 import copy
 import datetime
 import json
+import logging
+import multiprocessing
 import os
 from collections import OrderedDict, defaultdict
 
@@ -13,7 +15,7 @@ import torch._six
 
 import maskrcnn_benchmark.utils.mdetr_dist  as dist
 
-from maskrcnn_benchmark.utils.mdetr_dist import all_gather
+from maskrcnn_benchmark.utils.mdetr_dist import all_gather, gather_tensor
 
 
 from .lvis import LVIS
@@ -151,18 +153,33 @@ class LVISResults(LVIS):
         return list(filter(lambda ann: ann["score"] > score_thrs, anns))
 
 
+# LVISEval being evaluated by the forked workers of LVISEval._evaluate_vectorized
+_WORKER_LVIS_EVAL = None
+
+
+def _evaluate_cats_in_worker(cat_ids):
+    return _WORKER_LVIS_EVAL._evaluate_cats(cat_ids)
+
+
 class LVISEval:
-    def __init__(self, lvis_gt, lvis_dt=None, iou_type="segm"):
+    def __init__(self, lvis_gt, lvis_dt=None, iou_type="segm", engine="loop", num_workers=0):
         """Constructor for LVISEval.
         Args:
             lvis_gt (LVIS class instance, or str containing path of annotation file)
             lvis_dt (LVISResult class instance, or str containing path of result file,
             or list of dict)
             iou_type (str): segm or bbox evaluation
+            engine (str): "loop" for the reference per-image evaluation, "vectorized" for the
+            numpy matcher (same results)
+            num_workers (int): number of processes the categories are sharded across (vectorized engine only)
         """
 
         if iou_type not in ["bbox", "segm"]:
             raise ValueError("iou_type: {} is not supported.".format(iou_type))
+        if engine not in ["loop", "vectorized"]:
+            raise ValueError("engine: {} is not supported.".format(engine))
+        self.engine = engine
+        self.num_workers = num_workers
 
         if isinstance(lvis_gt, LVIS):
             self.lvis_gt = lvis_gt
@@ -263,6 +280,10 @@ class LVISEval:
 
         self._prepare()
 
+        if self.engine == "vectorized" and self.params.use_cats:
+            self._evaluate_vectorized(cat_ids)
+            return
+
         self.ious = {
             (img_id, cat_id): self.compute_iou(img_id, cat_id) for img_id in self.params.img_ids for cat_id in cat_ids
         }
@@ -275,6 +296,119 @@ class LVISEval:
             for img_id in self.params.img_ids
         ]
 
+    def _evaluate_vectorized(self, cat_ids):
+        """
+        Same results as the loop in evaluate(), but only the (image, category) pairs that have gts or dts are
+        visited, the IoUs are computed once for the four area ranges and the greedy matching is vectorized over
+        IoU thresholds and gts. With num_workers > 0 the categories are sharded across a process pool.
+        """
+        self._eval_keys = set(self._gts.keys()) | set(self._dts.keys())
+        self.ious = {}
+        if self.num_workers > 0 and len(cat_ids) > 1:
+            global _WORKER_LVIS_EVAL
+            num_shards = min(self.num_workers * 4, len(cat_ids))
+            shards = [list(shard) for shard in np.array_split(np.asarray(cat_ids), num_shards)]
+            # the pool is forked after setting the global, so the workers see the prepared gts/dts without pickling
+            _WORKER_LVIS_EVAL = self
+            try:
+                with multiprocessing.get_context("fork").Pool(self.num_workers) as pool:
+                    eval_imgs = pool.map(_evaluate_cats_in_worker, shards)
+            finally:
+                _WORKER_LVIS_EVAL = None
+            self.eval_imgs = [e for shard in eval_imgs for e in shard]
+        else:
+            self.eval_imgs = self._evaluate_cats(cat_ids)
+
+    def _evaluate_cats(self, cat_ids):
+        eval_imgs = []
+        for cat_id in cat_ids:
+            per_area = [[] for _ in self.params.area_rng]
+            for img_id in self.params.img_ids:
+                if (img_id, cat_id) not in self._eval_keys:
+                    for _per_area in per_area:
+                        _per_area.append(None)
+                    continue
+                ious = self.compute_iou(img_id, cat_id)
+                for _per_area, area_rng in zip(per_area, self.params.area_rng):
+                    _per_area.append(self.evaluate_img_vectorized(img_id, cat_id, area_rng, ious))
+            for _per_area in per_area:
+                eval_imgs.extend(_per_area)
+        return eval_imgs
+
+    def evaluate_img_vectorized(self, img_id, cat_id, area_rng, ious):
+        """Vectorized evaluate_img: greedy matching of all IoU thresholds at once."""
+        gt, dt = self._get_gt_dt(img_id, cat_id)
+
+        if len(gt) == 0 and len(dt) == 0:
+            return None
+
+        # ignore flag based on area range, gt ignore last
+        gt_ig = np.array(
+            [int(bool(g["ignore"]) or g["area"] < area_rng[0] or g["area"] > area_rng[1]) for g in gt]
+        )
+        gt_idx = np.argsort(gt_ig, kind="mergesort")
+        gt_ig = gt_ig[gt_idx]
+        gt_ids = np.array([gt[i]["id"] for i in gt_idx])
+
+        # dt highest score first
+        dt_scores = np.array([d["score"] for d in dt], dtype=np.float64)
+        dt_idx = np.argsort(-dt_scores, kind="mergesort")
+        dt = [dt[i] for i in dt_idx]
+        dt_ids = np.array([d["id"] for d in dt])
+
+        num_thrs = len(self.params.iou_thrs)
+        num_gt = len(gt)
+        num_dt = len(dt)
+
+        gt_m = np.zeros((num_thrs, num_gt))
+        dt_m = np.zeros((num_thrs, num_dt))
+        dt_ig = np.zeros((num_thrs, num_dt))
+
+        if len(ious) > 0:
+            ious = np.asarray(ious)[:, gt_idx]
+            iou_thrs = np.minimum(self.params.iou_thrs, 1 - 1e-10)[:, None]  # num_thrs x 1
+            thr_idx = np.arange(num_thrs)
+            for _dt_idx in range(num_dt):
+                # unmatched gts above the threshold, for every threshold: num_thrs x num_gt
+                candidate_ious = np.where(
+                    (ious[_dt_idx][None, :] >= iou_thrs) & (gt_m == 0), ious[_dt_idx][None, :], -np.inf
+                )
+                # a match on a regular gt always wins over a match on an ignored gt
+                regular_ious = np.where(gt_ig[None, :] == 0, candidate_ious, -np.inf)
+                has_regular = (regular_ious > -np.inf).any(1)
+                candidate_ious = np.where(has_regular[:, None], regular_ious, candidate_ious)
+                has_match = (candidate_ious > -np.inf).any(1)
+                if not has_match.any():
+                    continue
+                # best match, ties go to the last gt as in evaluate_img
+                m = num_gt - 1 - np.argmax(candidate_ious[:, ::-1], axis=1)
+                rows, m = thr_idx[has_match], m[has_match]
+                dt_ig[rows, _dt_idx] = gt_ig[m]
+                dt_m[rows, _dt_idx] = gt_ids[m]
+                gt_m[rows, m] = dt_ids[_dt_idx]
+
+        # For LVIS we will ignore any unmatched detection if that category was
+        # not exhaustively annotated in gt.
+        dt_area = np.array([d["area"] for d in dt], dtype=np.float64)
+        dt_ig_mask = (dt_area < area_rng[0]) | (dt_area > area_rng[1])
+        dt_ig_mask = dt_ig_mask | np.array(
+            [d["category_id"] in self.img_nel[d["image_id"]] for d in dt], dtype=bool
+        )
+        dt_ig_mask = np.repeat(dt_ig_mask.reshape((1, num_dt)), num_thrs, 0)  # num_thrs X num_dt
+        dt_ig = np.logical_or(dt_ig, np.logical_and(dt_m == 0, dt_ig_mask))
+        return {
+            "image_id": img_id,
+            "category_id": cat_id,
+            "area_rng": area_rng,
+            "dt_ids": [d["id"] for d in dt],
+            "gt_ids": [gt[i]["id"] for i in gt_idx],
+            "dt_matches": dt_m,
+            "gt_matches": gt_m,
+            "dt_scores": [d["score"] for d in dt],
+            "gt_ignore": gt_ig,
+            "dt_ignore": dt_ig,
+        }
+
     def _get_gt_dt(self, img_id, cat_id):
         """Create gt, dt which are list of anns/dets. If use_cats is true
         only anns/dets corresponding to tuple (img_id, cat_id) will be
@@ -633,7 +767,7 @@ class LVISEval:
 
 
 class LvisEvaluator(object):
-    def __init__(self, lvis_gt, iou_types):
+    def __init__(self, lvis_gt, iou_types, eval_engine="loop", num_workers=0):
         assert isinstance(iou_types, (list, tuple))
         # lvis_gt = copy.deepcopy(lvis_gt)
         self.lvis_gt = lvis_gt
@@ -641,7 +775,9 @@ class LvisEvaluator(object):
         self.iou_types = iou_types
         self.coco_eval = {}
         for iou_type in iou_types:
-            self.coco_eval[iou_type] = LVISEval(lvis_gt, iou_type=iou_type)
+            self.coco_eval[iou_type] = LVISEval(
+                lvis_gt, iou_type=iou_type, engine=eval_engine, num_workers=num_workers
+            )
 
         self.img_ids = []
         self.eval_imgs = {k: [] for k in iou_types}
@@ -761,31 +897,94 @@ def _merge_lists(listA, listB, maxN, key):
     return result
 
 
+# one row per detection, ~36 bytes instead of a python dict per detection
+_DET_DTYPE = np.dtype(
+    [("image_id", np.int64), ("category_id", np.int64), ("bbox", np.float32, (4,)), ("score", np.float32)]
+)
+
+
+def _dets_to_tensor(dets):
+    # float64 holds the int64 ids (< 2**53) and the float32 values exactly
+    packed = np.empty((len(dets), 7), dtype=np.float64)
+    packed[:, 0] = dets["image_id"]
+    packed[:, 1] = dets["category_id"]
+    packed[:, 2:6] = dets["bbox"]
+    packed[:, 6] = dets["score"]
+    return torch.from_numpy(packed)
+
+
+def _tensor_to_dets(tensor):
+    packed = tensor.numpy()
+    dets = np.empty(len(packed), dtype=_DET_DTYPE)
+    dets["image_id"] = packed[:, 0]
+    dets["category_id"] = packed[:, 1]
+    dets["bbox"] = packed[:, 2:6]
+    dets["score"] = packed[:, 6]
+    return dets
+
+
+def _split_by_category(dets):
+    """Yields (category_id, dets of that category), categories in order of first appearance."""
+    if len(dets) == 0:
+        return
+    order = np.argsort(dets["category_id"], kind="stable")
+    dets = dets[order]
+    cats, starts = np.unique(dets["category_id"], return_index=True)
+    groups = dict(zip(cats.tolist(), np.split(dets, starts[1:])))
+    for _, cat in sorted(zip(order[starts].tolist(), cats.tolist())):
+        yield cat, groups[cat]
+
+
+class _TopKBuffer(object):
+    """
+    Highest scoring detections of one category. New detections are appended and the buffer is
+    compacted (stable sort by decreasing score, truncation to topk) once it holds more than 2 * topk rows,
+    so it never grows past 2 * topk + one update. Ties keep insertion order, as with _merge_lists.
+    """
+
+    def __init__(self, topk):
+        self.topk = topk
+        self.chunks = []
+        self.size = 0
+
+    def push(self, dets):
+        self.chunks.append(dets)
+        self.size += len(dets)
+        if self.size > 2 * self.topk:
+            self.compact()
+
+    def compact(self):
+        if len(self.chunks) == 0:
+            return np.empty(0, dtype=_DET_DTYPE)
+        dets = np.concatenate(self.chunks) if len(self.chunks) > 1 else self.chunks[0]
+        dets = dets[np.argsort(-dets["score"], kind="stable")[: self.topk]]
+        self.chunks = [dets]
+        self.size = len(dets)
+        return dets
+
+    @property
+    def nbytes(self):
+        return sum(chunk.nbytes for chunk in self.chunks)
+
+
 # Adapted from https://github.com/achalddave/large-vocab-devil/blob/9aaddc15b00e6e0d370b16743233e40d973cd53f/scripts/evaluate_ap_fixed.py
 class LvisEvaluatorFixedAP(object):
-    def __init__(self, gt: LVIS, topk=10000, fixed_ap=True):
+    def __init__(self, gt: LVIS, topk=10000, fixed_ap=True, eval_engine="loop", num_workers=0):
 
         self.results = []
         self.by_cat = {}
         self.gt = gt
         self.topk = topk
         self.fixed_ap = fixed_ap
+        self.eval_engine = eval_engine
+        self.num_workers = num_workers
 
 
     def update(self, predictions):
-        cur_results = self.prepare(predictions)
         if self.fixed_ap:
-            by_cat = defaultdict(list)
-            for ann in cur_results:
-                by_cat[ann["category_id"]].append(ann)
-
-            for cat, cat_anns in by_cat.items():
-                if cat not in self.by_cat:
-                    self.by_cat[cat] = []
-
-                cur = sorted(cat_anns, key=lambda x: x["score"], reverse=True)[: self.topk]
-                self.by_cat[cat] = _merge_lists(self.by_cat[cat], cur, self.topk, key=lambda x: x["score"])
+            self._push(self.prepare_columnar(predictions))
         else:
+            cur_results = self.prepare(predictions)
             by_id = defaultdict(list)
             for ann in cur_results:
                 by_id[ann["image_id"]].append(ann)
@@ -793,13 +992,38 @@ class LvisEvaluatorFixedAP(object):
             for id_anns in by_id.values():
                 self.results.extend(sorted(id_anns, key=lambda x: x["score"], reverse=True)[:300])
 
+    def _push(self, dets):
+        for cat, cat_dets in _split_by_category(dets):
+            if cat not in self.by_cat:
+                self.by_cat[cat] = _TopKBuffer(self.topk)
+            self.by_cat[cat].push(cat_dets)
+
+    def _local_dets(self):
+        """All detections kept by this rank, at most topk per category."""
+        chunks = [buffer.compact() for buffer in self.by_cat.values()]
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=_DET_DTYPE)
+
+    def memory_bytes(self):
+        """Bytes held by the per-category top-k buffers of this rank."""
+        return sum(buffer.nbytes for buffer in self.by_cat.values())
+
     def synchronize_between_processes(self):
         if self.fixed_ap:
-            all_cats = dist.all_gather(self.by_cat)
-            self.by_cat = defaultdict(list)
-            for cats in all_cats:
-                for cat, cat_anns in cats.items():
-                    self.by_cat[cat].extend(cat_anns)
+            logger = logging.getLogger("maskrcnn_benchmark.inference")
+            logger.info(
+                "LvisEvaluatorFixedAP rank {}: {} detections in {} categories, {:.1f} MB".format(
+                    dist.get_rank(),
+                    sum(buffer.size for buffer in self.by_cat.values()),
+                    len(self.by_cat),
+                    self.memory_bytes() / 1024 ** 2,
+                )
+            )
+            # only the main process evaluates: the detections are gathered to it, the other ranks drop theirs
+            all_dets = gather_tensor(_dets_to_tensor(self._local_dets()), dst=0)
+            self.by_cat = {}
+            if all_dets is not None:
+                for dets in all_dets:
+                    self._push(_tensor_to_dets(dets))
         else:
             self.results = sum(dist.all_gather(self.results), [])
 
@@ -827,6 +1051,21 @@ class LvisEvaluatorFixedAP(object):
             )
         return lvis_results
 
+    def prepare_columnar(self, predictions):
+        """Same content as prepare, as a _DET_DTYPE array instead of a list of dicts."""
+        chunks = []
+        for original_id, prediction in predictions:
+            if len(prediction) == 0:
+                continue
+
+            dets = np.empty(len(prediction["boxes"]), dtype=_DET_DTYPE)
+            dets["image_id"] = original_id
+            dets["category_id"] = prediction["labels"].cpu().numpy()
+            dets["bbox"] = convert_to_xywh(prediction["boxes"]).cpu().numpy()
+            dets["score"] = prediction["scores"].cpu().numpy()
+            chunks.append(dets)
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=_DET_DTYPE)
+
     def summarize(self):
         if not dist.is_main_process():
             return
@@ -838,7 +1077,7 @@ class LvisEvaluatorFixedAP(object):
 
     def _summarize_standard(self):
         results = LVISResults(self.gt, self.results)
-        lvis_eval = LVISEval(self.gt, results, iou_type="bbox")
+        lvis_eval = LVISEval(self.gt, results, iou_type="bbox", engine=self.eval_engine, num_workers=self.num_workers)
         lvis_eval.run()
         lvis_eval.print_results()
 
@@ -846,10 +1085,19 @@ class LvisEvaluatorFixedAP(object):
         results = []
 
         missing_dets_cats = set()
-        for cat, cat_anns in self.by_cat.items():
-            if len(cat_anns) < self.topk:
+        for cat, buffer in self.by_cat.items():
+            cat_dets = buffer.compact()
+            if len(cat_dets) < self.topk:
                 missing_dets_cats.add(cat)
-            results.extend(sorted(cat_anns, key=lambda x: x["score"], reverse=True)[: self.topk])
+            results.extend(
+                {"image_id": image_id, "category_id": category_id, "bbox": bbox, "score": score}
+                for image_id, category_id, bbox, score in zip(
+                    cat_dets["image_id"].tolist(),
+                    cat_dets["category_id"].tolist(),
+                    cat_dets["bbox"].tolist(),
+                    cat_dets["score"].tolist(),
+                )
+            )
         if missing_dets_cats:
             print(
                 f"\n===\n"
@@ -861,7 +1109,7 @@ class LvisEvaluatorFixedAP(object):
             )
 
         results = LVISResults(self.gt, results, max_dets=-1)
-        lvis_eval = LVISEval(self.gt, results, iou_type="bbox")
+        lvis_eval = LVISEval(self.gt, results, iou_type="bbox", engine=self.eval_engine, num_workers=self.num_workers)
         params = lvis_eval.params
         params.max_dets = -1  # No limit on detections per image.
         lvis_eval.run()
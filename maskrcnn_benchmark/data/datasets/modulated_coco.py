@@ -15,7 +15,8 @@ from pycocotools import mask as coco_mask
 from maskrcnn_benchmark.structures.bounding_box import BoxList
 from maskrcnn_benchmark.structures.segmentation_mask import SegmentationMask
 from maskrcnn_benchmark.data.datasets.coco import has_valid_annotation
-from .od_to_grounding import convert_od_to_grounding_simple, check_for_positive_overflow, sanity_check_target_after_processing, convert_object_detection_to_grounding_optimized_for_od, od_to_grounding_optimized_streamlined
+from maskrcnn_benchmark.utils.token_offsets import build_char_to_token_table, build_positive_map, char_spans_to_token_spans
+from .od_to_grounding import convert_od_to_grounding_simple, check_for_positive_overflow, sanity_check_target_after_processing, convert_object_detection_to_grounding_optimized_for_od, od_to_grounding_optimized_streamlined, build_label_token_lengths
 from ._od_to_description import DescriptionConverter
 import pdb
 import json
@@ -102,6 +103,8 @@ class CocoGrounding(torchvision.datasets.CocoDetection):
         self.is_train = is_train
 
         self.ind_to_class = self.categories(no_background=False)
+        # token length of every class name, so that the prompt length limits do not tokenize them at every sample
+        self.label_token_lengths = build_label_token_lengths(self.ind_to_class, tokenizer) if tokenizer is not None else None
 
         self.disable_shuffle = disable_shuffle
         self.add_detection_prompt = add_detection_prompt
@@ -182,13 +185,14 @@ class CocoGrounding(torchvision.datasets.CocoDetection):
                 ind_to_class=self.ind_to_class,
                 tokenizer=self.tokenizer,
                 od_to_grounding_version=self.od_to_grounding_version,
+                label_token_lengths=self.label_token_lengths,
             )
         elif self.special_safeguard_for_coco_grounding:
             # Intended for LVIS
             assert(not self.use_caption_prompt)
 
             original_box_num = len(target)
-            target, positive_caption_length = check_for_positive_overflow(target, self.ind_to_class, self.tokenizer, self.max_query_len-2) # leave some space for the special tokens
+            target, positive_caption_length = check_for_positive_overflow(target, self.ind_to_class, self.tokenizer, self.max_query_len-2, label_token_lengths=self.label_token_lengths) # leave some space for the special tokens
             if len(target) < original_box_num:
                 print("WARNING: removed {} boxes due to positive caption overflow".format(original_box_num - len(target)))
 
@@ -208,6 +212,7 @@ class CocoGrounding(torchvision.datasets.CocoDetection):
                 tokenizer=self.tokenizer,
                 max_seq_length=self.max_query_len - 2,
                 od_to_grounding_version=self.od_to_grounding_version,
+                label_token_lengths=self.label_token_lengths,
             )
         else:
             # Intended for COCO / ODinW
@@ -603,37 +608,13 @@ def create_greenlight_map(tok_list, tokenized):
     # [(0, 5), (10, 13), (-1, -1, -1)]
     # The last one is a special indicator..
 
-    greenlight_map = torch.zeros(256, dtype=torch.float)
     for item in tok_list:
         if len(item) != 2:
             assert len(item) == 3
             # Make everything unmakable
-            greenlight_map[:] = -1
-            break
-
-        beg, end = item
-        beg_pos = tokenized.char_to_token(beg)
-        end_pos = tokenized.char_to_token(end - 1)
-        if beg_pos is None:
-            try:
-                beg_pos = tokenized.char_to_token(beg + 1)
-                if beg_pos is None:
-                    beg_pos = tokenized.char_to_token(beg + 2)
-            except:
-                beg_pos = None
-        if end_pos is None:
-            try:
-                end_pos = tokenized.char_to_token(end - 2)
-                if end_pos is None:
-                    end_pos = tokenized.char_to_token(end - 3)
-            except:
-                end_pos = None
-        if beg_pos is None or end_pos is None:
-            continue
+            return torch.full((256,), -1, dtype=torch.float)
 
-        assert beg_pos is not None and end_pos is not None
-        greenlight_map[beg_pos : end_pos + 1].fill_(1)
-    return greenlight_map
+    return build_positive_map(tokenized, [tok_list])[0]
 
 
 def create_positive_map_for_od_labels(tokenized, label_to_positions):
@@ -646,30 +627,16 @@ def create_positive_map_for_od_labels(tokenized, label_to_positions):
     """
     positive_map = torch.ones(256, dtype=torch.float) * -1  # -1 means no match
     keys = list(label_to_positions.keys())
-    for j, key in enumerate(keys):
-        tok_list = label_to_positions[key]
-        # one label only mapps to one location
-        beg, end = tok_list
-        beg_pos = tokenized.char_to_token(beg)
-        end_pos = tokenized.char_to_token(end - 1)
-        if beg_pos is None:
-            try:
-                beg_pos = tokenized.char_to_token(beg + 1)
-                if beg_pos is None:
-                    beg_pos = tokenized.char_to_token(beg + 2)
-            except:
-                beg_pos = None
-        if end_pos is None:
-            try:
-                end_pos = tokenized.char_to_token(end - 2)
-                if end_pos is None:
-                    end_pos = tokenized.char_to_token(end - 3)
-            except:
-                end_pos = None
-        if beg_pos is None or end_pos is None:
+    if len(keys) == 0:
+        return positive_map
+    # one label only mapps to one location
+    spans = torch.as_tensor([label_to_positions[key] for key in keys], dtype=torch.long).view(-1, 2)
+    table = build_char_to_token_table(tokenized)
+    beg_pos, end_pos = char_spans_to_token_spans(table, spans[:, 0], spans[:, 1])
+    for key, beg, end in zip(keys, beg_pos.tolist(), end_pos.tolist()):
+        if beg < 0 or end < 0:
             continue
-        assert beg_pos is not None and end_pos is not None
-        positive_map[beg_pos : end_pos + 1].fill_(key)
+        positive_map[beg : end + 1].fill_(key)
     return positive_map
 
 
@@ -692,33 +659,7 @@ def convert_coco_poly_to_mask(segmentations, height, width):
 
 def create_positive_map(tokenized, tokens_positive):
     """construct a map such that positive_map[i,j] = True iff box i is associated to token j"""
-    positive_map = torch.zeros((len(tokens_positive), 256), dtype=torch.float)
-
-    for j, tok_list in enumerate(tokens_positive):
-        for (beg, end) in tok_list:
-            if beg < 0 or end < 0:
-                continue
-            beg_pos = tokenized.char_to_token(beg)
-            end_pos = tokenized.char_to_token(end - 1)
-            if beg_pos is None:
-                try:
-                    beg_pos = tokenized.char_to_token(beg + 1)
-                    if beg_pos is None:
-                        beg_pos = tokenized.char_to_token(beg + 2)
-                except:
-                    beg_pos = None
-            if end_pos is None:
-                try:
-                    end_pos = tokenized.char_to_token(end - 2)
-                    if end_pos is None:
-                        end_pos = tokenized.char_to_token(end - 3)
-                except:
-                    end_pos = None
-            if beg_pos is None or end_pos is None:
-                continue
-
-            assert beg_pos is not None and end_pos is not None
-            positive_map[j, beg_pos : end_pos + 1].fill_(1)
+    positive_map = build_positive_map(tokenized, tokens_positive)
     return positive_map / (positive_map.sum(-1)[:, None] + 1e-6)
 
 
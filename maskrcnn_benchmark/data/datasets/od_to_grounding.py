@@ -54,6 +54,30 @@ class DetectionToGrounding():
     def __init__(self, version):
         pass
 
+def count_tokens(tokenizer, texts):
+    """
+    len(tokenizer.tokenize(text)) of every text, in one batched tokenizer call.
+    """
+    texts = list(texts)
+    if len(texts) == 0:
+        return []
+    return [len(input_ids) for input_ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+def build_label_token_lengths(ind_to_class, tokenizer):
+    """
+    {label: number of tokens of "<clean name>. "}, the length the prompts budget for each label. Built once per
+    dataset so that the length limits do not tokenize the names of the sampled labels at every sample.
+    """
+    labels = list(ind_to_class.keys())
+    lengths = count_tokens(tokenizer, [clean_name(ind_to_class[label]) + ". " for label in labels])
+    return dict(zip(labels, lengths))
+
+def _label_token_length(label, ind_to_class, tokenizer, label_token_lengths=None):
+    if label_token_lengths is not None and label in label_token_lengths:
+        return label_token_lengths[label]
+    label_text = clean_name(ind_to_class[label]) + ". " # "dog. "
+    return len(tokenizer.tokenize(label_text))
+
 def sanity_check_target_after_processing(target):
     assert(len(target.bbox) == len(target.extra_fields["boxes"]))
 
@@ -141,7 +165,7 @@ def convert_od_to_grounding_simple(
     return new_target, pheso_caption, greenlight_span_for_masked_lm_objective
 
 
-def check_for_positive_overflow(target, ind_to_class, tokenizer, max_seq_length=256):
+def check_for_positive_overflow(target, ind_to_class, tokenizer, max_seq_length=256, label_token_lengths=None):
     # NOTE: Only call this function for OD data; DO NOT USE IT FOR GROUNDING DATA
     # NOTE: called only in coco_dt
 
@@ -161,11 +185,7 @@ def check_for_positive_overflow(target, ind_to_class, tokenizer, max_seq_length=
 
     for index, label in enumerate(positive_label_list):
 
-        label_text = clean_name(ind_to_class[label]) + ". " # "dog. "
-
-        tokenized = tokenizer.tokenize(label_text)
-
-        length += len(tokenized)
+        length += _label_token_length(label, ind_to_class, tokenizer, label_token_lengths)
 
         if length > max_seq_length:
             break
@@ -187,15 +207,11 @@ def check_for_positive_overflow(target, ind_to_class, tokenizer, max_seq_length=
 
 
 
-def _label_drop_with_length_limit(label_list, ind_to_class, length_limit, tokenizer):
+def _label_drop_with_length_limit(label_list, ind_to_class, length_limit, tokenizer, label_token_lengths=None):
     screened_label_list = []
     random.shuffle(label_list) # randomly drop labels
     for label in label_list:
-        label_text = clean_name(ind_to_class[label]) + ". " # "dog. "
-
-        tokenized = tokenizer.tokenize(label_text)
-        
-        length_limit -= len(tokenized)
+        length_limit -= _label_token_length(label, ind_to_class, tokenizer, label_token_lengths)
 
         if length_limit > 0: 
             screened_label_list.append(label) # keep this label
@@ -203,15 +219,15 @@ def _label_drop_with_length_limit(label_list, ind_to_class, length_limit, tokeni
             break
     return screened_label_list
 
-def _randomv1_od_to_grounding(all_labels, ind_to_class, max_seq_length, max_num_labels, tokenizer):
+def _randomv1_od_to_grounding(all_labels, ind_to_class, max_seq_length, max_num_labels, tokenizer, label_token_lengths=None):
     
     label_num = np.random.randint(1, max_num_labels)
     selected_label_list = np.random.choice(all_labels, label_num, replace=False)
-    screened_label_list = _label_drop_with_length_limit(selected_label_list, ind_to_class, max_seq_length, tokenizer)
+    screened_label_list = _label_drop_with_length_limit(selected_label_list, ind_to_class, max_seq_length, tokenizer, label_token_lengths)
 
     return screened_label_list
 
-def _randomv2_od_to_grounding(all_labels, ind_to_class, max_seq_length, max_num_labels, tokenizer, positive_label_set):
+def _randomv2_od_to_grounding(all_labels, ind_to_class, max_seq_length, max_num_labels, tokenizer, positive_label_set, label_token_lengths=None):
     
     full_positive = len(positive_label_set)
     full_negative = max_num_labels - full_positive
@@ -239,7 +255,7 @@ def _randomv2_od_to_grounding(all_labels, ind_to_class, max_seq_length, max_num_
     positive_label_list = positive_label_list[:num_positives]
 
     selected_label_list = positive_label_list + negative_label_list
-    screened_label_list = _label_drop_with_length_limit(selected_label_list, ind_to_class, max_seq_length, tokenizer)
+    screened_label_list = _label_drop_with_length_limit(selected_label_list, ind_to_class, max_seq_length, tokenizer, label_token_lengths)
     return screened_label_list
 
 def od_to_grounding_optimized_streamlined(
@@ -248,6 +264,7 @@ def od_to_grounding_optimized_streamlined(
         ind_to_class,
         tokenizer,
         od_to_grounding_version,
+        label_token_lengths=None,
     ):
 
     if od_to_grounding_version == "random.v1":
@@ -293,6 +310,7 @@ def od_to_grounding_optimized_streamlined(
             max_seq_length = max_seq_length,
             max_num_labels = max_num_labels,
             tokenizer = tokenizer,
+            label_token_lengths = label_token_lengths,
         )
         label_to_positions, pheso_caption = generate_senetence_given_labels(
             label_list=screened_label_list, )
@@ -304,6 +322,7 @@ def od_to_grounding_optimized_streamlined(
             max_num_labels = max_num_labels,
             tokenizer = tokenizer,
             positive_label_set = set(target.extra_fields["labels"].tolist()),
+            label_token_lengths = label_token_lengths,
         )
         label_to_positions, pheso_caption = generate_senetence_given_labels(
             label_list=screened_label_list, )
@@ -360,12 +379,14 @@ def convert_object_detection_to_grounding_optimized_for_od(
         tokenizer=None,
         positive_caption_length=0,
         od_to_grounding_version = "vanilla",
+        label_token_lengths=None,
 ):
     '''
     ind_to_class: {0: "__background__", 1 : "person" ...}
     target:
 
     restricted_negative_list : for datasets with restricted negatives, sample only the negatives
+    label_token_lengths: {label: token length} from build_label_token_lengths, tokenize the labels if None
 
     Convert object detection data into grounding data format, on the fly.
 
@@ -502,11 +523,7 @@ def convert_object_detection_to_grounding_optimized_for_od(
         negative_max_length = max_seq_length - positive_caption_length
         screened_negative_label_list = []
         for negative_label in negative_label_list:
-            label_text = clean_name(ind_to_class[negative_label]) + ". " # "dog. "
-
-            tokenized = tokenizer.tokenize(label_text)
-            
-            negative_max_length -= len(tokenized)
+            negative_max_length -= _label_token_length(negative_label, ind_to_class, tokenizer, label_token_lengths)
 
             if negative_max_length > 0: 
                 screened_negative_label_list.append(negative_label) # keep this negative
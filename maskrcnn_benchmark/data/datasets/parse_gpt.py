@@ -1,4 +1,7 @@
 import json
+import os
+import os.path as op
+import pickle
 import re
 from copy import deepcopy
 import random
@@ -10,11 +13,67 @@ def clean_string(input_string):
     input_string = re.sub(r"\.$", "", input_string)
     return input_string
 
+def gpt_outputs_of(data):
+    '''
+    noun -> raw GPT output of a caption vocab (noun -> [GPT output, frequency]) or of a description file
+    (list of {"object": noun, "gpt3_output": GPT output})
+    '''
+    if isinstance(data, dict):
+        return {noun: info[0] for noun, info in data.items()}
+    return {i["object"]: i["gpt3_output"] for i in data}
+
+
+def description_index_file(source_file, version):
+    return "{}.{}.parsed.pkl".format(op.splitext(source_file)[0], version)
+
+
+def _source_signature(source_file):
+    stat = os.stat(source_file)
+    return (op.abspath(source_file), stat.st_size, int(stat.st_mtime))
+
+
+def build_description_index(source_file, version, gpt_outputs=None):
+    '''
+    Parses all the GPT outputs of source_file (a caption vocab or description file) with GPTOutputParser(version).
+    The outputs the parser fails on are left out, they are parsed (and fail) again when used.
+    '''
+    if gpt_outputs is None:
+        with open(source_file, "r") as f:
+            gpt_outputs = gpt_outputs_of(json.load(f))
+    parser = GPTOutputParser(version)
+    parsed = {}
+    for noun, gpt_output in gpt_outputs.items():
+        try:
+            parsed[noun] = parser(gpt_output)
+        except Exception:
+            pass
+    return {"source": _source_signature(source_file), "version": version, "parsed": parsed}
+
+
+def load_description_index(source_file, version, gpt_outputs=None):
+    '''
+    noun -> parsed description of the GPT outputs of source_file, read from description_index_file(source_file,
+    version) if it was built from the same file (tools/build_description_index.py), parsed now otherwise.
+    Built once in the main process, it is shared with the forked dataloader workers; it must not be modified.
+    '''
+    index_file = description_index_file(source_file, version)
+    if op.isfile(index_file):
+        with open(index_file, "rb") as f:
+            index = pickle.load(f)
+        if index["source"] == _source_signature(source_file) and index["version"] == version:
+            return index["parsed"]
+        print("{} is outdated, parsing {}".format(index_file, source_file))
+    return build_description_index(source_file, version, gpt_outputs)["parsed"]
+
+
 class GPTOutputParser():
     def __init__(self, version):
         self.version = version
 
     def __call__(self, description):
+        if isinstance(description, dict):
+            # already parsed (see load_description_index)
+            return description
         if self.version == "v1":
             try:
                 description = json.loads(description.strip("\n"))
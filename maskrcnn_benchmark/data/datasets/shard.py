@@ -0,0 +1,117 @@
+"""
+Binary shards, a drop-in replacement for the TSV files read by TSVDataset.
+
+A shard holds the rows of one TSV file:
+    <name>.shard      MAGIC, then for each row the utf-8 key followed by the value bytes
+    <name>.shard.idx  int64 array of shape (num_rows, 3): offset, key length, value length
+
+Image shards (MAGIC_BINARY) store the encoded image (e.g. JPEG) as is instead of base64 text, which
+saves a third of the I/O and the base64 decoding in the dataloader workers. Text shards (MAGIC_TEXT) store the
+remaining columns of the row, e.g. the json annotations of a label TSV.
+Shards are written by tools/convert_tsv_to_shard.py.
+"""
+import mmap
+import os
+
+import numpy as np
+
+MAGIC_TEXT = b"SHRDTXT1"
+MAGIC_BINARY = b"SHRDBIN1"
+
+
+def shard_index_file(shard_file):
+    return shard_file + ".idx"
+
+
+class ShardWriter(object):
+    def __init__(self, shard_file, binary):
+        self.shard_file = shard_file
+        self.binary = binary
+        self._fp = open(shard_file + ".tmp", "wb")
+        self._fp.write(MAGIC_BINARY if binary else MAGIC_TEXT)
+        self._index = []
+
+    def write(self, key, value):
+        """value: bytes for binary shards, str (the columns after the key, tab separated) for text shards"""
+        key = key.encode("utf-8")
+        if not self.binary:
+            value = value.encode("utf-8")
+        self._index.append((self._fp.tell(), len(key), len(value)))
+        self._fp.write(key)
+        self._fp.write(value)
+
+    def close(self):
+        self._fp.close()
+        index = np.array(self._index, dtype="<i8").reshape(-1, 3)
+        with open(shard_index_file(self.shard_file) + ".tmp", "wb") as fp:
+            index.tofile(fp)
+        os.rename(shard_index_file(self.shard_file) + ".tmp", shard_index_file(self.shard_file))
+        os.rename(self.shard_file + ".tmp", self.shard_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardFile(object):
+    """
+    Same interface as TSVFile. seek returns [key, column, ...] for text shards and [key, memoryview]
+    for image shards.
+    """
+
+    def __init__(self, shard_file):
+        self.shard_file = shard_file
+        self._mm = None
+        self._index = None
+
+    def __str__(self):
+        return "ShardFile(shard_file='{}')".format(self.shard_file)
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def binary(self):
+        self._ensure_opened()
+        return self._mm[: len(MAGIC_BINARY)] == MAGIC_BINARY
+
+    def num_rows(self):
+        self._ensure_opened()
+        return len(self._index)
+
+    def seek_value_bytes(self, idx):
+        self._ensure_opened()
+        offset, key_len, value_len = (int(v) for v in self._index[idx])
+        return memoryview(self._mm)[offset + key_len : offset + key_len + value_len]
+
+    def seek_first_column(self, idx):
+        self._ensure_opened()
+        offset, key_len, _ = (int(v) for v in self._index[idx])
+        return self._mm[offset : offset + key_len].decode("utf-8")
+
+    def seek(self, idx):
+        key = self.seek_first_column(idx)
+        value = self.seek_value_bytes(idx)
+        if self.binary:
+            return [key, value]
+        return [key] + value.tobytes().decode("utf-8").split("\t")
+
+    def get_key(self, idx):
+        return self.seek_first_column(idx)
+
+    def __getitem__(self, index):
+        return self.seek(index)
+
+    def __len__(self):
+        return self.num_rows()
+
+    def _ensure_opened(self):
+        # read-only mappings can be shared by forked dataloader workers as is
+        if self._mm is None:
+            with open(self.shard_file, "rb") as fp:
+                self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            magic = self._mm[: len(MAGIC_TEXT)]
+            assert magic in (MAGIC_TEXT, MAGIC_BINARY), "{} is not a shard file".format(self.shard_file)
+            self._index = np.fromfile(shard_index_file(self.shard_file), dtype="<i8").reshape(-1, 3)
@@ -8,10 +8,13 @@ import yaml
 import errno
 import io
 import math
+import mmap
+import numpy as np
 from PIL import Image, ImageDraw
 
 from maskrcnn_benchmark.structures.bounding_box import BoxList
 from .box_label_loader import LabelLoader
+from .shard import ShardFile
 
 
 def load_linelist_file(linelist_file):
@@ -31,6 +34,14 @@ def img_from_base64(imagestring):
         return None
 
 
+def img_from_bytes(imagebytes):
+    try:
+        img = Image.open(io.BytesIO(imagebytes))
+        return img.convert("RGB")
+    except ValueError:
+        return None
+
+
 def load_from_yaml_file(yaml_file):
     with open(yaml_file, "r") as fp:
         return yaml.load(fp, Loader=yaml.CLoader)
@@ -71,6 +82,55 @@ def create_lineidx(filein, idxout):
     os.rename(idxout_tmp, idxout)
 
 
+def create_lineidx_8b(filein, idxout, chunk_size=64 << 20):
+    """
+    Binary version of create_lineidx: the offsets of the rows as little-endian int64.
+    The file is scanned in chunks of chunk_size bytes instead of one readline per row.
+    """
+    idxout_tmp = idxout + ".tmp"
+    with open(filein, "rb") as tsvin, open(idxout_tmp, "wb") as idx:
+        fsize = os.fstat(tsvin.fileno()).st_size
+        if fsize > 0:
+            np.zeros(1, dtype="<i8").tofile(idx)
+        base = 0
+        while True:
+            chunk = tsvin.read(chunk_size)
+            if not chunk:
+                break
+            starts = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n")) + (base + 1)
+            # a row starts after every newline, except after the last byte of the file
+            starts[starts < fsize].astype("<i8").tofile(idx)
+            base += len(chunk)
+    os.rename(idxout_tmp, idxout)
+
+
+def caption_index_file(label_file):
+    return op.splitext(label_file)[0] + ".caption.tsv"
+
+
+def create_caption_index(label_file, caption_file=None):
+    """
+    Writes the caption side file of a caption label TSV (caption_index_file(label_file) by default): one row per
+    label row with only its json-encoded caption (null if it has none), plus its .lineidx.8b, so that the captions
+    can be read through MMapTSVFile without parsing the annotations or decoding the images.
+    Returns the number of rows.
+    """
+    if caption_file is None:
+        caption_file = caption_index_file(label_file)
+    caption_file_tmp = caption_file + ".tmp"
+    num_rows = 0
+    with open(label_file, "r") as tsvin, open(caption_file_tmp, "w") as tsvout:
+        for line in tsvin:
+            annotations = json.loads(line.split("\t")[1])
+            caption = annotations.get("caption") if isinstance(annotations, dict) else None
+            # json escapes the tabs and newlines, so each caption stays on one row and in one column
+            tsvout.write(json.dumps(caption) + "\n")
+            num_rows += 1
+    os.rename(caption_file_tmp, caption_file)
+    create_lineidx_8b(caption_file, op.splitext(caption_file)[0] + ".lineidx.8b")
+    return num_rows
+
+
 def read_to_character(fp, c):
     result = []
     while True:
@@ -155,6 +215,94 @@ class TSVFile(object):
             self.pid = os.getpid()
 
 
+class MMapTSVFile(object):
+    """
+    TSVFile backed by mmap. The row offsets are read from a binary .lineidx.8b file (int64,
+    see create_lineidx_8b) that is memory-mapped as well, so the index is shared through the page cache
+    by all the dataloader workers instead of being loaded as a list of python ints in each of them.
+    The file has the same interface as TSVFile, plus seek_bytes / seek_last_column_bytes which return
+    memoryviews into the mapped file without copying the row.
+    """
+
+    def __init__(self, tsv_file, generate_lineidx=False):
+        self.tsv_file = tsv_file
+        self.lineidx = op.splitext(tsv_file)[0] + ".lineidx.8b"
+        self._mm = None
+        self._lineidx = None
+        if not op.isfile(self.lineidx) and generate_lineidx:
+            create_lineidx_8b(self.tsv_file, self.lineidx)
+
+    def __str__(self):
+        return "MMapTSVFile(tsv_file='{}')".format(self.tsv_file)
+
+    def __repr__(self):
+        return str(self)
+
+    def num_rows(self):
+        self._ensure_lineidx_loaded()
+        return len(self._lineidx)
+
+    def _row_range(self, idx):
+        self._ensure_tsv_opened()
+        self._ensure_lineidx_loaded()
+        if idx < 0:
+            idx += len(self._lineidx)
+        beg = int(self._lineidx[idx])
+        end = int(self._lineidx[idx + 1]) if idx + 1 < len(self._lineidx) else len(self._mm)
+        # drop the line terminator, as readline().split() + strip() does in TSVFile
+        while end > beg and self._mm[end - 1] in b"\r\n":
+            end -= 1
+        return beg, end
+
+    def seek_bytes(self, idx):
+        beg, end = self._row_range(idx)
+        return memoryview(self._mm)[beg:end]
+
+    def seek_last_column_bytes(self, idx):
+        beg, end = self._row_range(idx)
+        sep = self._mm.rfind(b"\t", beg, end)
+        return memoryview(self._mm)[sep + 1 : end]
+
+    def seek(self, idx):
+        return [s.strip() for s in self.seek_bytes(idx).tobytes().decode("utf-8").split("\t")]
+
+    def seek_first_column(self, idx):
+        beg, end = self._row_range(idx)
+        sep = self._mm.find(b"\t", beg, end)
+        return self._mm[beg : sep if sep >= 0 else end].decode("utf-8")
+
+    def get_key(self, idx):
+        return self.seek_first_column(idx)
+
+    def __getitem__(self, index):
+        return self.seek(index)
+
+    def __len__(self):
+        return self.num_rows()
+
+    def _ensure_lineidx_loaded(self):
+        if self._lineidx is None:
+            self._lineidx = np.memmap(self.lineidx, dtype="<i8", mode="r") if op.getsize(self.lineidx) else []
+
+    def _ensure_tsv_opened(self):
+        # unlike a file object, the read-only mapping can be inherited by forked workers as is
+        if self._mm is None:
+            with open(self.tsv_file, "rb") as fp:
+                self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def open_tsv_file(tsv_file, generate_lineidx=False):
+    """
+    ShardFile for .shard files (see shard.py), MMapTSVFile if the binary .lineidx.8b of tsv_file exists,
+    TSVFile otherwise.
+    """
+    if tsv_file.endswith(".shard"):
+        return ShardFile(tsv_file)
+    if op.isfile(op.splitext(tsv_file)[0] + ".lineidx.8b"):
+        return MMapTSVFile(tsv_file)
+    return TSVFile(tsv_file, generate_lineidx=generate_lineidx)
+
+
 class CompositeTSVFile:
     def __init__(self, file_list, seq_file, root="."):
         if isinstance(file_list, str):
@@ -224,9 +372,9 @@ class TSVDataset(object):
         self.hw_file = hw_file
         self.linelist_file = linelist_file
 
-        self.img_tsv = TSVFile(img_file)
-        self.label_tsv = None if label_file is None else TSVFile(label_file, generate_lineidx=True)
-        self.hw_tsv = None if hw_file is None else TSVFile(hw_file)
+        self.img_tsv = open_tsv_file(img_file)
+        self.label_tsv = None if label_file is None else open_tsv_file(label_file, generate_lineidx=True)
+        self.hw_tsv = None if hw_file is None else open_tsv_file(hw_file)
         self.line_list = load_linelist_file(linelist_file)
         self.imageid2idx = None
         if imageid2idx_file is not None:
@@ -269,6 +417,11 @@ class TSVDataset(object):
             annotations = json.loads(row[1])
             imageid = annotations["img_id"]
             line_no = self.imageid2idx[imageid]
+        if isinstance(self.img_tsv, ShardFile):
+            return img_from_bytes(self.img_tsv.seek_value_bytes(line_no))
+        if isinstance(self.img_tsv, MMapTSVFile):
+            # decode straight from the mapped file, without splitting the row into strings
+            return img_from_base64(self.img_tsv.seek_last_column_bytes(line_no))
         row = self.img_tsv.seek(line_no)
         # use -1 to support old format with multiple columns.
         img = img_from_base64(row[-1])
@@ -0,0 +1,110 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+"""
+(height, width) of every image of a dataset, as given by dataset.get_img_info, cached in a .npy file so that the
+aspect ratio grouping does not have to call get_img_info (a TSV seek and a json.loads each) for millions of images
+at every start. The file name is a hash of the cache version, the dataset class and length, and the path, size and
+modification time of its source files (TSV / yaml / annotation files): any change of the data gives a new file.
+ConcatDatasets are cached per dataset.
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import os.path as op
+
+import numpy as np
+
+from maskrcnn_benchmark.utils.comm import get_world_size, is_main_process, synchronize
+
+IMAGE_SIZE_CACHE_VERSION = 1
+
+# attributes of the datasets which point to the files their image sizes are read from
+_SOURCE_FILE_ATTRIBUTES = ("yaml_file", "ann_file", "img_file", "label_file", "hw_file", "linelist_file")
+
+# dataset of the forked workers of compute_image_sizes
+_dataset = None
+
+
+def _source_files(dataset):
+    files = []
+    for attribute in _SOURCE_FILE_ATTRIBUTES:
+        path = getattr(dataset, attribute, None)
+        if isinstance(path, str) and op.isfile(path):
+            files.append(path)
+    return files
+
+
+def image_size_cache_file(dataset, cache_dir):
+    """
+    Path of the cache of dataset in cache_dir, or None if the dataset has no known source file to key it on.
+    """
+    files = _source_files(dataset)
+    if not files:
+        return None
+    key = [str(IMAGE_SIZE_CACHE_VERSION), type(dataset).__name__, str(len(dataset))]
+    for path in files:
+        stat = os.stat(path)
+        key.append("{}:{}:{}".format(op.abspath(path), stat.st_size, int(stat.st_mtime)))
+    digest = hashlib.sha1("\n".join(key).encode("utf-8")).hexdigest()[:16]
+    return op.join(cache_dir, "{}_{}.v{}.npy".format(type(dataset).__name__, digest, IMAGE_SIZE_CACHE_VERSION))
+
+
+def _image_sizes_of_range(index_range):
+    sizes = np.zeros((len(index_range), 2), dtype=np.int32)
+    for k, i in enumerate(index_range):
+        img_info = _dataset.get_img_info(i)
+        sizes[k] = (int(img_info["height"]), int(img_info["width"]))
+    return sizes
+
+
+def compute_image_sizes(dataset, num_workers=0, chunk_size=10000):
+    """
+    (len(dataset), 2) int32 array of the (height, width) of the images, with num_workers forked processes.
+    """
+    global _dataset
+    _dataset = dataset
+    try:
+        chunks = [range(i, min(i + chunk_size, len(dataset))) for i in range(0, len(dataset), chunk_size)]
+        if num_workers > 1 and len(chunks) > 1:
+            with multiprocessing.get_context("fork").Pool(num_workers) as pool:
+                sizes = pool.map(_image_sizes_of_range, chunks)
+        else:
+            sizes = [_image_sizes_of_range(chunk) for chunk in chunks]
+    finally:
+        _dataset = None
+    return np.concatenate(sizes) if sizes else np.zeros((0, 2), dtype=np.int32)
+
+
+def _save(sizes, cache_file):
+    os.makedirs(op.dirname(cache_file) or ".", exist_ok=True)
+    cache_file_tmp = cache_file + ".{}.tmp".format(os.getpid())
+    with open(cache_file_tmp, "wb") as fp:
+        np.save(fp, sizes)
+    os.rename(cache_file_tmp, cache_file)
+
+
+def _load_image_sizes(dataset, cache_dir, num_workers):
+    cache_file = image_size_cache_file(dataset, cache_dir)
+    if cache_file is None:
+        return compute_image_sizes(dataset, num_workers)
+    # the main process fills the cache, the others wait for it (or compute the sizes if the cache dir is not shared)
+    if is_main_process() and not op.isfile(cache_file):
+        logging.getLogger("maskrcnn_benchmark.data").info("Computing the image sizes of {}".format(cache_file))
+        _save(compute_image_sizes(dataset, num_workers), cache_file)
+    if get_world_size() > 1:
+        synchronize()
+    if not op.isfile(cache_file):
+        _save(compute_image_sizes(dataset, num_workers), cache_file)
+    sizes = np.load(cache_file, mmap_mode="r")
+    assert len(sizes) == len(dataset), "{} does not match the dataset".format(cache_file)
+    return sizes
+
+
+def load_image_sizes(dataset, cache_dir, num_workers=0):
+    """
+    (len(dataset), 2) array of the (height, width) of the images, read from (or first written to) the caches in
+    cache_dir. The arrays of the datasets with a cache file are memory-mapped.
+    """
+    if hasattr(dataset, "datasets") and hasattr(dataset, "cumulative_sizes"):
+        return np.concatenate([load_image_sizes(d, cache_dir, num_workers) for d in dataset.datasets])
+    return _load_image_sizes(dataset, cache_dir, num_workers)
@@ -0,0 +1,111 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+import queue
+import threading
+
+import torch
+
+from maskrcnn_benchmark.structures.bounding_box import BoxList
+from maskrcnn_benchmark.structures.image_list import ImageList
+
+
+def _apply(obj, fn):
+    """
+    Applies fn to every tensor of a training batch: ImageList, BoxList (bbox and extra fields),
+    dicts (tokenized captions, span_split), lists and tuples. Other objects are returned as they are.
+    """
+    if isinstance(obj, torch.Tensor):
+        return fn(obj)
+    if isinstance(obj, ImageList):
+        return ImageList(fn(obj.tensors), obj.image_sizes)
+    if isinstance(obj, BoxList):
+        boxlist = BoxList(fn(obj.bbox), obj.size, obj.mode)
+        for k, v in obj.extra_fields.items():
+            boxlist.add_field(k, _apply(v, fn))
+        return boxlist
+    if isinstance(obj, dict):
+        return type(obj)((k, _apply(v, fn)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_apply(v, fn) for v in obj)
+    return obj
+
+
+class DataPrefetcher(object):
+    """
+    Wraps the training data loader: a background thread takes the next batches from it, pins them and copies
+    them to the device (on a side CUDA stream) while the current training step runs. The batches are yielded
+    unchanged, with their tensors already on the device.
+    """
+
+    def __init__(self, data_loader, device, depth=1):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.use_cuda = self.device.type == "cuda" and torch.cuda.is_available()
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._load, args=(iter(self.data_loader),), daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                batch, event, tensors = item
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    # the tensors were allocated on the copy stream but are used on this one
+                    for tensor in tensors:
+                        tensor.record_stream(stream)
+                yield batch
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        # unblock the loading thread if it is waiting for a free slot
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _load(self, iterator):
+        stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        try:
+            for batch in iterator:
+                tensors = []
+
+                def to_device(tensor):
+                    if stream is not None and not tensor.is_cuda:
+                        tensor = tensor.pin_memory()
+                    tensor = tensor.to(self.device, non_blocking=True)
+                    tensors.append(tensor)
+                    return tensor
+
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = _apply(batch, to_device)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = _apply(batch, to_device)
+                if not self._put((batch, event, tensors)):
+                    return
+            self._put(None)
+        except BaseException as e:
+            self._put(e)
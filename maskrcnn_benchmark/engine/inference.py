@@ -20,6 +20,7 @@ from maskrcnn_benchmark.data.datasets.evaluation.flickr.flickr_eval import Flick
 
 from maskrcnn_benchmark.data.datasets.refexp import RefExpEvaluator
 from maskrcnn_benchmark.structures.bounding_box import BoxList
+from maskrcnn_benchmark.structures.image_list import ImageList
 import matplotlib.pyplot as plt
 import matplotlib.pylab as pylab
 from maskrcnn_benchmark.data.datasets.tsv import load_from_yaml_file
@@ -36,6 +37,7 @@ import cv2, json
 from maskrcnn_benchmark.structures.boxlist_ops import cat_boxlist
 from maskrcnn_benchmark.data.datasets.od_to_grounding import clean_name
 from maskrcnn_benchmark.data.datasets._od_to_description import DescriptionConverter
+from maskrcnn_benchmark.utils.token_offsets import build_positive_dict
 
 from copy import deepcopy
 from pprint import pprint
@@ -145,38 +147,8 @@ def create_one_hot_dict(labels, no_minus_one_for_one_hot=False):
 
 def create_positive_dict(tokenized, tokens_positive, labels):
     """construct a dictionary such that positive_map[i] = j, iff token i is mapped to j label"""
-    positive_map = defaultdict(int)
-
     # Additionally, have positive_map_label_to_tokens
-    positive_map_label_to_token = defaultdict(list)
-
-    for j, tok_list in enumerate(tokens_positive):
-        for (beg, end) in tok_list:
-            beg_pos = tokenized.char_to_token(beg)
-            end_pos = tokenized.char_to_token(end - 1)
-            if beg_pos is None:
-                try:
-                    beg_pos = tokenized.char_to_token(beg + 1)
-                    if beg_pos is None:
-                        beg_pos = tokenized.char_to_token(beg + 2)
-                except:
-                    beg_pos = None
-            if end_pos is None:
-                try:
-                    end_pos = tokenized.char_to_token(end - 2)
-                    if end_pos is None:
-                        end_pos = tokenized.char_to_token(end - 3)
-                except:
-                    end_pos = None
-            if beg_pos is None or end_pos is None:
-                continue
-
-            assert beg_pos is not None and end_pos is not None
-            for i in range(beg_pos, end_pos + 1):
-                positive_map[i] = labels[j]  # because the labels starts from 1
-                positive_map_label_to_token[labels[j]].append(i)
-            # positive_map[j, beg_pos : end_pos + 1].fill_(1)
-    return positive_map, positive_map_label_to_token  # / (positive_map.sum(-1)[:, None] + 1e-6)
+    return build_positive_dict(tokenized, tokens_positive, labels)
 
 
 def chunks(lst, n):
@@ -538,10 +510,10 @@ def build_refexp_evaluator(dataset):
     return evaluator
 
 
-def build_lvis_evaluator(ann_file, topk, fixed_ap=True):
+def build_lvis_evaluator(ann_file, topk, fixed_ap=True, eval_engine="loop", num_workers=0):
     from maskrcnn_benchmark.data.datasets.evaluation.lvis.lvis import LVIS
     from maskrcnn_benchmark.data.datasets.evaluation.lvis.lvis_eval import LvisEvaluatorFixedAP, LvisEvaluator
-    evaluator = LvisEvaluatorFixedAP(LVIS(ann_file), topk = topk, fixed_ap=fixed_ap) # topk
+    evaluator = LvisEvaluatorFixedAP(LVIS(ann_file), topk = topk, fixed_ap=fixed_ap, eval_engine=eval_engine, num_workers=num_workers) # topk
     #evaluator = LvisEvaluator(LVIS(ann_file), iou_types=['segm', 'bbox'])
     return evaluator
 
@@ -596,6 +568,23 @@ def write_refexp_results(results, output_file_name):
     return
 
 
+def run_query_chunks_batched(model, images, captions, positive_maps, visual_features=None):
+    """
+    Run several query chunks of one image in a single forward pass: the image (or its backbone features)
+    is tiled along the batch dimension and paired with one caption / positive_map per chunk.
+    Returns one BoxList per chunk, in the order of captions.
+    """
+    num_chunks = len(captions)
+    assert len(images.image_sizes) == 1, "Batched chunk inference only supports one image per GPU!"
+    model_without_ddp = model.module if hasattr(model, "module") else model
+    if visual_features is None and model_without_ddp.supports_visual_feature_reuse():
+        visual_features = model_without_ddp.extract_visual_features(images)
+    if visual_features is not None:
+        visual_features = tuple(f.expand(num_chunks, -1, -1, -1).contiguous() for f in visual_features)
+    images = ImageList(images.tensors.expand(num_chunks, -1, -1, -1), images.image_sizes * num_chunks)
+    return model(images, captions=captions, positive_map=list(positive_maps), visual_features=visual_features)
+
+
 def inference(
     model,
     data_loader,
@@ -666,7 +655,13 @@ def inference(
     if "flickr" in cfg.DATASETS.TEST[0]:
         evaluator = build_flickr_evaluator(cfg)
     elif "lvis" in cfg.DATASETS.TEST[0]:
-        evaluator = build_lvis_evaluator(dataset.ann_file, topk=cfg.DATASETS.LVIS_TOPK, fixed_ap=not cfg.DATASETS.LVIS_USE_NORMAL_AP)
+        evaluator = build_lvis_evaluator(
+            dataset.ann_file,
+            topk=cfg.DATASETS.LVIS_TOPK,
+            fixed_ap=not cfg.DATASETS.LVIS_USE_NORMAL_AP,
+            eval_engine=cfg.DATASETS.LVIS_EVAL_ENGINE,
+            num_workers=cfg.DATASETS.LVIS_EVAL_NUM_WORKERS,
+        )
     elif "refcoco" in cfg.DATASETS.TEST[0]:
         evaluator = build_refexp_evaluator(dataset)
     else:
@@ -695,6 +690,28 @@ def inference(
         pass
 
 
+    # the backbone + FPN only depend on the image, so compute them once for all the query chunks
+    model_without_ddp = model.module if hasattr(model, "module") else model
+    reuse_visual_features = (
+        cfg.TEST.REUSE_VISUAL_FEATURES
+        and task == "detection"
+        and not cfg.TEST.USE_MULTISCALE
+        and model_without_ddp.supports_visual_feature_reuse()
+    )
+    # several query chunks per forward pass; the ATSS post-processor splits the outputs back per chunk.
+    # The chunks of one image are tiled along the batch, so this needs one image per GPU
+    chunks_per_batch = 1
+    if (
+        cfg.TEST.CHUNKS_PER_BATCH > 1
+        and cfg.TEST.IMS_PER_BATCH // num_devices == 1
+        and task == "detection"
+        and not cfg.TEST.USE_MULTISCALE
+        and cfg.TEST.CHUNK_INFERENCE_VERSION != "v2"
+        and cfg.MODEL.DYHEAD.FUSE_CONFIG.SPAN_VERSION is None
+        and not model_without_ddp.roi_heads
+    ):
+        chunks_per_batch = cfg.TEST.CHUNKS_PER_BATCH
+
     try:
         categories = dataset.categories()
         raw_categories = dataset.lvis.dataset["categories"]
@@ -732,6 +749,7 @@ def inference(
             else:
                 images = images.to(device)
                 query_time = len(all_queries)
+                visual_features = model_without_ddp.extract_visual_features(images) if reuse_visual_features else None
 
                 output_for_one_image = []
                 for query_i in range(query_time):
@@ -769,7 +787,19 @@ def inference(
                         )
                         span_map = None
                         spans = None
-                    output = model(images, captions=captions, positive_map=positive_map_label_to_token, spans = spans, span_map=span_map)
+                    if chunks_per_batch > 1:
+                        if query_i % chunks_per_batch == 0:
+                            chunk_indices = range(query_i, min(query_i + chunks_per_batch, query_time))
+                            batched_output = run_query_chunks_batched(
+                                model,
+                                images,
+                                [all_queries[j] for j in chunk_indices],
+                                [all_positive_map_label_to_token[j] for j in chunk_indices],
+                                visual_features=visual_features,
+                            )
+                        output = [batched_output[query_i % chunks_per_batch]]
+                    else:
+                        output = model(images, captions=captions, positive_map=positive_map_label_to_token, spans = spans, span_map=span_map, visual_features=visual_features)
                     if cfg.TEST.CHUNK_INFERENCE_VERSION == "v2":
                         assert(len(output) == 1)
                         output_for_one_image.append(output[0])
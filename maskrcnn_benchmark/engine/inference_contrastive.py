@@ -36,6 +36,7 @@ import cv2, json
 from maskrcnn_benchmark.structures.boxlist_ops import cat_boxlist
 from maskrcnn_benchmark.data.datasets.od_to_grounding import clean_name
 from maskrcnn_benchmark.data.datasets._od_to_description import DescriptionConverter
+from maskrcnn_benchmark.utils.token_offsets import build_positive_dict
 
 from copy import deepcopy
 from pprint import pprint
@@ -145,38 +146,8 @@ def create_one_hot_dict(labels, no_minus_one_for_one_hot=False):
 
 def create_positive_dict(tokenized, tokens_positive, labels):
     """construct a dictionary such that positive_map[i] = j, iff token i is mapped to j label"""
-    positive_map = defaultdict(int)
-
     # Additionally, have positive_map_label_to_tokens
-    positive_map_label_to_token = defaultdict(list)
-
-    for j, tok_list in enumerate(tokens_positive):
-        for (beg, end) in tok_list:
-            beg_pos = tokenized.char_to_token(beg)
-            end_pos = tokenized.char_to_token(end - 1)
-            if beg_pos is None:
-                try:
-                    beg_pos = tokenized.char_to_token(beg + 1)
-                    if beg_pos is None:
-                        beg_pos = tokenized.char_to_token(beg + 2)
-                except:
-                    beg_pos = None
-            if end_pos is None:
-                try:
-                    end_pos = tokenized.char_to_token(end - 2)
-                    if end_pos is None:
-                        end_pos = tokenized.char_to_token(end - 3)
-                except:
-                    end_pos = None
-            if beg_pos is None or end_pos is None:
-                continue
-
-            assert beg_pos is not None and end_pos is not None
-            for i in range(beg_pos, end_pos + 1):
-                positive_map[i] = labels[j]  # because the labels starts from 1
-                positive_map_label_to_token[labels[j]].append(i)
-            # positive_map[j, beg_pos : end_pos + 1].fill_(1)
-    return positive_map, positive_map_label_to_token  # / (positive_map.sum(-1)[:, None] + 1e-6)
+    return build_positive_dict(tokenized, tokens_positive, labels)
 
 
 def chunks(lst, n):
@@ -539,10 +510,10 @@ def build_refexp_evaluator(dataset):
     return evaluator
 
 
-def build_lvis_evaluator(ann_file, topk, fixed_ap=True):
+def build_lvis_evaluator(ann_file, topk, fixed_ap=True, eval_engine="loop", num_workers=0):
     from maskrcnn_benchmark.data.datasets.evaluation.lvis.lvis import LVIS
     from maskrcnn_benchmark.data.datasets.evaluation.lvis.lvis_eval import LvisEvaluatorFixedAP, LvisEvaluator
-    evaluator = LvisEvaluatorFixedAP(LVIS(ann_file), topk = topk, fixed_ap=fixed_ap) # topk
+    evaluator = LvisEvaluatorFixedAP(LVIS(ann_file), topk = topk, fixed_ap=fixed_ap, eval_engine=eval_engine, num_workers=num_workers) # topk
     #evaluator = LvisEvaluator(LVIS(ann_file), iou_types=['segm', 'bbox'])
     return evaluator
 
@@ -667,7 +638,13 @@ def inference(
     if "flickr" in cfg.DATASETS.TEST[0]:
         evaluator = build_flickr_evaluator(cfg)
     elif "lvis" in cfg.DATASETS.TEST[0]:
-        evaluator = build_lvis_evaluator(dataset.ann_file, topk=cfg.DATASETS.LVIS_TOPK, fixed_ap=not cfg.DATASETS.LVIS_USE_NORMAL_AP)
+        evaluator = build_lvis_evaluator(
+            dataset.ann_file,
+            topk=cfg.DATASETS.LVIS_TOPK,
+            fixed_ap=not cfg.DATASETS.LVIS_USE_NORMAL_AP,
+            eval_engine=cfg.DATASETS.LVIS_EVAL_ENGINE,
+            num_workers=cfg.DATASETS.LVIS_EVAL_NUM_WORKERS,
+        )
     elif "refcoco" in cfg.DATASETS.TEST[0]:
         evaluator = build_refexp_evaluator(dataset)
     else:
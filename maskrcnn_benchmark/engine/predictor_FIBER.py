@@ -16,6 +16,7 @@ from maskrcnn_benchmark.structures.bounding_box import BoxList
 from maskrcnn_benchmark import layers as L
 from maskrcnn_benchmark.modeling.roi_heads.mask_head.inference import Masker
 from maskrcnn_benchmark.utils import cv2_util
+from maskrcnn_benchmark.utils.token_offsets import build_positive_map
 
 engine = inflect.engine()
 nltk.download("punkt")
@@ -342,37 +343,7 @@ def create_positive_map_label_to_token_from_positive_map(positive_map, plus=0):
 
 def create_positive_map(tokenized, tokens_positive):
     """construct a map such that positive_map[i,j] = True iff box i is associated to token j"""
-    positive_map = torch.zeros((len(tokens_positive), 256), dtype=torch.float)
-
-    for j, tok_list in enumerate(tokens_positive):
-        for (beg, end) in tok_list:
-            try:
-                beg_pos = tokenized.char_to_token(beg)
-                end_pos = tokenized.char_to_token(end - 1)
-            except Exception as e:
-                print("beg:", beg, "end:", end)
-                print("token_positive:", tokens_positive)
-                # print("beg_pos:", beg_pos, "end_pos:", end_pos)
-                raise e
-            if beg_pos is None:
-                try:
-                    beg_pos = tokenized.char_to_token(beg + 1)
-                    if beg_pos is None:
-                        beg_pos = tokenized.char_to_token(beg + 2)
-                except:
-                    beg_pos = None
-            if end_pos is None:
-                try:
-                    end_pos = tokenized.char_to_token(end - 2)
-                    if end_pos is None:
-                        end_pos = tokenized.char_to_token(end - 3)
-                except:
-                    end_pos = None
-            if beg_pos is None or end_pos is None:
-                continue
-
-            assert beg_pos is not None and end_pos is not None
-            positive_map[j, beg_pos : end_pos + 1].fill_(1)
+    positive_map = build_positive_map(tokenized, tokens_positive)
     return positive_map / (positive_map.sum(-1)[:, None] + 1e-6)
 
 
@@ -13,6 +13,7 @@ from maskrcnn_benchmark.utils.comm import get_world_size, all_gather, is_main_pr
 from maskrcnn_benchmark.utils.metric_logger import MetricLogger
 from maskrcnn_benchmark.utils.ema import ModelEma
 from maskrcnn_benchmark.utils.amp import autocast, GradScaler
+from maskrcnn_benchmark.data.prefetcher import DataPrefetcher
 from maskrcnn_benchmark.data.datasets.evaluation import evaluate
 from .inference import inference
 from .tsv_saver import TSVResultWriter
@@ -45,6 +46,74 @@ def reduce_loss_dict(loss_dict):
     return reduced_losses
 
 
+def mask_invalid_loss(losses, max_loss=None):
+    """
+    Zeroes the loss on the device if it is NaN / inf (or larger than max_loss), without a host sync.
+    Returns the masked loss and a 0-dim bool tensor telling whether it was masked.
+    """
+    invalid = ~torch.isfinite(losses)
+    if max_loss is not None:
+        invalid = invalid | (losses > max_loss)
+    return torch.where(invalid, torch.zeros_like(losses), losses), invalid
+
+
+def mask_invalid_grads(parameters, skipped):
+    """
+    Zeroes the gradients on the device if the loss was masked (skipped, from mask_invalid_loss) on any GPU: zeroing
+    the loss does not zero the NaN / inf gradients of its backward, which the optimizer step would write into the
+    weights. The step of a masked iteration then only applies the momentum and weight decay.
+    """
+    if get_world_size() > 1:
+        # the gradients are all-reduced, so a NaN on one GPU is on all of them
+        skipped = skipped.float()
+        dist.all_reduce(skipped, op=dist.ReduceOp.MAX)
+        skipped = skipped > 0
+    with torch.no_grad():
+        for p in parameters:
+            if p.grad is not None:
+                p.grad.masked_fill_(skipped, 0)
+
+
+class DeferredLossDict(object):
+    """
+    Accumulates the loss terms on the device (SOLVER.LOSS_SYNC_PERIOD > 1). flush() averages them over the
+    iterations whose loss was not masked, reduces them over all GPUs and brings them to the host at once.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.count = 0
+        self.num_skipped = None
+
+    def update(self, loss_dict, skipped):
+        with torch.no_grad():
+            for k, v in loss_dict.items():
+                v = torch.where(skipped, torch.zeros_like(v), v.detach().float())
+                self.sums[k] = self.sums[k] + v if k in self.sums else v
+            skipped = skipped.long()
+            self.num_skipped = skipped if self.num_skipped is None else self.num_skipped + skipped
+            self.count += 1
+
+    def flush(self):
+        """
+        Returns the dict of the averaged loss terms (as floats) and the number of masked iterations, summed over
+        all GPUs (on the main process).
+        """
+        with torch.no_grad():
+            names = sorted(self.sums.keys())
+            num_valid = (self.count - self.num_skipped).clamp(min=1)
+            reduced = reduce_loss_dict({k: self.sums[k] / num_valid for k in names})
+            num_skipped = self.num_skipped.float()
+            if get_world_size() > 1:
+                dist.reduce(num_skipped, dst=0)
+            values = torch.stack([reduced[k] for k in names] + [num_skipped]).tolist()
+        self.reset()
+        return dict(zip(names, values[:-1])), int(values[-1])
+
+
 def do_train(
     cfg,
     model,
@@ -62,6 +131,8 @@ def do_train(
     logger = logging.getLogger("maskrcnn_benchmark.trainer")
     logger.info("Start training")
     # meters = MetricLogger(delimiter="  ")
+    if cfg.DATALOADER.PREFETCH_DEPTH > 0:
+        data_loader = DataPrefetcher(data_loader, device, depth=cfg.DATALOADER.PREFETCH_DEPTH)
     max_iter = len(data_loader)
     start_iter = arguments["iteration"]
     model.train()
@@ -74,6 +145,9 @@ def do_train(
     if cfg.SOLVER.USE_AMP:
         scaler = GradScaler()
 
+    log_period = cfg.SOLVER.LOG_PERIOD
+    deferred_losses = DeferredLossDict() if cfg.SOLVER.LOSS_SYNC_PERIOD > 1 else None
+
     global_rank = get_rank()
 
     if cfg.SOLVER.CHECKPOINT_PER_EPOCH != -1 and cfg.SOLVER.MAX_EPOCH >= 1:
@@ -101,11 +175,15 @@ def do_train(
     
     tsv_visualizer = TSVResultWriter(
         tokenizer=tokenizer, 
-        max_visualize_num=1000, 
-        file_name=cfg.OUTPUT_DIR + "/train_visualize/train.tsv", write_freq=100)
-    for iteration, (images, targets, idxs, positive_map, positive_map_eval, greenlight_map) in enumerate(
+        max_visualize_num=cfg.SOLVER.TRAIN_VISUALIZE_NUM, 
+        file_name=cfg.OUTPUT_DIR + "/train_visualize/train.tsv", write_freq=100,
+        sample_period=cfg.SOLVER.TRAIN_VISUALIZE_PERIOD,
+        queue_size=cfg.SOLVER.TRAIN_VISUALIZE_QUEUE_SIZE)
+    for iteration, (images, targets, idxs, positive_map, positive_map_eval, greenlight_map, *tokenized_captions) in enumerate(
         data_loader, start_iter
     ):
+        # only present if the captions were tokenized by the collator (DATALOADER.PRETOKENIZE)
+        tokenized_captions = tokenized_captions[0] if tokenized_captions else None
 
         nnegative = sum(len(target) < 1 for target in targets)
         nsample = len(targets)
@@ -140,25 +218,36 @@ def do_train(
                     model.fusion_backbone.language_backbone.eval()
                 else:
                     model.language_backbone.eval()
-        if is_main_process(): # only visualize for the main process
+        if is_main_process() and cfg.SOLVER.TRAIN_VISUALIZE_NUM > 0: # only visualize for the main process
            tsv_visualizer.update_train_data(images, targets)
         if cfg.SOLVER.USE_AMP:
             with autocast():
                 if len(captions) > 0:
-                    loss_dict = model(images, targets, captions, positive_map, greenlight_map=greenlight_map)
+                    loss_dict = model(
+                        images,
+                        targets,
+                        captions,
+                        positive_map,
+                        greenlight_map=greenlight_map,
+                        tokenized_captions=tokenized_captions,
+                    )
                 else:
                     loss_dict = model(images, targets)
             losses = sum(loss for loss in loss_dict.values())
 
-            # save checkpoints for further debug if nan happens
-            loss_value = losses.item()
-            if torch.isnan(losses) or torch.isinf(losses):
-                logging.error("NaN encountered, ignoring")
-                losses[losses != losses] = 0
-            # if loss is too large, ignore it
-            if loss_value > 10 and iteration > 10000:
-                losses[losses == losses] = 0 # this is a bad example
-                print("Loss is too large, ignore it, loss: ", loss_value)
+            if deferred_losses is not None:
+                # the masked iterations are reported when the losses are synchronized
+                losses, skipped = mask_invalid_loss(losses, max_loss=10 if iteration > 10000 else None)
+            else:
+                # save checkpoints for further debug if nan happens
+                loss_value = losses.item()
+                if torch.isnan(losses) or torch.isinf(losses):
+                    logging.error("NaN encountered, ignoring")
+                    losses[losses != losses] = 0
+                # if loss is too large, ignore it
+                if loss_value > 10 and iteration > 10000:
+                    losses[losses == losses] = 0 # this is a bad example
+                    print("Loss is too large, ignore it, loss: ", loss_value)
 
             optimizer.zero_grad()
             scaler.scale(losses).backward()
@@ -167,13 +256,17 @@ def do_train(
             scheduler.step()
         else:
             if len(captions) > 0:
-                loss_dict = model(images, targets, captions, positive_map)
+                loss_dict = model(images, targets, captions, positive_map, tokenized_captions=tokenized_captions)
             else:
                 loss_dict = model(images, targets)
             losses = sum(loss for loss in loss_dict.values())
 
-            # save checkpoints for further debug if nan happens
-            loss_value = losses.item()
+            if deferred_losses is not None:
+                losses, skipped = mask_invalid_loss(losses)
+                loss_value = 0.0
+            else:
+                # save checkpoints for further debug if nan happens
+                loss_value = losses.item()
             if not math.isfinite(loss_value):
                 logging.error(f"=> loss is {loss_value}, stopping training")
                 time_str = time.strftime("%Y-%m-%d-%H-%M")
@@ -191,7 +284,7 @@ def do_train(
                 torch.save(dict_to_save, fname)
                 sys.exit(-1)
 
-            if torch.isnan(losses) or torch.isinf(losses):
+            if deferred_losses is None and (torch.isnan(losses) or torch.isinf(losses)):
                 losses[losses != losses] = 0
             # if loss is too large, ignore it
             # if loss_value > 10 and iteration > 10000:
@@ -199,6 +292,8 @@ def do_train(
             #     print("Loss is too large, ignore it, loss: ", loss_value)
             optimizer.zero_grad()
             losses.backward()
+            if deferred_losses is not None:
+                mask_invalid_grads(model.parameters(), skipped)
             optimizer.step()
             scheduler.step()
 
@@ -219,9 +314,21 @@ def do_train(
                 milestone_target += 1
 
         # reduce losses over all GPUs for logging purposes
-        loss_dict_reduced = reduce_loss_dict(loss_dict)
-        losses_reduced = sum(loss for loss in loss_dict_reduced.values())
-        meters.update(loss=losses_reduced, **loss_dict_reduced)
+        if deferred_losses is not None:
+            deferred_losses.update(loss_dict, skipped)
+            sync_losses = (
+                iteration % cfg.SOLVER.LOSS_SYNC_PERIOD == 0 or iteration % log_period == 0 or iteration == max_iter
+            )
+            if sync_losses:
+                loss_dict_reduced, num_skipped = deferred_losses.flush()
+                if num_skipped > 0:
+                    logger.error("NaN or too large loss in {} iterations (summed over the GPUs), ignored".format(num_skipped))
+        else:
+            loss_dict_reduced = reduce_loss_dict(loss_dict)
+            sync_losses = True
+        if sync_losses:
+            losses_reduced = sum(loss for loss in loss_dict_reduced.values())
+            meters.update(loss=losses_reduced, **loss_dict_reduced)
         if model_ema is not None:
             model_ema.update(model)
             arguments["model_ema"] = model_ema.state_dict()
@@ -229,10 +336,13 @@ def do_train(
         batch_time = time.time() - end
         end = time.time()
         meters.update(time=batch_time, data=data_time)
+        if cfg.DATALOADER.PREFETCH_DEPTH > 0:
+            # data is the time waited for the prefetched batch, the rest of the step is compute
+            meters.update(compute=batch_time - data_time)
         eta_seconds = meters.time.global_avg * (max_iter - iteration)
         eta_string = str(datetime.timedelta(seconds=int(eta_seconds)))
 
-        if iteration % 20 == 0 or iteration == max_iter:
+        if iteration % log_period == 0 or iteration == max_iter:
             # if iteration % 1 == 0 or iteration == max_iter:
             # logger.info(
             if global_rank <= 0:
@@ -255,7 +365,7 @@ def do_train(
                         memory=torch.cuda.max_memory_allocated() / 1024.0 / 1024.0,
                     )
                 )
-        if use_wandb and is_main_process():
+        if use_wandb and is_main_process() and sync_losses:
             wandb.log({"train_loss": losses_reduced, "lr": optimizer.param_groups[0]["lr"], "wd": optimizer.param_groups[0]["weight_decay"], **loss_dict_reduced})
         if val_data_loader and (iteration % checkpoint_period == 0 or iteration == max_iter):
             if is_main_process():
@@ -370,6 +480,9 @@ def do_train(
             checkpointer.save("model_final", **arguments)
             break
 
+    tsv_visualizer.close()
+    if tsv_visualizer.num_dropped > 0:
+        logger.info("{} training batches were not visualized, the writer queue was full".format(tsv_visualizer.num_dropped))
     total_training_time = time.time() - start_training_time
     total_time_str = str(datetime.timedelta(seconds=total_training_time))
     logger.info("Total training time: {} ({:.4f} s / it)".format(total_time_str, total_training_time / (max_iter)))
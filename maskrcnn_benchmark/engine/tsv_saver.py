@@ -1,4 +1,7 @@
 import os
+import queue
+import threading
+import logging
 import torch
 from tqdm import tqdm
 from collections import defaultdict
@@ -22,7 +25,15 @@ def ensure_file(file_name):
         ensure_file(os.path.dirname(file_name))
 
 class TSVResultWriter(object):
-    def __init__(self, tokenizer = None, max_visualize_num=-1, dataset_length=-1, threshold = -1.0, in_order = True, write_freq = 100, file_name = None):
+    """
+    Dumps images with their boxes to a TSV file (for the tsv viewer), every write_freq rows, up to max_visualize_num
+    rows. The rows are kept in memory and the file is rewritten at each write, so max_visualize_num <= 0 (no limit)
+    is only meant for a bounded number of updates, such as an evaluation.
+    Only one call of the update methods out of sample_period is kept. If queue_size > 0, the updates (the copy of
+    the images to the host, the jpeg / base64 encoding and the file writes) are done by a background thread, and
+    the updates that find its queue full are dropped instead of waiting.
+    """
+    def __init__(self, tokenizer = None, max_visualize_num=-1, dataset_length=-1, threshold = -1.0, in_order = True, write_freq = 100, file_name = None, sample_period = 1, queue_size = 0):
         self.tokenizer = tokenizer
         self.max_visualize_num = max_visualize_num
         self.dataset_length = dataset_length
@@ -34,6 +45,52 @@ class TSVResultWriter(object):
         if not self.in_order:
             assert(0)
 
+        self.sample_period = sample_period
+        self.num_calls = 0
+        self.num_dropped = 0
+        self._queue = None
+        if queue_size > 0:
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    def _full(self):
+        return self.max_visualize_num > 0 and len(self.predictions) >= self.max_visualize_num
+
+    def _dispatch(self, method, *args):
+        self.num_calls += 1
+        if (self.num_calls - 1) % self.sample_period != 0 or self._full():
+            return
+        if self._queue is None:
+            return method(*args)
+        try:
+            self._queue.put_nowait((method, args))
+        except queue.Full:
+            self.num_dropped += 1
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            method, args = item
+            try:
+                method(*args)
+            except Exception:
+                # the visualization must not stop the training
+                logging.getLogger("maskrcnn_benchmark.tsv_saver").exception("Failed to write {}".format(self.file_name))
+
+    def close(self):
+        """
+        Waits for the queued updates, stops the background thread and writes the rows left since the last write.
+        """
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._queue = None
+        if len(self.predictions) % self.write_freq != 0 and self.file_name is not None:
+            self.tsv_writer(self.predictions, self.file_name)
+
     @staticmethod
     def imagelist_to_b64(imgs):
         imgs = imgs.tensors.permute(0, 2, 3, 1).cpu().numpy()
@@ -44,6 +101,9 @@ class TSVResultWriter(object):
         return imgs
 
     def update(self, imgs, results):
+        self._dispatch(self._update, imgs, results)
+
+    def _update(self, imgs, results):
         if self.max_visualize_num > 0 and len(self.predictions) >= self.max_visualize_num:
             return
 
@@ -74,11 +134,14 @@ class TSVResultWriter(object):
             pred = [str(result[0]), json.dumps(pred, sort_keys=False), img_encoded_str]
             self.predictions.append(pred)
 
-        if len(self.predictions) % self.write_freq == 0 or len(self.predictions) >= self.max_visualize_num:
+        if len(self.predictions) % self.write_freq == 0 or self._full():
             self.tsv_writer(self.predictions, self.file_name)
 
 
     def update_train_data(self, imgs, targets):
+        self._dispatch(self._update_train_data, imgs, targets)
+
+    def _update_train_data(self, imgs, targets):
         if self.max_visualize_num > 0 and len(self.predictions) >= self.max_visualize_num:
             return
 
@@ -107,11 +170,14 @@ class TSVResultWriter(object):
             pred["relations"] = []
             pred = [str(0), json.dumps(pred, sort_keys=False), img_encoded_str]
             self.predictions.append(pred)
-        if len(self.predictions) % self.write_freq == 0 or len(self.predictions) >= self.max_visualize_num:
+        if len(self.predictions) % self.write_freq == 0 or self._full():
             ensure_file(self.file_name)
             self.tsv_writer(self.predictions, self.file_name)
 
     def update_gold_od_data(self, imgs, targets, categories):
+        self._dispatch(self._update_gold_od_data, imgs, targets, categories)
+
+    def _update_gold_od_data(self, imgs, targets, categories):
         if self.max_visualize_num > 0 and len(self.predictions) >= self.max_visualize_num:
             return
 
@@ -135,7 +201,7 @@ class TSVResultWriter(object):
             pred = [str(0), json.dumps(pred, sort_keys=False), img_encoded_str]
             self.predictions.append(pred)
 
-        if len(self.predictions) % self.write_freq == 0 or len(self.predictions) >= self.max_visualize_num:
+        if len(self.predictions) % self.write_freq == 0 or self._full():
             ensure_file(self.file_name)
             print("Writing to {}".format(self.file_name))
             self.tsv_writer(self.predictions, self.file_name)
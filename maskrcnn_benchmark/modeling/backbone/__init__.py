@@ -17,6 +17,7 @@ from . import swint_v2_vl
 from . import fusion_swin_transformer
 from . import fusion_swin_transformer_v2
 from . import fusion_swin_transformer_v3
+from . import swin_window_cache
 
 
 @registry.BACKBONES.register("R-50-C4")
@@ -454,6 +455,7 @@ def build_backbone(cfg):
     assert (
         cfg.MODEL.BACKBONE.CONV_BODY in registry.BACKBONES
     ), "cfg.MODEL.BACKBONE.CONV_BODY: {} are not registered in registry".format(cfg.MODEL.BACKBONE.CONV_BODY)
+    swin_window_cache.set_cache_size(cfg.MODEL.SWINT.WINDOW_CACHE_SIZE)
     return registry.BACKBONES[cfg.MODEL.BACKBONE.CONV_BODY](cfg)
 
 
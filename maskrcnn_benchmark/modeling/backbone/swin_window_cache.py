@@ -0,0 +1,89 @@
+"""
+Caches shared by the Swin Transformer variants (swint, swint_v2, swint_vl, swint_v2_vl and fusion v1-v3).
+
+The SW-MSA attention mask only depends on the padded feature map size, the window and the shift, and the
+gathered relative position bias only changes when the bias table does. Both used to be rebuilt at every
+forward call of every layer; they are now kept in a LRU keyed by (Hp, Wp, window, shift, device, dtype),
+which is mostly useful for multi-scale testing where the same resolutions come back. The size of the LRU
+is MODEL.SWINT.WINDOW_CACHE_SIZE (0 disables the caching).
+"""
+from collections import OrderedDict
+
+import torch
+
+_cache_size = 0
+_mask_cache = OrderedDict()
+
+
+def set_cache_size(cache_size):
+    global _cache_size
+    _cache_size = cache_size
+    while len(_mask_cache) > _cache_size:
+        _mask_cache.popitem(last=False)
+
+
+def _region_ids(length, window_size, shift_size, device):
+    # same regions as the slices (0, -window_size), (-window_size, -shift_size), (-shift_size, None)
+    coords = torch.arange(length, device=device)
+    return (coords >= length - window_size).long() + (coords >= length - shift_size).long()
+
+
+def _build_attention_mask(Hp, Wp, window_size, shift_size, device, dtype):
+    if shift_size > 0:
+        img_mask = _region_ids(Hp, window_size, shift_size, device)[:, None] * 3 + _region_ids(
+            Wp, window_size, shift_size, device
+        )
+    else:
+        img_mask = torch.zeros((Hp, Wp), dtype=torch.long, device=device)
+    # window partition: nW, window_size*window_size
+    mask_windows = img_mask.view(Hp // window_size, window_size, Wp // window_size, window_size)
+    mask_windows = mask_windows.permute(0, 2, 1, 3).reshape(-1, window_size * window_size)
+    attn_mask = torch.zeros(mask_windows.shape + (window_size * window_size,), dtype=dtype, device=device)
+    return attn_mask.masked_fill_(mask_windows.unsqueeze(1) != mask_windows.unsqueeze(2), -100.0)
+
+
+def shifted_window_attention_mask(H, W, window_size, shift_size, device, dtype=torch.float32):
+    """
+    Attention mask for SW-MSA of a H x W feature map, of shape (nW, window_size**2, window_size**2):
+    0 within a region of the cyclically shifted map and -100 across regions.
+    The returned tensor may be shared and must not be modified in place.
+    """
+    Hp = -(-H // window_size) * window_size
+    Wp = -(-W // window_size) * window_size
+    if _cache_size <= 0:
+        return _build_attention_mask(Hp, Wp, window_size, shift_size, device, dtype)
+
+    key = (Hp, Wp, window_size, shift_size, torch.device(device), dtype)
+    attn_mask = _mask_cache.get(key)
+    if attn_mask is None:
+        attn_mask = _build_attention_mask(Hp, Wp, window_size, shift_size, device, dtype)
+        _mask_cache[key] = attn_mask
+        while len(_mask_cache) > _cache_size:
+            _mask_cache.popitem(last=False)
+    else:
+        _mask_cache.move_to_end(key)
+    return attn_mask
+
+
+def window_relative_position_bias(attn):
+    """
+    Relative position bias (nH, Wh*Ww, Wh*Ww) of a WindowAttention module. When no gradient is needed,
+    it is kept on the module until its relative_position_bias_table is modified or moved.
+    """
+    table = attn.relative_position_bias_table
+    cacheable = _cache_size > 0 and not (table.requires_grad and torch.is_grad_enabled())
+    if cacheable:
+        key = (table._version, table.data_ptr(), table.device, table.dtype)
+        cached = getattr(attn, "_relative_position_bias_cache", None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+    num_positions = attn.window_size[0] * attn.window_size[1]
+    relative_position_bias = table[attn.relative_position_index.view(-1)].view(
+        num_positions, num_positions, -1
+    )  # Wh*Ww,Wh*Ww,nH
+    relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+
+    if cacheable:
+        attn._relative_position_bias_cache = (key, relative_position_bias)
+    return relative_position_bias
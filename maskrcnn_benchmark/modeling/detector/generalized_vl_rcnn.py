@@ -16,7 +16,9 @@ from ..rpn import build_rpn
 from ..roi_heads import build_roi_heads
 
 from ..language_backbone import build_language_backbone
-from transformers import AutoTokenizer
+from ..language_backbone.prompt_cache import PromptEmbeddingCache, hash_module_weights
+from maskrcnn_benchmark.utils.span_pooling import split_captions_by_spans, add_span_token_ranges, pool_span_features
+from transformers import AutoTokenizer, BatchEncoding
 
 import random
 import timeit
@@ -60,27 +62,6 @@ def random_word(input_ids, mask_token_id, vocabs, padding_token_id, greenlight_m
                 output_label[j, i] = -100  # If this location should not be masked
     return input_ids, output_label
 
-def get_char_token_with_relaxation(tokenized, beg, end, batch_index = None):
-    beg_pos = tokenized.char_to_token(batch_index, beg)
-    end_pos = tokenized.char_to_token(batch_index, end - 1)
-    if beg_pos is None:
-        try:
-            beg_pos = tokenized.char_to_token(batch_index, beg + 1)
-            if beg_pos is None:
-                beg_pos = tokenized.char_to_token(batch_index, beg + 2)
-        except:
-            beg_pos = None
-    if end_pos is None:
-        try:
-            end_pos = tokenized.char_to_token(batch_index, end - 2)
-            if end_pos is None:
-                end_pos = tokenized.char_to_token(batch_index, end - 3)
-        except:
-            end_pos = None
-    if beg_pos is None or end_pos is None:
-        return None, None
-    return beg_pos, end_pos + 1
-
 class GeneralizedVLRCNN(nn.Module):
     """
     Main class for Generalized R-CNN. Currently supports boxes and masks.
@@ -180,9 +161,20 @@ class GeneralizedVLRCNN(nn.Module):
             self.tunable_linear = torch.nn.Linear(cfg.MODEL.LANGUAGE_BACKBONE.LANG_DIM, 1000, bias=False)
             self.tunable_linear.weight.data.fill_(0.0)
 
+        # cache of tokenized prompts + language features, keyed by caption and language weights
+        self.prompt_cache = None
+        self._language_weights_hash = None
+        if cfg.MODEL.LANGUAGE_BACKBONE.PROMPT_CACHE and not self.fusion_in_backbone:
+            self.prompt_cache = PromptEmbeddingCache(
+                max_size=cfg.MODEL.LANGUAGE_BACKBONE.PROMPT_CACHE_SIZE,
+                cache_dir=cfg.MODEL.LANGUAGE_BACKBONE.PROMPT_CACHE_DIR,
+            )
+
     def train(self, mode=True):
         """Convert the model into training mode while keep layers freezed."""
         super(GeneralizedVLRCNN, self).train(mode)
+        # the language weights may have changed since the last evaluation
+        self._language_weights_hash = None
         if self.freeze_backbone:
             if self.fusion_in_backbone:
                 self.fusion_backbone.backbone.body.eval()
@@ -259,13 +251,41 @@ class GeneralizedVLRCNN(nn.Module):
                 for p in self.language_backbone.parameters():
                     p.requires_grad = False
 
-    def forward(self, images, targets=None, captions=None, positive_map=None, greenlight_map=None, spans = None, span_map = None):
+    def _can_use_prompt_cache(self):
+        if self.prompt_cache is None or self.use_mlm_loss:
+            return False
+        # the span pooling needs the tokenizer offsets, which are not cached
+        if self.cfg.MODEL.DYHEAD.FUSE_CONFIG.SPAN_VERSION is not None:
+            return False
+        return not self.training or self.freeze_language_backbone
+
+    def supports_visual_feature_reuse(self):
+        """
+        The image-only stages (backbone + FPN) can be shared across prompts only when
+        the visual backbone never sees the language features.
+        """
+        return not self.fusion_in_backbone and "vl" not in self.cfg.MODEL.SWINT.VERSION
+
+    def extract_visual_features(self, images):
+        """
+        Run the image-only stages once so that they can be passed to forward() for several
+        query chunks of the same image (see TEST.REUSE_VISUAL_FEATURES).
+        """
+        assert self.supports_visual_feature_reuse(), "The visual backbone depends on the language input!"
+        images = to_image_list(images)
+        return self.backbone(images.tensors)
+
+    def forward(self, images, targets=None, captions=None, positive_map=None, greenlight_map=None, spans = None, span_map = None, visual_features = None, tokenized_captions = None):
         """
         Arguments:
             images (list[Tensor] or ImageList): images to be processed
             targets (list[BoxList]): ground-truth boxes present in the image (optional)
 
             mask_black_list: batch x 256, indicates whether or not a certain token is maskable or not
+            visual_features (tuple[Tensor]): precomputed output of extract_visual_features (optional);
+                when given, the visual backbone is skipped
+            tokenized_captions (dict[Tensor]): `captions` already tokenized by BatchCollator (optional);
+                when given, the tokenizer is not called, neither here nor in the ATSS loss
 
         Returns:
             result (list[BoxList] or dict[Tensor]): the output from the model.
@@ -283,62 +303,57 @@ class GeneralizedVLRCNN(nn.Module):
 
         # if we use the advanced span prediction version, we need to do both preprocessing and postprocessing
         if self.cfg.MODEL.DYHEAD.FUSE_CONFIG.SPAN_VERSION is not None and self.cfg.MODEL.DYHEAD.FUSE_CONFIG.SPAN_VERSION.startswith("v2"):
-            if spans is None:
-                spans = [i.extra_fields['spans'] if "spans" in i.extra_fields else [] for i in targets] # if we did not pass the spans explicitly
-            assert(len(spans) == len(captions))
-            new_captions = []
-            mapping_batch_span_to_caption_num = {} # (batch_num, start, end) -> caption_num
-            mapping_batch_to_caption_num = {}
-            corrected_spans = deepcopy(spans)
-
-            for i in range(len(captions)):
-                if len(spans[i]) == 0: # if this instance does not have span
-                    mapping_batch_to_caption_num[i] = len(new_captions)
-                    new_captions.append(captions[i])
-                    continue
-
-                for j in range(len(spans[i])):
-                    ''' spans[i][j]: 
-                    [[230, 241],
-                    [241, 254],
-                    [254, 269],
-                    [269, 298],]
-                    '''
-                    valid_spans = [k for k in spans[i][j] if k[0] != -1]
-                    if "independent" in self.cfg.MODEL.DYHEAD.FUSE_CONFIG.SPAN_VERSION:
-                        for k, span_i_j_k in enumerate(valid_spans):
-                            mapping_batch_span_to_caption_num[(i, span_i_j_k[0], span_i_j_k[1])] = len(new_captions)
-                            corrected_spans[i][j][k] = (0, span_i_j_k[1] - span_i_j_k[0])
-                            new_captions.append(captions[i][span_i_j_k[0]:span_i_j_k[1]])
-                    else:
-                        start = valid_spans[0][0]
-                        end = valid_spans[-1][-1]
-                        # rewrite the spans !!
-                        corrected_spans[i][j] = [(k[0] - start, k[1] - start) for k in spans[i][j]]
-                        
-                        for k in valid_spans:
-                            mapping_batch_span_to_caption_num[(i, k[0], k[1])] = len(new_captions)
-                        #mapping_batch_to_caption_num[i] = len(new_captions)
-                        new_captions.append(captions[i][start:end])
-            captions = new_captions
+            if tokenized_captions is not None and "span_split" in tokenized_captions:
+                # split and tokenized by BatchCollator in the dataloader workers
+                tokenized_captions = dict(tokenized_captions)
+                span_split = tokenized_captions.pop("span_split")
+            else:
+                if spans is None:
+                    spans = [i.extra_fields['spans'] if "spans" in i.extra_fields else [] for i in targets] # if we did not pass the spans explicitly
+                assert(len(spans) == len(captions))
+                span_split = split_captions_by_spans(
+                    captions, spans, independent="independent" in self.cfg.MODEL.DYHEAD.FUSE_CONFIG.SPAN_VERSION
+                )
+                # the captions tokenized by BatchCollator were not split into spans
+                tokenized_captions = None
+            captions = span_split["captions"]
             padding_method = "longest"
             #print(new_captions)
         else:
-            mapping_batch_span_to_caption_num = None
+            span_split = None
             padding_method = "max_length" if self.cfg.MODEL.LANGUAGE_BACKBONE.PAD_MAX else "longest"
 
         # language embedding
         language_dict_features = {}
         if captions is not None:
             # print(captions[0])
-            tokenized = self.tokenizer.batch_encode_plus(
-                captions,
-                max_length=self.cfg.MODEL.LANGUAGE_BACKBONE.MAX_QUERY_LEN,
-                padding=padding_method,
-                return_special_tokens_mask=True,
-                return_tensors="pt",
-                truncation=True,
-            ).to(device)
+            cached_prompt = None
+            prompt_cache_key = None
+            if self._can_use_prompt_cache():
+                if self._language_weights_hash is None:
+                    self._language_weights_hash = hash_module_weights(self.language_backbone)
+                prompt_cache_key = PromptEmbeddingCache.make_key(
+                    captions,
+                    self._language_weights_hash,
+                    max_length=self.cfg.MODEL.LANGUAGE_BACKBONE.MAX_QUERY_LEN,
+                    padding=padding_method,
+                )
+                cached_prompt = self.prompt_cache.get(prompt_cache_key, device)
+
+            if cached_prompt is not None:
+                tokenized = BatchEncoding(cached_prompt[0])
+            elif tokenized_captions is not None:
+                # tokenized by BatchCollator in the dataloader workers
+                tokenized = BatchEncoding(tokenized_captions).to(device)
+            else:
+                tokenized = self.tokenizer.batch_encode_plus(
+                    captions,
+                    max_length=self.cfg.MODEL.LANGUAGE_BACKBONE.MAX_QUERY_LEN,
+                    padding=padding_method,
+                    return_special_tokens_mask=True,
+                    return_tensors="pt",
+                    truncation=True,
+                ).to(device)
             if self.use_mlm_loss:
                 if not self.mlm_loss_for_only_positives:
                     greenlight_map = None
@@ -356,12 +371,25 @@ class GeneralizedVLRCNN(nn.Module):
             tokenizer_input = {"input_ids": input_ids, "attention_mask": tokenized.attention_mask}
 
             if not self.fusion_in_backbone:
-                if self.cfg.MODEL.LANGUAGE_BACKBONE.FREEZE:
+                if cached_prompt is not None:
+                    language_dict_features = cached_prompt[1]
+                elif self.cfg.MODEL.LANGUAGE_BACKBONE.FREEZE:
                     with torch.no_grad():
                         language_dict_features = self.language_backbone(tokenizer_input)
                 else:
                     language_dict_features = self.language_backbone(tokenizer_input)
 
+                if prompt_cache_key is not None and cached_prompt is None:
+                    self.prompt_cache.put(
+                        prompt_cache_key,
+                        {
+                            "input_ids": tokenized.input_ids,
+                            "attention_mask": tokenized.attention_mask,
+                            "special_tokens_mask": tokenized.special_tokens_mask,
+                        },
+                        language_dict_features,
+                    )
+
                 # ONE HOT
                 if self.cfg.DATASETS.ONE_HOT:
                     new_masks = torch.zeros_like(
@@ -379,7 +407,10 @@ class GeneralizedVLRCNN(nn.Module):
         if not self.fusion_in_backbone:
             # visual embedding
             swint_feature_c4 = None
-            if "vl" in self.cfg.MODEL.SWINT.VERSION:
+            if visual_features is not None:
+                # reuse the features computed by extract_visual_features
+                assert self.supports_visual_feature_reuse()
+            elif "vl" in self.cfg.MODEL.SWINT.VERSION:
                 # the backbone only updates the "hidden" field in language_dict_features
                 inputs = {"img": images.tensors, "lang": language_dict_features}
                 visual_features, language_dict_features, swint_feature_c4 = self.backbone(inputs)
@@ -409,68 +440,14 @@ class GeneralizedVLRCNN(nn.Module):
 
             # Step 1. get the spans
             embedding = language_dict_features["hidden"]
-            if spans is None:
-                spans = [i.extra_fields['spans'] if "spans" in i.extra_fields else [] for i in targets] # if we did not pass the spans explicitly
-
-            if mapping_batch_span_to_caption_num is not None: # need to do a remapping
-                flatterned_spans = []
-                for i in spans:
-                    _ = []
-                    for j in i:
-                        _.extend(j)
-                    flatterned_spans.append(_)
-                spans = flatterned_spans
-
-                # flattern corrected spans
-                flatterned_corrected_spans = []
-                for i in corrected_spans:
-                    _ = []
-                    for j in i:
-                        _.extend(j)
-                    flatterned_corrected_spans.append(_)
-                corrected_spans = flatterned_corrected_spans
-
-                max_span_num = max([len(i) for i in spans])
-
-                # go over the batch, see if there is an instance without spans; if so, we override the span_num to the token_num of that instance
-                for i, spans_i in enumerate(spans):
-                    if len(spans_i) == 0: # no spans
-                        text_length = sum(tokenized.attention_mask[mapping_batch_to_caption_num[i]])
-                        max_span_num = max(text_length, max_span_num) # override
-                
-                # Step 2. Get the Masks
-                span_masks = torch.zeros((len(spans), max_span_num), device=embedding.device, dtype=torch.long)
-                for i, spans_i in enumerate(spans):
-                    if len(spans_i) == 0:
-                        # this would be the text masks
-                        text_mask_i = tokenized.attention_mask[mapping_batch_to_caption_num[i]]
-                        text_length = sum(text_mask_i)
-                        span_masks[i, : text_length] = text_mask_i[:text_length]
-                    else:
-                        span_masks[i, : len(spans_i)] = 1
-
-                # Step 3. get the span features
-                span_features = torch.zeros((len(spans), max_span_num, embedding.size(2)), device=embedding.device, dtype=embedding.dtype)
-                # the complexity is just batch x span_num; should be begign for a foor loop
-                for i, spans_i in enumerate(spans):
-                    if len(spans_i) == 0:
-                        # directly override with the embedding
-                        __len = min(max_span_num, embedding[mapping_batch_to_caption_num[i]].size(0))
-                        span_features[i, :__len, :] = embedding[mapping_batch_to_caption_num[i], :__len, :]
-                    else:
-                        for j, span in enumerate(spans_i):
-                            # first need to get the correct tokenized version
-                            mapped_sentence_index = mapping_batch_span_to_caption_num[(i, span[0], span[1])] # here we use the original span
-
-                            start, end = get_char_token_with_relaxation(tokenized, corrected_spans[i][j][0], corrected_spans[i][j][1], batch_index = mapped_sentence_index) # here use the span location after we have partitioned the sentence
-                            if start is None or end is None:
-                                span_masks[i, j] = 0 # mark this span as invalid
-
-                            if pooling_version == "mean":
-                                span_rep_i_j = torch.mean(embedding[mapped_sentence_index, start:end, :], dim=0)
-                            elif pooling_version == "max":
-                                span_rep_i_j = torch.max(embedding[mapped_sentence_index, start:end, :], dim=0)[0]
-                            span_features[i, j, :] = span_rep_i_j
+            if span_split is not None:
+                # Step 2 and 3. get the span features and masks
+                if "span_token_start" not in span_split:
+                    span_split = add_span_token_ranges(span_split, tokenized)
+                span_features, span_masks = pool_span_features(
+                    embedding, tokenized.attention_mask, span_split, pooling=pooling_version
+                )
+                max_span_num = span_masks.size(1)
             else:
                 assert(0)
                 # max_span_num = max([len(i) for i in spans])
@@ -512,12 +489,16 @@ class GeneralizedVLRCNN(nn.Module):
                         _all_span_map_flattern.extend([[]] * num_box) # very important
                     
                 assert(len(_all_span_map_flattern) == positive_map.size(0))
-                for i, span_map_i in enumerate(_all_span_map_flattern):
-                    if len(span_map_i) == 0:
-                        seq_len = min(max_span_num, positive_map.size(1))
-                        span_map[i, :seq_len] = positive_map[i, :seq_len] # use the original positive map in this case!
-                    else:
-                        span_map[i, :len(span_map_i)] = span_map_i
+                span_map_lengths = torch.as_tensor([len(span_map_i) for span_map_i in _all_span_map_flattern], dtype=torch.long)
+                # use the original positive map for the boxes without span_map
+                no_span_map = (span_map_lengths == 0).nonzero().view(-1)
+                seq_len = min(max_span_num, positive_map.size(1))
+                span_map[no_span_map.to(span_map.device), :seq_len] = positive_map[no_span_map.to(positive_map.device), :seq_len].to(span_map.device)
+                # and write the span_map of all the other boxes at once
+                rows = torch.repeat_interleave(torch.arange(len(span_map_lengths)), span_map_lengths)
+                cols = torch.arange(len(rows)) - (span_map_lengths.cumsum(0) - span_map_lengths)[rows]
+                values = torch.as_tensor([float(v) for span_map_i in _all_span_map_flattern for v in span_map_i], dtype=torch.float)
+                span_map[rows.to(span_map.device), cols.to(span_map.device)] = values.to(span_map.device)
 
             
             # Step 5. Override
@@ -542,7 +523,14 @@ class GeneralizedVLRCNN(nn.Module):
                 proposals.append(tb)
             if self.cfg.MODEL.RPN.RETURN_FUSED_FEATURES:
                 _, proposal_losses, fused_visual_features = self.rpn(
-                    images, visual_features, targets, language_dict_features, positive_map, captions, swint_feature_c4
+                    images,
+                    visual_features,
+                    targets,
+                    language_dict_features,
+                    positive_map,
+                    captions,
+                    swint_feature_c4,
+                    tokenized_captions=tokenized_captions,
                 )
             elif self.training:
                 null_loss = 0
@@ -551,7 +539,14 @@ class GeneralizedVLRCNN(nn.Module):
                 proposal_losses = {("rpn_null_loss", null_loss)}
         else:
             proposals, proposal_losses, fused_visual_features = self.rpn(
-                images, visual_features, targets, language_dict_features, positive_map, captions, swint_feature_c4
+                images,
+                visual_features,
+                targets,
+                language_dict_features,
+                positive_map,
+                captions,
+                swint_feature_c4,
+                tokenized_captions=tokenized_captions,
             )
 
         if self.roi_heads:
@@ -0,0 +1,95 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import torch
+
+
+def hash_module_weights(module):
+    """Fingerprint of the parameters and buffers of a module, used to invalidate cached prompts."""
+    sha = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        sha.update(name.encode("utf-8"))
+        sha.update(str(tuple(tensor.shape)).encode("utf-8"))
+        sha.update(tensor.detach().cpu().contiguous().view(-1).float().numpy().tobytes())
+    return sha.hexdigest()
+
+
+class PromptEmbeddingCache(object):
+    """
+    Cache of the tokenized prompts and the output of the language backbone (language_dict_features),
+    keyed by the caption text, the tokenization arguments and the hash of the language weights.
+
+    Entries are kept in memory (LRU with max_size entries) and, if cache_dir is given, also saved to disk
+    so that they can be reused by other runs / processes evaluating the same checkpoint.
+    """
+
+    def __init__(self, max_size=256, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir if cache_dir else None
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(captions, weights_hash, **tokenizer_kwargs):
+        sha = hashlib.sha1()
+        sha.update(weights_hash.encode("utf-8"))
+        for k in sorted(tokenizer_kwargs):
+            sha.update("{}={};".format(k, tokenizer_kwargs[k]).encode("utf-8"))
+        for caption in captions:
+            sha.update(caption.encode("utf-8"))
+            sha.update(b"\x00")
+        return sha.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, "{}.pth".format(key))
+
+    def get(self, key, device):
+        """
+        Returns (tokenized, language_dict_features) or None. tokenized is a dict of tensors with
+        "input_ids", "attention_mask" and "special_tokens_mask".
+        """
+        entry = self._entries.get(key)
+        if entry is None and self.cache_dir is not None and os.path.exists(self._disk_path(key)):
+            entry = torch.load(self._disk_path(key), map_location="cpu")
+            self._insert(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        tokenized = {k: v.to(device) for k, v in entry["tokenized"].items()}
+        # shallow copy: the caller adds / overrides fields of language_dict_features
+        language_dict_features = {k: v.to(device) for k, v in entry["language_dict_features"].items()}
+        return tokenized, language_dict_features
+
+    def put(self, key, tokenized, language_dict_features):
+        entry = {
+            "tokenized": {k: v.detach() for k, v in tokenized.items()},
+            "language_dict_features": {
+                k: v.detach() for k, v in language_dict_features.items() if isinstance(v, torch.Tensor)
+            },
+        }
+        self._insert(key, entry)
+        if self.cache_dir is not None and not os.path.exists(self._disk_path(key)):
+            cpu_entry = {
+                group: {k: v.cpu() for k, v in tensors.items()} for group, tensors in entry.items()
+            }
+            tmp_path = self._disk_path(key) + ".tmp{}".format(os.getpid())
+            torch.save(cpu_entry, tmp_path)
+            os.replace(tmp_path, self._disk_path(key))
+
+    def _insert(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,5 +1,6 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 import math
+from collections import OrderedDict
 
 import numpy as np
 import torch
@@ -33,6 +34,28 @@ class BufferList(nn.Module):
         return iter(self._buffers.values())
 
 
+class AnchorsPerImage(list):
+    """
+    The per level anchors (list[BoxList]) of one image, as returned by AnchorGenerator.
+    `flat` is the BoxList of all levels concatenated, the per level BoxLists being views of it.
+    """
+
+    def __init__(self, anchors_per_level, flat):
+        super(AnchorsPerImage, self).__init__(anchors_per_level)
+        self.flat = flat
+
+
+def cat_anchors(anchors_per_image):
+    """
+    Same as cat_boxlist(anchors_per_image), without concatenating again the anchors cached
+    by AnchorGenerator. The returned BoxList may be shared and must not be modified in place.
+    """
+    flat = getattr(anchors_per_image, "flat", None)
+    if flat is not None:
+        return flat
+    return cat_boxlist(anchors_per_image)
+
+
 class AnchorGenerator(nn.Module):
     """
     For a set of image sizes and feature maps, computes a set
@@ -45,6 +68,7 @@ class AnchorGenerator(nn.Module):
         aspect_ratios=(0.5, 1.0, 2.0),
         anchor_strides=(8, 16, 32),
         straddle_thresh=0,
+        cache_size=0,
     ):
         super(AnchorGenerator, self).__init__()
 
@@ -63,6 +87,11 @@ class AnchorGenerator(nn.Module):
         self.strides = anchor_strides
         self.cell_anchors = BufferList(cell_anchors)
         self.straddle_thresh = straddle_thresh
+        # LRU of AnchorsPerImage, keyed by (grid sizes, device, dtype, image size); 0 disables it.
+        # the anchor boxes only depend on the grid sizes and are shared by all the image sizes
+        self.cache_size = cache_size
+        self._anchor_cache = OrderedDict()
+        self._grid_cache = OrderedDict()
 
     def num_anchors_per_location(self):
         return [len(cell_anchors) for cell_anchors in self.cell_anchors]
@@ -98,8 +127,57 @@ class AnchorGenerator(nn.Module):
             inds_inside = torch.ones(anchors.shape[0], dtype=torch.bool, device=device)
         boxlist.add_field("visibility", inds_inside)
 
+    def cached_anchors(self, grid_sizes, image_size):
+        """
+        Anchors of an image of size image_size (width, height) for feature maps of sizes grid_sizes,
+        computed once per key: all levels are generated and checked for visibility in a single
+        flat BoxList, of which the per level BoxLists are views.
+        """
+        base_anchors = next(iter(self.cell_anchors))
+        grid_key = (tuple(tuple(int(s) for s in size) for size in grid_sizes), base_anchors.device, base_anchors.dtype)
+        key = grid_key + (image_size,)
+        anchors = self._anchor_cache.get(key)
+        if anchors is not None:
+            self._anchor_cache.move_to_end(key)
+            return anchors
+
+        grid = self._grid_cache.get(grid_key)
+        if grid is None:
+            anchors_over_all_feature_maps = self.grid_anchors(grid_sizes)
+            grid = (torch.cat(anchors_over_all_feature_maps, dim=0), [len(a) for a in anchors_over_all_feature_maps])
+            self._grid_cache[grid_key] = grid
+        self._grid_cache.move_to_end(grid_key)
+        while len(self._grid_cache) > self.cache_size:
+            self._grid_cache.popitem(last=False)
+
+        flat_bbox, num_anchors_per_level = grid
+        flat = BoxList(flat_bbox, image_size, mode="xyxy")
+        self.add_visibility_to(flat)
+        visibility = flat.get_field("visibility")
+        anchors_per_level = []
+        start = 0
+        for num_anchors in num_anchors_per_level:
+            end = start + num_anchors
+            boxlist = BoxList(flat_bbox[start:end], image_size, mode="xyxy")
+            boxlist.add_field("visibility", visibility[start:end])
+            anchors_per_level.append(boxlist)
+            start = end
+        anchors = AnchorsPerImage(anchors_per_level, flat)
+
+        self._anchor_cache[key] = anchors
+        while len(self._anchor_cache) > self.cache_size:
+            self._anchor_cache.popitem(last=False)
+        return anchors
+
     def forward(self, image_list, feature_maps):
         grid_sizes = [feature_map.shape[-2:] for feature_map in feature_maps]
+        if self.cache_size > 0:
+            if isinstance(image_list, ImageList):
+                image_sizes = [(int(w), int(h)) for h, w in image_list.image_sizes]
+            else:
+                image_sizes = [tuple(int(x) for x in image_list.size()[-2:][::-1])]
+            return [self.cached_anchors(grid_sizes, image_size) for image_size in image_sizes]
+
         anchors_over_all_feature_maps = self.grid_anchors(grid_sizes)
         anchors = []
         if isinstance(image_list, ImageList):
@@ -126,12 +204,13 @@ def make_anchor_generator(config):
     aspect_ratios = config.MODEL.RPN.ASPECT_RATIOS
     anchor_stride = config.MODEL.RPN.ANCHOR_STRIDE
     straddle_thresh = config.MODEL.RPN.STRADDLE_THRESH
+    cache_size = config.MODEL.RPN.ANCHOR_CACHE_SIZE
 
     if config.MODEL.RPN.USE_FPN:
         assert len(anchor_stride) == len(anchor_sizes), "FPN should have len(ANCHOR_STRIDE) == len(ANCHOR_SIZES)"
     else:
         assert len(anchor_stride) == 1, "Non-FPN should have a single ANCHOR_STRIDE"
-    anchor_generator = AnchorGenerator(anchor_sizes, aspect_ratios, anchor_stride, straddle_thresh)
+    anchor_generator = AnchorGenerator(anchor_sizes, aspect_ratios, anchor_stride, straddle_thresh, cache_size)
     return anchor_generator
 
 
@@ -156,7 +235,9 @@ def make_anchor_generator_complex(config):
         assert len(anchor_strides) == 1, "Non-FPN should have a single ANCHOR_STRIDE"
         new_anchor_sizes = anchor_sizes
 
-    anchor_generator = AnchorGenerator(tuple(new_anchor_sizes), aspect_ratios, anchor_strides, straddle_thresh)
+    anchor_generator = AnchorGenerator(
+        tuple(new_anchor_sizes), aspect_ratios, anchor_strides, straddle_thresh, config.MODEL.RPN.ANCHOR_CACHE_SIZE
+    )
     return anchor_generator
 
 
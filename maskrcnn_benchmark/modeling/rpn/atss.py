@@ -8,7 +8,7 @@ from .loss import make_atss_loss_evaluator
 
 from maskrcnn_benchmark.structures.boxlist_ops import cat_boxlist
 from maskrcnn_benchmark.layers import Scale, DFConv2d, DYReLU, SELayer
-from .anchor_generator import make_anchor_generator_complex
+from .anchor_generator import make_anchor_generator_complex, cat_anchors
 
 
 class BoxCoder(object):
@@ -189,7 +189,7 @@ class ATSSModule(torch.nn.Module):
             boxes = self.box_selector_train(box_cls, box_regression, centerness, anchors)
             train_boxes = []
             for b, a in zip(boxes, anchors):
-                a = cat_boxlist(a)
+                a = cat_anchors(a)
                 b.add_field("visibility", torch.ones(b.bbox.shape[0], dtype=torch.bool, device=b.bbox.device))
                 del b.extra_fields["scores"]
                 del b.extra_fields["labels"]
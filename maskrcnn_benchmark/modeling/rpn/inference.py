@@ -1,5 +1,6 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 import logging
+from collections import OrderedDict
 
 import torch
 
@@ -565,6 +566,7 @@ class ATSSPostProcessor(torch.nn.Module):
         bbox_aug_vote=False,
         score_agg="MEAN",
         mdetr_style_aggregate_class_num=-1,
+        score_agg_matrix=False,
     ):
         super(ATSSPostProcessor, self).__init__()
         self.pre_nms_thresh = pre_nms_thresh
@@ -578,6 +580,25 @@ class ATSSPostProcessor(torch.nn.Module):
         self.bbox_aug_vote = bbox_aug_vote
         self.score_agg = score_agg
         self.mdetr_style_aggregate_class_num = mdetr_style_aggregate_class_num
+        self.score_agg_matrix = score_agg_matrix and score_agg in ("MEAN", "MAX", "POWER")
+        # (id(positive_map), ...) -> (positive_map, TokenToClassAggregation); the positive_map is kept alive so
+        # that its id cannot be reused by another prompt while cached
+        self._aggregation_cache = OrderedDict()
+
+    def _aggregate_token_scores(self, logits, positive_map, num_class, label_offset=-1):
+        """Same as convert_grounding_to_od_logits(_v2) with the label -> token matrix of positive_map"""
+        key = (id(positive_map), num_class, label_offset, logits.shape[-1], logits.device)
+        entry = self._aggregation_cache.get(key)
+        if entry is None or entry[0] is not positive_map:
+            entry = (
+                positive_map,
+                TokenToClassAggregation(positive_map, num_class, label_offset, logits.shape[-1], logits.device),
+            )
+            self._aggregation_cache[key] = entry
+            while len(self._aggregation_cache) > 64:
+                self._aggregation_cache.popitem(last=False)
+        self._aggregation_cache.move_to_end(key)
+        return entry[1](logits, self.score_agg)
 
     def forward_for_single_feature_map(
         self,
@@ -612,17 +633,39 @@ class ATSSPostProcessor(torch.nn.Module):
             token_logits = permute_and_flatten(token_logits, N, A, T, H, W)
             token_logits = token_logits.sigmoid()
             # turn back to original classes
-            scores = convert_grounding_to_od_logits(
-                logits=token_logits, box_cls=box_cls, positive_map=positive_map, score_agg=self.score_agg
-            )
+            if self.score_agg_matrix and positive_map is not None:
+                scores = convert_grounding_to_od_logits_per_image(
+                    self._aggregate_token_scores,
+                    logits=token_logits,
+                    positive_map=positive_map,
+                    num_class=box_cls.shape[2],
+                )
+            else:
+                scores = convert_grounding_to_od_logits_per_image(
+                    convert_grounding_to_od_logits,
+                    logits=token_logits,
+                    positive_map=positive_map,
+                    box_cls=box_cls,
+                    score_agg=self.score_agg,
+                )
             box_cls = scores
 
         # binary dot product focal version
         if dot_product_logits is not None:
             # print('Dot Product.')
             dot_product_logits = dot_product_logits.sigmoid()
-            if self.mdetr_style_aggregate_class_num != -1:
-                scores = convert_grounding_to_od_logits_v2(
+            if self.score_agg_matrix and positive_map is not None:
+                scores = convert_grounding_to_od_logits_per_image(
+                    self._aggregate_token_scores,
+                    logits=dot_product_logits,
+                    positive_map=positive_map,
+                    num_class=self.mdetr_style_aggregate_class_num
+                    if self.mdetr_style_aggregate_class_num != -1
+                    else box_cls.shape[2],
+                )
+            elif self.mdetr_style_aggregate_class_num != -1:
+                scores = convert_grounding_to_od_logits_per_image(
+                    convert_grounding_to_od_logits_v2,
                     logits=dot_product_logits,
                     num_class=self.mdetr_style_aggregate_class_num,
                     positive_map=positive_map,
@@ -630,8 +673,12 @@ class ATSSPostProcessor(torch.nn.Module):
                     disable_minus_one=False,
                 )
             else:
-                scores = convert_grounding_to_od_logits(
-                    logits=dot_product_logits, box_cls=box_cls, positive_map=positive_map, score_agg=self.score_agg
+                scores = convert_grounding_to_od_logits_per_image(
+                    convert_grounding_to_od_logits,
+                    logits=dot_product_logits,
+                    positive_map=positive_map,
+                    box_cls=box_cls,
+                    score_agg=self.score_agg,
                 )
             box_cls = scores
 
@@ -737,6 +784,79 @@ class ATSSPostProcessor(torch.nn.Module):
         return results
 
 
+def convert_grounding_to_od_logits_per_image(convert_fn, logits, positive_map, **kwargs):
+    """
+    In batched chunk inference (TEST.CHUNKS_PER_BATCH) every image of the batch is paired with its own prompt,
+    so positive_map is a list with one label -> token map per image; the scores are converted per image and
+    stacked back. A single positive_map is shared by the whole batch as before.
+    """
+    if isinstance(positive_map, (list, tuple)):
+        assert len(positive_map) == logits.shape[0], "Need one positive_map per image!"
+        return torch.cat(
+            [
+                convert_fn(logits=logits[i : i + 1], positive_map=positive_map[i], **kwargs)
+                for i in range(logits.shape[0])
+            ],
+            dim=0,
+        )
+    return convert_fn(logits=logits, positive_map=positive_map, **kwargs)
+
+
+class TokenToClassAggregation(object):
+    """
+    Label -> token map of a prompt ({label: [token, ...]}) compiled into tensors, so that the token scores of all
+    the labels are aggregated at once instead of with one gather per label: a matmul with the (tokens x classes)
+    averaging matrix for MEAN, the same matmul in log space for POWER (geometric mean), and a running max over
+    the k-th token of every label for MAX. The scores of label j go to class j + label_offset.
+    """
+
+    def __init__(self, positive_map, num_class, label_offset, num_tokens, device):
+        labels, locations = [], []
+        for label_j, locations_label_j in positive_map.items():
+            if isinstance(locations_label_j, int):
+                locations_label_j = [locations_label_j]
+            if len(locations_label_j) > 0:
+                labels.append(label_j)
+                locations.append(list(locations_label_j))
+        counts = torch.as_tensor([len(locs) for locs in locations], dtype=torch.long)
+        columns = torch.as_tensor(labels, dtype=torch.long) + label_offset
+        tokens = torch.as_tensor(sum(locations, []), dtype=torch.long)
+
+        mean_weights = torch.zeros(num_tokens, num_class)
+        mean_weights.index_put_(
+            (tokens, columns.repeat_interleave(counts)), (1.0 / counts.float()).repeat_interleave(counts), accumulate=True
+        )
+        self.mean_weights = mean_weights.to(device)
+        has_label = torch.zeros(num_class)
+        has_label[columns] = 1
+        self.has_label = has_label.to(device)
+
+        # max_tokens[k, l] = k-th token of label l, padded with its first token
+        max_len = int(counts.max()) if len(counts) > 0 else 0
+        max_tokens = torch.as_tensor(
+            [locs + locs[:1] * (max_len - len(locs)) for locs in locations], dtype=torch.long
+        ).view(len(locations), max_len)
+        self.max_tokens = max_tokens.t().contiguous().to(device)
+        self.columns = columns.to(device)
+        self.num_class = num_class
+
+    def __call__(self, logits, score_agg):
+        if score_agg == "MEAN":
+            return torch.matmul(logits.float(), self.mean_weights)
+        if score_agg == "POWER":
+            log_logits = torch.log(logits.float().clamp(min=torch.finfo(torch.float).tiny))
+            return torch.exp(torch.matmul(log_logits, self.mean_weights)) * self.has_label
+        if score_agg == "MAX":
+            scores = torch.zeros(logits.shape[0], logits.shape[1], self.num_class, device=logits.device)
+            if len(self.columns) > 0:
+                label_scores = logits[:, :, self.max_tokens[0]]
+                for tokens_k in self.max_tokens[1:]:
+                    label_scores = torch.max(label_scores, logits[:, :, tokens_k])
+                scores[:, :, self.columns] = label_scores.float()
+            return scores
+        raise NotImplementedError
+
+
 def convert_grounding_to_od_logits(logits, box_cls, positive_map, score_agg=None):
     scores = torch.zeros(logits.shape[0], logits.shape[1], box_cls.shape[2]).to(logits.device)
     # 256 -> 80, average for each class
@@ -817,6 +937,7 @@ def make_atss_postprocessor(config, box_coder, is_train=False):
         bbox_aug_enabled=config.TEST.USE_MULTISCALE,
         score_agg=score_agg,
         mdetr_style_aggregate_class_num=config.TEST.MDETR_STYLE_AGGREGATE_CLASS_NUM,
+        score_agg_matrix=config.MODEL.DYHEAD.SCORE_AGG_MATRIX,
     )
 
     return box_selector
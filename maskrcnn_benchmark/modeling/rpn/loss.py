@@ -19,6 +19,8 @@ from maskrcnn_benchmark.layers import SigmoidFocalLoss, IOULoss, TokenSigmoidFoc
 from maskrcnn_benchmark.utils.comm import get_world_size, reduce_sum
 from maskrcnn_benchmark.utils.amp import custom_fwd, custom_bwd
 from maskrcnn_benchmark.utils.shallow_contrastive_loss_helper import *
+from maskrcnn_benchmark.utils.token_offsets import OffsetsEncoding, build_char_to_token_table, char_span_to_token_span
+from .anchor_generator import cat_anchors
 import pdb
 from transformers import AutoTokenizer
 
@@ -102,7 +104,7 @@ class RPNLossComputation(object):
             objectness_loss (Tensor)
             box_loss (Tensor
         """
-        anchors = [cat_boxlist(anchors_per_image) for anchors_per_image in anchors]
+        anchors = [cat_anchors(anchors_per_image) for anchors_per_image in anchors]
         labels, regression_targets = self.prepare_targets(anchors, targets)
         sampled_pos_inds, sampled_neg_inds = self.fg_bg_sampler(labels)
         sampled_pos_inds = torch.nonzero(torch.cat(sampled_pos_inds, dim=0)).squeeze(1)
@@ -231,7 +233,7 @@ class FocalLossComputation(object):
             retinanet_cls_loss (Tensor)
             retinanet_regression_loss (Tensor
         """
-        anchors = [cat_boxlist(anchors_per_image) for anchors_per_image in anchors]
+        anchors = [cat_anchors(anchors_per_image) for anchors_per_image in anchors]
         labels, regression_targets = self.prepare_targets(anchors, targets)
 
         N = len(labels)
@@ -486,6 +488,9 @@ class ATSSLossComputation(torch.nn.Module):
         self.matcher = Matcher(cfg.MODEL.FOCAL.FG_IOU_THRESHOLD, cfg.MODEL.FOCAL.BG_IOU_THRESHOLD, True)
         self.box_coder = box_coder
 
+        self.target_assignment = cfg.MODEL.ATSS.TARGET_ASSIGNMENT
+        assert self.target_assignment in ["loop", "batched"], self.target_assignment
+
         if (
             self.cfg.MODEL.DYHEAD.FUSE_CONFIG.USE_TOKEN_LOSS
             or self.cfg.MODEL.DYHEAD.FUSE_CONFIG.USE_DOT_PRODUCT_TOKEN_LOSS
@@ -686,7 +691,7 @@ class ATSSLossComputation(torch.nn.Module):
                         assert beg_pos is not None and end_pos is not None
                         map[j, beg_pos : end_pos + 1].fill_(True)
 
-            anchors_per_im = cat_boxlist(anchors[im_i])
+            anchors_per_im = cat_anchors(anchors[im_i])
 
             num_anchors_per_loc = len(self.cfg.MODEL.RPN.ASPECT_RATIOS) * self.cfg.MODEL.RPN.SCALES_PER_OCTAVE
             num_anchors_per_level = [len(anchors_per_level.bbox) for anchors_per_level in anchors[im_i]]
@@ -820,6 +825,147 @@ class ATSSLossComputation(torch.nn.Module):
             positive_indices,
         )
 
+    def prepare_targets_batched(self, targets, anchors, tokenized=None, positive_map=None, proj_tokens=None):
+        """
+        Tensorized version of prepare_targets (MODEL.ATSS.TARGET_ASSIGNMENT = "batched").
+        The ground truths of all images are padded to the same number so that the level-wise top-k,
+        the IoU mean + std threshold and the in-box test of the whole batch are computed at once.
+        Returns the same per-image lists as prepare_targets.
+        """
+        num_images = len(targets)
+        num_anchors_per_loc = len(self.cfg.MODEL.RPN.ASPECT_RATIOS) * self.cfg.MODEL.RPN.SCALES_PER_OCTAVE
+        num_anchors_per_level = [len(anchors_per_level.bbox) for anchors_per_level in anchors[0]]
+        anchors_bbox = torch.stack([cat_anchors(anchors_per_im).bbox for anchors_per_im in anchors], dim=0)
+        device = anchors_bbox.device
+        anchor_num = anchors_bbox.shape[1]
+
+        # pad the ground truths: B x G
+        num_gts = [len(targets_per_im) for targets_per_im in targets]
+        max_gt = max(max(num_gts), 1)
+        gt_boxes = anchors_bbox.new_zeros((num_images, max_gt, 4))
+        gt_labels = torch.zeros((num_images, max_gt), dtype=torch.long, device=device)
+        gt_valid = torch.zeros((num_images, max_gt), dtype=torch.bool, device=device)
+        for im_i, targets_per_im in enumerate(targets):
+            assert targets_per_im.mode == "xyxy"
+            gt_boxes[im_i, : num_gts[im_i]] = targets_per_im.bbox
+            gt_labels[im_i, : num_gts[im_i]] = targets_per_im.get_field("labels")
+            gt_valid[im_i, : num_gts[im_i]] = True
+
+        # IoU between anchors and ground truths: B x A x G (same arithmetic as boxlist_iou)
+        TO_REMOVE = 1
+        area_anchors = (anchors_bbox[..., 2] - anchors_bbox[..., 0] + TO_REMOVE) * (
+            anchors_bbox[..., 3] - anchors_bbox[..., 1] + TO_REMOVE
+        )
+        area_gts = (gt_boxes[..., 2] - gt_boxes[..., 0] + TO_REMOVE) * (gt_boxes[..., 3] - gt_boxes[..., 1] + TO_REMOVE)
+        lt = torch.max(anchors_bbox[:, :, None, :2], gt_boxes[:, None, :, :2])
+        rb = torch.min(anchors_bbox[:, :, None, 2:], gt_boxes[:, None, :, 2:])
+        wh = (rb - lt + TO_REMOVE).clamp(min=0)
+        inter = wh[..., 0] * wh[..., 1]
+        ious = inter / (area_anchors[:, :, None] + area_gts[:, None, :] - inter)
+
+        gt_cx = (gt_boxes[..., 2] + gt_boxes[..., 0]) / 2.0
+        gt_cy = (gt_boxes[..., 3] + gt_boxes[..., 1]) / 2.0
+        anchors_cx = (anchors_bbox[..., 2] + anchors_bbox[..., 0]) / 2.0
+        anchors_cy = (anchors_bbox[..., 3] + anchors_bbox[..., 1]) / 2.0
+        distances = (
+            (anchors_cx[:, :, None] - gt_cx[:, None, :]).pow(2) + (anchors_cy[:, :, None] - gt_cy[:, None, :]).pow(2)
+        ).sqrt()
+
+        # Selecting candidates based on the center distance between anchor box and object: B x K x G
+        candidate_idxs = []
+        star_idx = 0
+        for level in range(len(num_anchors_per_level)):
+            end_idx = star_idx + num_anchors_per_level[level]
+            topk = min(self.cfg.MODEL.ATSS.TOPK * num_anchors_per_loc, num_anchors_per_level[level])
+            _, topk_idxs_per_level = distances[:, star_idx:end_idx, :].topk(topk, dim=1, largest=False)
+            candidate_idxs.append(topk_idxs_per_level + star_idx)
+            star_idx = end_idx
+        candidate_idxs = torch.cat(candidate_idxs, dim=1)
+
+        # Using the sum of mean and standard deviation as the IoU threshold to select final positive samples
+        candidate_ious = ious.gather(1, candidate_idxs)
+        iou_thresh_per_gt = candidate_ious.mean(1) + candidate_ious.std(1)
+        is_pos = candidate_ious >= iou_thresh_per_gt[:, None, :]
+
+        # Limiting the final positive samples’ center to object
+        flat_candidate_idxs = candidate_idxs.view(num_images, -1)
+        candidate_cx = anchors_cx.gather(1, flat_candidate_idxs).view_as(candidate_idxs)
+        candidate_cy = anchors_cy.gather(1, flat_candidate_idxs).view_as(candidate_idxs)
+        l = candidate_cx - gt_boxes[:, None, :, 0]
+        t = candidate_cy - gt_boxes[:, None, :, 1]
+        r = gt_boxes[:, None, :, 2] - candidate_cx
+        b = gt_boxes[:, None, :, 3] - candidate_cy
+        is_in_gts = torch.stack([l, t, r, b], dim=-1).min(dim=-1)[0] > 0.01
+        is_pos = is_pos & is_in_gts & gt_valid[:, None, :]
+
+        # if an anchor box is assigned to multiple gts, the one with the highest IoU will be selected.
+        ious_inf = torch.full_like(ious, -INF)
+        ious_inf.scatter_(1, candidate_idxs, candidate_ious.masked_fill(~is_pos, -INF))
+        anchors_to_gt_values, anchors_to_gt_indexs = ious_inf.max(dim=2)
+        is_unmatched = anchors_to_gt_values == -INF
+        anchors_to_gt_indexs = anchors_to_gt_indexs.masked_fill(is_unmatched, 0)
+
+        cls_labels = gt_labels.gather(1, anchors_to_gt_indexs).masked_fill(is_unmatched, 0)
+        matched_gts = gt_boxes.gather(1, anchors_to_gt_indexs[:, :, None].expand(-1, -1, 4))
+        reg_targets = self.box_coder.encode(matched_gts.view(-1, 4), anchors_bbox.view(-1, 4)).view(
+            num_images, anchor_num, 4
+        )
+
+        token_labels = []
+        if positive_map is not None:
+            num_tokens = positive_map.size(1)
+            padded_positive_map = positive_map.new_zeros((num_images, max_gt, num_tokens))
+            padded_positive_map[gt_valid.to(positive_map.device)] = positive_map
+            padded_positive_map = padded_positive_map.to(device)
+            batch_index = torch.arange(num_images, device=device)[:, None]
+            token_labels = padded_positive_map[batch_index, anchors_to_gt_indexs]
+            unmatched_labels = torch.zeros(num_tokens, dtype=token_labels.dtype, device=device)
+            if not self.cfg.MODEL.DYHEAD.FUSE_CONFIG.MUTE_NOOBJ_TOKEN:
+                unmatched_labels[-1] = 1  # token: none object - > 256
+            token_labels[is_unmatched] = unmatched_labels
+            token_labels = list(token_labels.unbind(0))
+
+        map_labels = []
+        gold_box_od_labels = []
+        od_label_of_tokens_labels = []
+        positive_indices = []
+        if positive_map is not None and proj_tokens is not None:
+            for im_i, targets_per_im in enumerate(targets):
+                if "tokens_positive" in targets_per_im.fields():
+                    cur_tokens = targets_per_im.get_field("tokens_positive")
+                else:
+                    cur_tokens = targets_per_im.get_field("tokens")
+                char_to_token = build_char_to_token_table(tokenized, im_i)
+                map = torch.zeros((max(len(cur_tokens), 1), proj_tokens.shape[1]), dtype=torch.bool)
+                for j, tok_list in enumerate(cur_tokens):
+                    for (beg, end) in tok_list:
+                        beg_pos, end_pos = char_span_to_token_span(char_to_token, beg, end)
+                        if beg_pos is None or end_pos is None:
+                            continue
+                        map[j, beg_pos : end_pos + 1].fill_(True)
+                map_labels_per_im = map.to(device)[anchors_to_gt_indexs[im_i]]
+                map_labels_per_im[is_unmatched[im_i]] = False
+                map_labels.append(map_labels_per_im)
+
+                gold_box_od_label_per_im = targets_per_im.get_field("original_od_label").to(device)
+                gold_box_od_label_per_im = gold_box_od_label_per_im[anchors_to_gt_indexs[im_i]]
+                gold_box_od_label_per_im[is_unmatched[im_i]] = -100
+                gold_box_od_labels.append(gold_box_od_label_per_im)
+
+                od_label_of_tokens_labels.append(targets_per_im.get_field("positive_map_for_od_labels"))
+                # same definition as prepare_targets: anchors whose matched gt index is non-zero
+                positive_indices.append(torch.nonzero(anchors_to_gt_indexs[im_i]).view(-1).tolist())
+
+        return (
+            list(cls_labels.unbind(0)),
+            list(reg_targets.unbind(0)),
+            token_labels,
+            map_labels,
+            gold_box_od_labels,
+            od_label_of_tokens_labels,
+            positive_indices,
+        )
+
     def compute_centerness_targets(self, reg_targets, anchors):
         gts = self.box_coder.decode(reg_targets, anchors)
         anchors_cx = (anchors[:, 2] + anchors[:, 0]) / 2
@@ -853,10 +999,14 @@ class ATSSLossComputation(torch.nn.Module):
         dot_product_logits=None,
         text_masks=None,
         shallow_img_emb_feats=None,
+        tokenized_captions=None,
     ):
 
         tokenized = None
-        if captions is not None:
+        if tokenized_captions is not None:
+            # tokenized by BatchCollator in the dataloader workers, which sends back the offsets but not the encodings
+            tokenized = OffsetsEncoding(tokenized_captions)
+        elif captions is not None:
             # tokenized = self.tokenizer.batch_encode_plus(captions, padding="longest", return_tensors="pt")
             if self.cfg.MODEL.LANGUAGE_BACKBONE.TOKENIZER_TYPE == "clip":
                 tokenized = self.tokenizer.batch_encode_plus(
@@ -877,7 +1027,9 @@ class ATSSLossComputation(torch.nn.Module):
             gold_box_od_labels,
             od_label_of_tokens_labels,
             positive_indices,
-        ) = self.prepare_targets(targets, anchors, tokenized, positive_map, proj_tokens)
+        ) = (self.prepare_targets_batched if self.target_assignment == "batched" else self.prepare_targets)(
+            targets, anchors, tokenized, positive_map, proj_tokens
+        )
 
         N = len(labels)
         box_regression_flatten, box_cls_flatten, token_logits_stacked = concat_box_prediction_layers(
@@ -899,7 +1051,7 @@ class ATSSLossComputation(torch.nn.Module):
 
         labels_flatten = torch.cat(labels, dim=0)
         reg_targets_flatten = torch.cat(reg_targets, dim=0)
-        anchors_flatten = torch.cat([cat_boxlist(anchors_per_image).bbox for anchors_per_image in anchors], dim=0)
+        anchors_flatten = torch.cat([cat_anchors(anchors_per_image).bbox for anchors_per_image in anchors], dim=0)
 
         if positive_map is not None:
             token_labels_stacked = torch.stack(token_labels, dim=0)
@@ -967,7 +1119,7 @@ class ATSSLossComputation(torch.nn.Module):
                     if not self.cfg.MODEL.DYHEAD.FUSE_CONFIG.USE_SHALLOW_ZERO_PADS:
                         for (positive_index, old_positive_index) in zip(new_positive_indices, positive_indices):
                             negative_index = [
-                                i for i in range(len(cat_boxlist(anchors[0]))) if i not in old_positive_index
+                                i for i in range(len(cat_anchors(anchors[0]))) if i not in old_positive_index
                             ]
                             import random
 
@@ -1063,7 +1215,7 @@ class ATSSLossComputation(torch.nn.Module):
                     pooler = ROIAlignV2((1, 1), 1.0 / 16, 0)
                     # get positive features
                     for i in range(bs):
-                        rois = convert_to_roi_format(cat_boxlist(anchors[i])[new_positive_indices[i]])
+                        rois = convert_to_roi_format(cat_anchors(anchors[i])[new_positive_indices[i]])
                         roi_feature = pooler(shallow_img_emb_feats[i].unsqueeze(0), rois)
                         roi_feature = roi_feature.squeeze(-1).squeeze(-1)
                         shallow_contrastive_proj_queries = self.shallow_contrastive_projection_image(roi_feature)
@@ -1081,7 +1233,7 @@ class ATSSLossComputation(torch.nn.Module):
                             )
                         else:
                             # pad negatives
-                            negative_rois = convert_to_roi_format(cat_boxlist(anchors[i])[new_negative_pad_indices[i]])
+                            negative_rois = convert_to_roi_format(cat_anchors(anchors[i])[new_negative_pad_indices[i]])
                             negative_roi_feature = pooler(shallow_img_emb_feats[i].unsqueeze(0), negative_rois)
                             negative_roi_feature = negative_roi_feature.squeeze(-1).squeeze(-1)
                             negative_shallow_contrastive_proj_queries = self.shallow_contrastive_projection_image(
@@ -373,6 +373,7 @@ class VLFuse(torch.nn.Module):
         super(VLFuse, self).__init__()
         self.init_configs(cfg)
         self.cfg = cfg
+        self.fused_levels = cfg.MODEL.DYHEAD.FUSE_CONFIG.FUSED_LEVELS
 
         self.use_checkpoint = False
         if hasattr(cfg.MODEL.DYHEAD, "USE_CHECKPOINT"):
@@ -500,6 +501,42 @@ class VLFuse(torch.nn.Module):
             fused_visual_features = [q0, q1, q2, q3, q4]
             fused_language_dict_features = language_dict_features
 
+        elif self.cfg.MODEL.DYHEAD.FUSE_CONFIG.TYPE == "MHA-B" and self.fused_levels:
+            # all the levels as a single sequence of image tokens: bs, sum(h * w), C
+            level_shapes = [tuple(feat.shape[-2:]) for feat in visual_features]
+            level_sizes = tuple(h * w for h, w in level_shapes)
+            visual_features_flatten = torch.cat([feat.flatten(2) for feat in visual_features], dim=2).transpose(1, 2)
+            if self.use_checkpoint:
+                new_v, new_l = checkpoint.checkpoint(
+                    self.b_attn.fused_levels_call,
+                    visual_features_flatten,
+                    language_dict_features["hidden"],
+                    level_sizes,
+                    language_dict_features["masks"],
+                    self.dummy_tensor,
+                )
+            else:
+                new_v, new_l = self.b_attn.fused_levels_call(
+                    visual_features_flatten,
+                    language_dict_features["hidden"],
+                    level_sizes,
+                    language_dict_features["masks"],
+                    self.dummy_tensor,
+                )
+
+            fused_visual_features = [
+                feat.transpose(1, 2).reshape(batch_size, -1, h, w)
+                for feat, (h, w) in zip(new_v.split(level_sizes, dim=1), level_shapes)
+            ]
+            if (
+                self.cfg.MODEL.DYHEAD.FUSE_CONFIG.SEPARATE_BIDIRECTIONAL
+                and self.cfg.MODEL.DYHEAD.FUSE_CONFIG.DO_LANG_PROJ_OUTSIDE_CHECKPOINT
+            ):
+                new_l = self.shrink_lang(new_l)
+
+            language_dict_features["hidden"] = new_l
+            fused_language_dict_features = language_dict_features
+
         elif self.cfg.MODEL.DYHEAD.FUSE_CONFIG.TYPE == "MHA-B":
             if self.use_checkpoint:
                 q0, q1, q2, q3, q4, l0, l1, l2, l3, l4 = checkpoint.checkpoint(
@@ -954,6 +991,7 @@ class VLDyHeadModule(torch.nn.Module):
         positive_map=None,
         captions=None,
         swint_feature_c4=None,
+        tokenized_captions=None,
     ):
 
         if self.cfg.MODEL.DYHEAD.FUSE_CONFIG.USE_CONTRASTIVE_ALIGN_LOSS:
@@ -1010,6 +1048,7 @@ class VLDyHeadModule(torch.nn.Module):
                 mlm_labels=language_dict_features["mlm_labels"],
                 shallow_img_emb_feats=shallow_img_emb_feats,
                 fused_visual_features=fused_visual_features,
+                tokenized_captions=tokenized_captions,
             )
         else:
             return self._forward_test(
@@ -1041,6 +1080,7 @@ class VLDyHeadModule(torch.nn.Module):
         mlm_labels=None,
         shallow_img_emb_feats=None,
         fused_visual_features=None,
+        tokenized_captions=None,
     ):
 
         (
@@ -1065,6 +1105,7 @@ class VLDyHeadModule(torch.nn.Module):
             dot_product_logits,
             text_masks,
             shallow_img_emb_feats,
+            tokenized_captions=tokenized_captions,
         )
 
         losses = {
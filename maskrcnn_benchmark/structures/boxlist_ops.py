@@ -53,17 +53,7 @@ def boxlist_ml_nms(boxlist, nms_thresh, max_proposals=-1, score_field="scores",
     labels = boxlist.get_field(label_field)
 
     if boxes.device == torch.device("cpu"):
-        keep = []
-        unique_labels = torch.unique(labels)
-        print(unique_labels)
-        for j in unique_labels:
-            inds = (labels == j).nonzero().view(-1)
-
-            scores_j = scores[inds]
-            boxes_j = boxes[inds, :].view(-1, 4)
-            keep_j = _box_nms(boxes_j, scores_j, nms_thresh)
-
-            keep += keep_j
+        keep = batched_ml_nms_cpu(boxes, scores, labels, nms_thresh)
     else:
         keep = _box_ml_nms(boxes, scores, labels.float(), nms_thresh)
 
@@ -74,6 +64,37 @@ def boxlist_ml_nms(boxlist, nms_thresh, max_proposals=-1, score_field="scores",
     return boxlist.convert(mode)
 
 
+def batched_ml_nms_cpu(boxes, scores, labels, nms_thresh, max_boxes_per_call=500):
+    """
+    Multi-class NMS with few nms calls: the boxes of each label are shifted by label * (extent of all the
+    boxes + 1), so that boxes with different labels never overlap and many labels are suppressed in one call.
+    The shifted coordinates are computed in float64 to keep the IoUs of boxes with the same label exact.
+    As the cost of a call grows quadratically with its number of boxes, the labels are split into groups of
+    about max_boxes_per_call boxes, one call per group.
+
+    Returns the indices of the kept boxes sorted by decreasing score, as ml_nms on GPU.
+    """
+    if boxes.numel() == 0:
+        return torch.empty((0,), dtype=torch.int64, device=boxes.device)
+    boxes = boxes.double()
+    boxes = boxes - boxes.min()
+    offsets = labels.to(boxes) * (boxes.max() + 1)
+    boxes = boxes + offsets[:, None]
+    scores = scores.double()
+    if len(boxes) <= max_boxes_per_call:
+        return _box_nms(boxes, scores, nms_thresh)
+
+    unique_labels, label_inds, counts = torch.unique(labels, return_inverse=True, return_counts=True)
+    label_groups = (torch.cumsum(counts, dim=0) - 1) // max_boxes_per_call
+    box_groups = label_groups[label_inds]
+    keep = []
+    for group in torch.unique(label_groups):
+        inds = (box_groups == group).nonzero().view(-1)
+        keep.append(inds[_box_nms(boxes[inds], scores[inds], nms_thresh)])
+    keep = torch.cat(keep)
+    return keep[scores[keep].argsort(descending=True)]
+
+
 def remove_small_boxes(boxlist, min_size):
     """
     Only keep boxes with both sides >= min_size
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint as checkpoint
 import pdb
 import math
 from maskrcnn_benchmark.modeling.utils import cat, concat_box_prediction_layers, permute_and_flatten
@@ -209,6 +210,7 @@ class BiMultiHeadAttention(nn.Module):
         self.stable_softmax_2d = cfg.MODEL.DYHEAD.FUSE_CONFIG.STABLE_SOFTMAX_2D
         self.clamp_min_for_underflow = cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MIN_FOR_UNDERFLOW
         self.clamp_max_for_overflow = cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MAX_FOR_OVERFLOW
+        self.chunk_size = cfg.MODEL.DYHEAD.FUSE_CONFIG.BI_ATTN_CHUNK_SIZE
 
         self._reset_parameters()
 
@@ -229,7 +231,12 @@ class BiMultiHeadAttention(nn.Module):
         nn.init.xavier_uniform_(self.out_l_proj.weight)
         self.out_l_proj.bias.data.fill_(0)
 
-    def forward(self, v, l, attention_mask_l=None):
+    def forward(self, v, l, attention_mask_l=None, level_sizes=None):
+        """
+        level_sizes: number of image tokens of each level when v holds several levels (bsz, sum(level_sizes), C)
+        whose text->image attention is computed separately. The language output is then of shape
+        (bsz, num_levels, src_len, l_dim).
+        """
         bsz, tgt_len, embed_dim = v.size()
 
         query_states = self.v_proj(v) * self.scale
@@ -244,6 +251,12 @@ class BiMultiHeadAttention(nn.Module):
         value_l_states = value_l_states.view(*proj_shape)
 
         src_len = key_states.size(1)
+        if level_sizes is None and 0 < self.chunk_size < tgt_len:
+            attn_output_v, attn_output_l = self._chunked_attention(
+                query_states, key_states, value_v_states, value_l_states, attention_mask_l
+            )
+            return self._output_projection(attn_output_v, attn_output_l, bsz, tgt_len, src_len)
+
         attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
 
         if attn_weights.size() != (bsz * self.num_heads, tgt_len, src_len):
@@ -266,17 +279,11 @@ class BiMultiHeadAttention(nn.Module):
             )  # Do not increase 50000, data type half has quite limited range
 
         attn_weights_T = attn_weights.transpose(1, 2)
-        attn_weights_l = attn_weights_T - torch.max(attn_weights_T, dim=-1, keepdim=True)[0]
-        if self.clamp_min_for_underflow:
-            attn_weights_l = torch.clamp(
-                attn_weights_l, min=-50000
-            )  # Do not increase -50000, data type half has quite limited range
-        if self.clamp_max_for_overflow:
-            attn_weights_l = torch.clamp(
-                attn_weights_l, max=50000
-            )  # Do not increase 50000, data type half has quite limited range
-
-        attn_weights_l = attn_weights_l.softmax(dim=-1)
+        if level_sizes is None:
+            attn_weights_l = self._text_to_image_softmax(attn_weights_T)
+        else:
+            # one softmax per level, over the image tokens of that level
+            attn_weights_l = [self._text_to_image_softmax(w) for w in attn_weights_T.split(level_sizes, dim=-1)]
 
         if attention_mask_l is not None:
             assert attention_mask_l.dim() == 2
@@ -292,11 +299,29 @@ class BiMultiHeadAttention(nn.Module):
         attn_weights_v = nn.functional.softmax(attn_weights, dim=-1)
 
         attn_probs_v = F.dropout(attn_weights_v, p=self.dropout, training=self.training)
-        attn_probs_l = F.dropout(attn_weights_l, p=self.dropout, training=self.training)
-
         attn_output_v = torch.bmm(attn_probs_v, value_l_states)
-        attn_output_l = torch.bmm(attn_probs_l, value_v_states)
 
+        if level_sizes is None:
+            attn_probs_l = F.dropout(attn_weights_l, p=self.dropout, training=self.training)
+            attn_output_l = torch.bmm(attn_probs_l, value_v_states)
+            return self._output_projection(attn_output_v, attn_output_l, bsz, tgt_len, src_len)
+
+        # the levels are projected together as a sequence of num_levels * src_len text tokens
+        attn_output_l = torch.cat(
+            [
+                torch.bmm(F.dropout(attn_weights_l_per_level, p=self.dropout, training=self.training), value_v_per_level)
+                for attn_weights_l_per_level, value_v_per_level in zip(
+                    attn_weights_l, value_v_states.split(level_sizes, dim=1)
+                )
+            ],
+            dim=1,
+        )
+        attn_output_v, attn_output_l = self._output_projection(
+            attn_output_v, attn_output_l, bsz, tgt_len, len(level_sizes) * src_len
+        )
+        return attn_output_v, attn_output_l.view(bsz, len(level_sizes), src_len, -1)
+
+    def _output_projection(self, attn_output_v, attn_output_l, bsz, tgt_len, src_len):
         if attn_output_v.size() != (bsz * self.num_heads, tgt_len, self.head_dim):
             raise ValueError(
                 f"`attn_output_v` should be of size {(bsz, self.num_heads, tgt_len, self.head_dim)}, but is {attn_output_v.size()}"
@@ -320,6 +345,108 @@ class BiMultiHeadAttention(nn.Module):
 
         return attn_output_v, attn_output_l
 
+    def _clamp(self, attn_weights):
+        if self.clamp_min_for_underflow:
+            attn_weights = torch.clamp(
+                attn_weights, min=-50000
+            )  # Do not increase -50000, data type half has quite limited range
+        if self.clamp_max_for_overflow:
+            attn_weights = torch.clamp(
+                attn_weights, max=50000
+            )  # Do not increase 50000, data type half has quite limited range
+        return attn_weights
+
+    def _text_to_image_softmax(self, attn_weights_T):
+        attn_weights_l = attn_weights_T - torch.max(attn_weights_T, dim=-1, keepdim=True)[0]
+        return self._clamp(attn_weights_l).softmax(dim=-1)
+
+    def _attention_chunk(self, query_states, key_states, value_v_states, value_l_states, attention_mask, shift):
+        """
+        Attention of a chunk of the image tokens: the image->text output of these tokens, and the partial
+        text->image softmax statistics over them (max, sum of exp and exp-weighted values, per text token).
+        """
+        bsz_heads, chunk_len, _ = query_states.shape
+        attn_weights = torch.bmm(query_states, key_states.transpose(1, 2))
+        if shift is not None:
+            attn_weights = attn_weights - shift
+        attn_weights = self._clamp(attn_weights)
+
+        # text->image, the softmax over the image tokens is completed across chunks in _chunked_attention
+        attn_weights_T = attn_weights.transpose(1, 2)
+        chunk_max = attn_weights_T.max(dim=-1, keepdim=True)[0].float()
+        exp_weights_l = (attn_weights_T.float() - chunk_max).exp()
+        chunk_sum = exp_weights_l.sum(dim=-1, keepdim=True)
+        exp_probs_l = F.dropout(exp_weights_l, p=self.dropout, training=self.training)
+        chunk_output_l = torch.bmm(exp_probs_l.to(value_v_states.dtype), value_v_states).float()
+
+        # image->text, complete for this chunk
+        if attention_mask is not None:
+            attn_weights = attn_weights.view(-1, self.num_heads, chunk_len, attn_weights.size(-1)) + attention_mask
+            attn_weights = attn_weights.view(bsz_heads, chunk_len, -1)
+        attn_probs_v = F.dropout(attn_weights.softmax(dim=-1), p=self.dropout, training=self.training)
+        chunk_output_v = torch.bmm(attn_probs_v, value_l_states)
+
+        return chunk_output_v, chunk_max, chunk_sum, chunk_output_l
+
+    def _chunked_attention(self, query_states, key_states, value_v_states, value_l_states, attention_mask_l):
+        """
+        Same outputs as the full attention of forward, computed over chunks of chunk_size image tokens so that
+        the (bsz * num_heads, tgt_len, src_len) attention matrix is never held as a whole. The text->image softmax
+        is accumulated online; in training, every chunk is checkpointed and recomputed in the backward pass.
+        """
+        tgt_len = query_states.size(1)
+
+        shift = None
+        if self.stable_softmax_2d:
+            # the global max only matters through the clamps, it does not need gradients
+            with torch.no_grad():
+                shift = max(
+                    torch.bmm(query_states[:, start : start + self.chunk_size], key_states.transpose(1, 2)).max()
+                    for start in range(0, tgt_len, self.chunk_size)
+                )
+
+        attention_mask = None
+        if attention_mask_l is not None:
+            assert attention_mask_l.dim() == 2
+            # (bsz, 1, 1, src_len), broadcast instead of expanded to (bsz, 1, tgt_len, src_len)
+            attention_mask = attention_mask_l.unsqueeze(1).unsqueeze(1)
+            attention_mask = attention_mask.masked_fill(attention_mask == 0, -9e15)
+
+        use_checkpoint = self.training and torch.is_grad_enabled()
+        attn_output_v = []
+        running_max, running_sum, attn_output_l = None, None, None
+        for start in range(0, tgt_len, self.chunk_size):
+            end = min(start + self.chunk_size, tgt_len)
+            args = (
+                query_states[:, start:end],
+                key_states,
+                value_v_states[:, start:end],
+                value_l_states,
+                attention_mask,
+                shift,
+            )
+            if use_checkpoint:
+                chunk_output_v, chunk_max, chunk_sum, chunk_output_l = checkpoint.checkpoint(
+                    self._attention_chunk, *args
+                )
+            else:
+                chunk_output_v, chunk_max, chunk_sum, chunk_output_l = self._attention_chunk(*args)
+            attn_output_v.append(chunk_output_v)
+
+            if running_max is None:
+                running_max, running_sum, attn_output_l = chunk_max, chunk_sum, chunk_output_l
+            else:
+                new_max = torch.max(running_max, chunk_max)
+                old_scale = (running_max - new_max).exp()
+                chunk_scale = (chunk_max - new_max).exp()
+                running_sum = running_sum * old_scale + chunk_sum * chunk_scale
+                attn_output_l = attn_output_l * old_scale + chunk_output_l * chunk_scale
+                running_max = new_max
+
+        attn_output_v = torch.cat(attn_output_v, dim=1)
+        attn_output_l = (attn_output_l / running_sum).to(attn_output_v.dtype)
+        return attn_output_v, attn_output_l
+
 
 # Bi-Direction MHA (text->image, image->text)
 class BiAttentionBlock(nn.Module):
@@ -468,6 +595,30 @@ class BiAttentionBlockForCheckpoint(nn.Module):
         l = l + self.drop_path(self.gamma_l * delta_l)
         return v, l
 
+    def fused_levels_call(self, v, l, level_sizes, attention_mask_l=None, dummy_tensor=None):
+        """
+        Same as forward, on the image tokens of all the levels flattened in v (bs, sum(level_sizes), C)
+        and with a single attention call. With SEPARATE_BIDIRECTIONAL, the text->image attention is still
+        computed per level and the language features of the levels are merged by shrink_lang, or returned
+        concatenated (bs, seq_len, num_levels * C) with DO_LANG_PROJ_OUTSIDE_CHECKPOINT.
+        """
+        separate_bidirectional = self.cfg.MODEL.DYHEAD.FUSE_CONFIG.SEPARATE_BIDIRECTIONAL
+        v = self.layer_norm_v(v)
+        l = self.layer_norm_l(l)
+        delta_v, delta_l = self.attn(
+            v, l, attention_mask_l=attention_mask_l, level_sizes=level_sizes if separate_bidirectional else None
+        )
+        v = v + self.drop_path(self.gamma_v * delta_v)
+        if not separate_bidirectional:
+            return v, l + self.drop_path(self.gamma_l * delta_l)
+
+        l = l.unsqueeze(1) + self.drop_path(self.gamma_l * delta_l)
+        # bs, num_levels, seq_len, C -> bs, seq_len, num_levels * C, i.e. the levels concatenated
+        l = l.permute(0, 2, 1, 3).flatten(2)
+        if not self.cfg.MODEL.DYHEAD.FUSE_CONFIG.DO_LANG_PROJ_OUTSIDE_CHECKPOINT:
+            l = self.shrink_lang(l)
+        return v, l
+
 
 # Single Direction MHA
 class MultiHeadAttention(nn.Module):
@@ -90,6 +90,74 @@ def all_gather(data):
     return data_list
 
 
+def _gather_padded(tensor, size_list, dst, group):
+    # torch gather does not support tensors of different shapes either: pad to the largest size
+    padded = tensor.new_zeros((max(size_list),) + tuple(tensor.shape[1:]))
+    padded[: tensor.shape[0]] = tensor
+    gather_list = [torch.empty_like(padded) for _ in size_list] if get_rank() == dst else None
+    dist.gather(padded, gather_list, dst=dst, group=group)
+    if gather_list is None:
+        return None
+    return [t[:size].cpu() for size, t in zip(size_list, gather_list)]
+
+
+def _gather_chunked(tensor, size_list, dst, chunk_rows, device, group):
+    # point to point in chunks of chunk_rows: only one chunk at a time is on the device, on the sender and on dst
+    if get_rank() != dst:
+        for start in range(0, tensor.shape[0], chunk_rows):
+            dist.send(tensor[start : start + chunk_rows].to(device).contiguous(), dst, group=group)
+        return None
+    tensor_list = []
+    for src, size in enumerate(size_list):
+        if src == dst:
+            tensor_list.append(tensor.cpu())
+            continue
+        received = torch.empty((size,) + tuple(tensor.shape[1:]), dtype=tensor.dtype)
+        buffer = torch.empty((min(chunk_rows, size),) + tuple(tensor.shape[1:]), dtype=tensor.dtype, device=device)
+        for start in range(0, size, chunk_rows):
+            chunk = buffer[: min(chunk_rows, size - start)]
+            dist.recv(chunk, src, group=group)
+            received[start : start + chunk.shape[0]] = chunk.cpu()
+        tensor_list.append(received)
+    return tensor_list
+
+
+def gather_tensor(tensor, dst=0, chunk_bytes=64 * 1024 ** 2):
+    """
+    Gather tensors whose first dimension may differ across ranks (the other dimensions and the dtype must match)
+    to rank dst only, the other ranks keep nothing but their own tensor. Unlike all_gather, the data is not pickled.
+    NCCL has no gather (before torch 1.11), so there the tensors are sent in chunks of at most chunk_bytes.
+    Args:
+        tensor: a tensor
+    Returns:
+        list[Tensor]: on dst, list of (cpu) tensors gathered from each rank; None on the other ranks
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return [tensor.cpu()]
+
+    cpu_group = None
+    if os.getenv("MDETR_CPU_REDUCE") == "1":
+        cpu_group = _get_global_gloo_group()
+    nccl = dist.get_backend(cpu_group) == "nccl"
+    device = "cuda" if nccl else "cpu"
+
+    # obtain Tensor size of each rank
+    local_size = torch.tensor([tensor.shape[0]], device=device, dtype=torch.long)
+    size_list = [torch.tensor([0], device=device, dtype=torch.long) for _ in range(world_size)]
+    dist.all_gather(size_list, local_size, group=cpu_group)
+    size_list = [int(size.item()) for size in size_list]
+
+    if not nccl:
+        return _gather_padded(tensor.cpu(), size_list, dst, cpu_group)
+    # from the row shape only, so that all the ranks agree on the chunks
+    row_bytes = tensor.element_size()
+    for dim in tensor.shape[1:]:
+        row_bytes *= dim
+    chunk_rows = max(chunk_bytes // max(row_bytes, 1), 1)
+    return _gather_chunked(tensor.cpu(), size_list, dst, chunk_rows, device, cpu_group)
+
+
 def reduce_dict(input_dict, average=True):
     """
     Args:
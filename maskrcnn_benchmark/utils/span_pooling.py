@@ -0,0 +1,150 @@
+"""
+Span pooling for MODEL.DYHEAD.FUSE_CONFIG.SPAN_VERSION "v2*": the captions are split into pieces around their
+spans, the pieces are encoded by the language backbone, and every span is represented by the mean (or max) of the
+embeddings of its tokens.
+
+The spans of a batch are handled as flat LongTensors (one entry per span) instead of nested lists:
+    split_captions_by_spans  caption pieces and char spans relative to them (no tokenizer needed)
+    add_span_token_ranges    char spans -> token ranges, can run in the dataloader workers (BatchCollator)
+    pool_span_features       (batch, max_span_num, C) span features and masks with a single scatter_reduce
+"""
+import torch
+
+from maskrcnn_benchmark.utils.token_offsets import build_char_to_token_table, char_spans_to_token_spans
+
+
+def split_captions_by_spans(captions, spans, independent=False):
+    """
+    spans[i]: list of groups of char spans (beg, end) of captions[i], (-1, -1) for padding. Each group is cut out of
+    the caption as one piece (each span with independent=True). Returns a dict with:
+        captions         the caption pieces, plus the whole caption of the instances without spans
+        caption_index    (batch,) index in captions of the instances without spans, -1 for the others
+        span_batch, span_position, span_caption, span_char_beg, span_char_end
+                         (num_spans,) instance, position among the (flattened) spans of the instance,
+                         caption piece and char span in that piece of every span, -1 for padding spans
+    """
+    new_captions = []
+    caption_index = []
+    span_batch, span_position, span_caption, span_char_beg, span_char_end = [], [], [], [], []
+    for i, (caption, spans_i) in enumerate(zip(captions, spans)):
+        if len(spans_i) == 0:  # this instance does not have spans
+            caption_index.append(len(new_captions))
+            new_captions.append(caption)
+            continue
+        caption_index.append(-1)
+
+        position = 0
+        for group in spans_i:
+            valid_spans = [span for span in group if span[0] != -1]
+            if not independent and len(valid_spans) > 0:
+                start, end = valid_spans[0][0], valid_spans[-1][-1]
+                piece = len(new_captions)
+                new_captions.append(caption[start:end])
+            for span in group:
+                span_batch.append(i)
+                span_position.append(position)
+                position += 1
+                if span[0] == -1:
+                    span_caption.append(-1)
+                    span_char_beg.append(-1)
+                    span_char_end.append(-1)
+                elif independent:
+                    span_caption.append(len(new_captions))
+                    new_captions.append(caption[span[0] : span[1]])
+                    span_char_beg.append(0)
+                    span_char_end.append(span[1] - span[0])
+                else:
+                    # char spans relative to the piece
+                    span_caption.append(piece)
+                    span_char_beg.append(span[0] - start)
+                    span_char_end.append(span[1] - start)
+
+    as_long = lambda x: torch.as_tensor(x, dtype=torch.long)
+    return {
+        "captions": new_captions,
+        "caption_index": as_long(caption_index),
+        "span_batch": as_long(span_batch),
+        "span_position": as_long(span_position),
+        "span_caption": as_long(span_caption),
+        "span_char_beg": as_long(span_char_beg),
+        "span_char_end": as_long(span_char_end),
+    }
+
+
+def add_span_token_ranges(span_split, tokenized):
+    """
+    Adds span_token_start / span_token_end (end excluded, -1 if the span cannot be mapped) to span_split, from the
+    tokenization of span_split["captions"] by a fast tokenizer (with the same relaxation as char_to_token).
+    """
+    span_caption = span_split["span_caption"]
+    token_start = torch.full_like(span_caption, -1)
+    token_end = torch.full_like(span_caption, -1)
+    valid = span_split["span_char_beg"] >= 0
+    for caption in torch.unique(span_caption[valid]).tolist():
+        in_caption = (valid & (span_caption == caption)).nonzero().view(-1)
+        table = build_char_to_token_table(tokenized, caption)
+        beg_pos, end_pos = char_spans_to_token_spans(
+            table, span_split["span_char_beg"][in_caption], span_split["span_char_end"][in_caption]
+        )
+        mapped = (beg_pos >= 0) & (end_pos >= 0)
+        token_start[in_caption[mapped]] = beg_pos[mapped]
+        token_end[in_caption[mapped]] = end_pos[mapped] + 1
+    span_split["span_token_start"] = token_start
+    span_split["span_token_end"] = token_end
+    return span_split
+
+
+def pool_span_features(embedding, attention_mask, span_split, pooling="mean"):
+    """
+    embedding: (num_captions, seq_len, C) language features of span_split["captions"], attention_mask: their mask.
+    Returns span_features (batch, max_span_num, C) and span_masks (batch, max_span_num): the pooled tokens of every
+    span (masked out if it could not be mapped to tokens, and then pooled over the whole caption piece; zero for
+    padding spans), or, for the instances without spans, their token features and attention mask.
+    """
+    device = embedding.device
+    num_captions, seq_len, dim = embedding.shape
+    span_batch = span_split["span_batch"].to(device)
+    span_position = span_split["span_position"].to(device)
+    span_caption = span_split["span_caption"].to(device)
+    token_start = span_split["span_token_start"].to(device)
+    token_end = span_split["span_token_end"].to(device)
+    caption_index = span_split["caption_index"].to(device)
+    batch_size = len(caption_index)
+
+    # the instances without spans use their tokens as spans
+    no_spans = (caption_index >= 0).nonzero().view(-1)
+    text_lengths = attention_mask[caption_index[no_spans]].sum(dim=-1)
+    num_spans = torch.bincount(span_batch, minlength=batch_size)
+    max_span_num = max(
+        int(num_spans.max()) if len(span_batch) else 0,
+        int(text_lengths.max()) if len(no_spans) else 0,
+    )
+
+    # Step 1. flat (span, token) pairs
+    mapped = (token_start >= 0) & (token_end >= 0)
+    start = token_start.masked_fill(~mapped, 0)
+    end = token_end.masked_fill(~mapped, seq_len).clamp(max=seq_len)
+    lengths = (end - start).clamp(min=0).masked_fill(span_caption < 0, 0)
+    pair_span = torch.repeat_interleave(torch.arange(len(lengths), device=device), lengths)
+    pair_offset = torch.arange(len(pair_span), device=device) - (lengths.cumsum(0) - lengths)[pair_span]
+    pair_features = embedding[span_caption[pair_span], start[pair_span] + pair_offset]
+
+    # Step 2. segment pooling
+    reduce = {"mean": "mean", "max": "amax"}[pooling]
+    pooled = embedding.new_zeros((len(lengths), dim)).scatter_reduce(
+        0, pair_span.unsqueeze(1).expand(-1, dim), pair_features, reduce=reduce, include_self=False
+    )
+
+    # Step 3. batch the spans
+    span_features = embedding.new_zeros((batch_size, max_span_num, dim))
+    span_masks = torch.zeros((batch_size, max_span_num), dtype=torch.long, device=device)
+    span_features[span_batch, span_position] = pooled
+    span_masks[span_batch, span_position] = mapped.long()
+
+    if len(no_spans):
+        length = min(max_span_num, seq_len)
+        span_features[no_spans, :length] = embedding[caption_index[no_spans], :length]
+        text_masks = attention_mask[caption_index[no_spans], :length].long()
+        in_text = torch.arange(length, device=device).unsqueeze(0) < text_lengths.unsqueeze(1)
+        span_masks[no_spans, :length] = text_masks * in_text
+    return span_features, span_masks
@@ -0,0 +1,152 @@
+"""
+Char -> token lookup tables built once per caption from the offsets of a fast tokenizer.
+
+They replace repeated calls to `tokenized.char_to_token` (one per span boundary, plus the
+`beg + 1`, `beg + 2`, `end - 2`, `end - 3` retries) with array lookups. They can also be built from the
+plain dict of BatchCollator.tokenize, which has the offset_mapping but not the encodings.
+"""
+from collections import defaultdict
+
+import torch
+
+
+def build_char_to_token_table(tokenized, batch_index=0):
+    """
+    Returns a LongTensor `table` such that `table[c]` is the index of the token containing
+    character `c` of the `batch_index`-th caption, or -1 where char_to_token would return None.
+    Requires the output of a fast (Rust) tokenizer, or a dict with its offset_mapping and special_tokens_mask.
+    """
+    if getattr(tokenized, "encodings", None) is not None:
+        encoding = tokenized.encodings[batch_index]
+        offsets = encoding.offsets
+        sequence_ids = encoding.sequence_ids
+    else:
+        # the captions are single sequences: the tokens of the text are the ones which are not special
+        offsets = [tuple(offset) for offset in tokenized["offset_mapping"][batch_index].tolist()]
+        special_tokens_mask = tokenized["special_tokens_mask"][batch_index].tolist()
+        sequence_ids = [None if special else 0 for special in special_tokens_mask]
+    num_chars = max([end for (beg, end) in offsets], default=0)
+    table = torch.full((num_chars,), -1, dtype=torch.long)
+    # iterate backwards so that the first token covering a character wins, as in char_to_token
+    for token_index in range(len(offsets) - 1, -1, -1):
+        beg, end = offsets[token_index]
+        if end > beg and sequence_ids[token_index] == 0:
+            table[beg:end] = token_index
+    return table
+
+
+def _lookup(table, c):
+    if 0 <= c < len(table):
+        token = int(table[c])
+        return None if token < 0 else token
+    return None
+
+
+class OffsetsEncoding(object):
+    """
+    Gives the char_to_token of a BatchEncoding to the plain dict of BatchCollator.tokenize, from its offset_mapping.
+    The table of each caption is built on its first lookup.
+    """
+
+    def __init__(self, tokenized):
+        self.tokenized = tokenized
+        self._tables = {}
+
+    def __getitem__(self, key):
+        return self.tokenized[key]
+
+    def char_to_token(self, batch_index, char_index):
+        if batch_index not in self._tables:
+            self._tables[batch_index] = build_char_to_token_table(self.tokenized, batch_index)
+        return _lookup(self._tables[batch_index], char_index)
+
+
+def char_span_to_token_span(table, beg, end):
+    """
+    Token range [beg_pos, end_pos] (inclusive) covering the char span [beg, end), with the same relaxation as
+    the char_to_token based code: try beg, beg + 1, beg + 2 for the start and end - 1, end - 2, end - 3 for the
+    end. Returns (None, None) if the span cannot be mapped.
+    """
+    beg_pos = _lookup(table, beg)
+    if beg_pos is None:
+        beg_pos = _lookup(table, beg + 1)
+        if beg_pos is None:
+            beg_pos = _lookup(table, beg + 2)
+    end_pos = _lookup(table, end - 1)
+    if end_pos is None:
+        end_pos = _lookup(table, end - 2)
+        if end_pos is None:
+            end_pos = _lookup(table, end - 3)
+    if beg_pos is None or end_pos is None:
+        return None, None
+    return beg_pos, end_pos
+
+
+def _lookup_many(table, chars):
+    tokens = torch.full_like(chars, -1)
+    valid = (chars >= 0) & (chars < len(table))
+    tokens[valid] = table[chars[valid]]
+    return tokens
+
+
+def char_spans_to_token_spans(table, begs, ends):
+    """
+    Vectorized char_span_to_token_span for LongTensors of char spans. Returns the LongTensors (beg_pos, end_pos),
+    -1 where a span boundary cannot be mapped.
+    """
+    beg_pos = _lookup_many(table, begs)
+    for shift in (1, 2):
+        missing = beg_pos < 0
+        beg_pos[missing] = _lookup_many(table, begs[missing] + shift)
+    end_pos = _lookup_many(table, ends - 1)
+    for shift in (2, 3):
+        missing = end_pos < 0
+        end_pos[missing] = _lookup_many(table, ends[missing] - shift)
+    return beg_pos, end_pos
+
+
+def map_char_spans(tokenized, tokens_positive, batch_index=0):
+    """
+    tokens_positive: list (one entry per box / label) of lists of char spans (beg, end).
+    Returns LongTensors (rows, beg_pos, end_pos) of the spans that can be mapped to tokens, in the order of
+    tokens_positive; spans with negative chars are skipped.
+    """
+    spans = [(row, span[0], span[1]) for row, tok_list in enumerate(tokens_positive) for span in tok_list]
+    spans = torch.as_tensor(spans, dtype=torch.long).view(-1, 3)
+    spans = spans[(spans[:, 1] >= 0) & (spans[:, 2] >= 0)]
+    table = build_char_to_token_table(tokenized, batch_index)
+    beg_pos, end_pos = char_spans_to_token_spans(table, spans[:, 1], spans[:, 2])
+    mapped = (beg_pos >= 0) & (end_pos >= 0)
+    return spans[mapped, 0], beg_pos[mapped], end_pos[mapped]
+
+
+def build_positive_map(tokenized, tokens_positive, num_tokens=256, batch_index=0):
+    """
+    Float map of shape (len(tokens_positive), num_tokens), with positive_map[i, j] = 1 iff token j is in one of the
+    spans of tokens_positive[i] (not normalized). All the spans are written at once: +1 at the first token and -1
+    after the last token of each span, then a cumulative sum along the tokens.
+    """
+    rows, beg_pos, end_pos = map_char_spans(tokenized, tokens_positive, batch_index)
+    # same as positive_map[row, beg_pos : end_pos + 1] = 1, which ignores empty and out of range slices
+    keep = (beg_pos <= end_pos) & (beg_pos < num_tokens)
+    rows, beg_pos, end_pos = rows[keep], beg_pos[keep], end_pos[keep].clamp(max=num_tokens - 1)
+    delta = torch.zeros((len(tokens_positive), num_tokens + 1), dtype=torch.float)
+    ones = torch.ones(len(rows), dtype=torch.float)
+    delta.index_put_((rows, beg_pos), ones, accumulate=True)
+    delta.index_put_((rows, end_pos + 1), -ones, accumulate=True)
+    return (delta.cumsum(dim=-1)[:, :num_tokens] > 0).float()
+
+
+def build_positive_dict(tokenized, tokens_positive, labels, batch_index=0):
+    """
+    Returns (positive_map, positive_map_label_to_token): positive_map[i] = labels[j] iff token i is in a span of
+    tokens_positive[j] (the last such j wins), positive_map_label_to_token[labels[j]] lists the tokens of those spans.
+    """
+    positive_map = defaultdict(int)
+    positive_map_label_to_token = defaultdict(list)
+    rows, beg_pos, end_pos = map_char_spans(tokenized, tokens_positive, batch_index)
+    for j, beg, end in zip(rows.tolist(), beg_pos.tolist(), end_pos.tolist()):
+        for i in range(beg, end + 1):
+            positive_map[i] = labels[j]
+            positive_map_label_to_token[labels[j]].append(i)
+    return positive_map, positive_map_label_to_token
@@ -0,0 +1,110 @@
+r"""
+Parity check and CPU peak memory of BiMultiHeadAttention (maskrcnn_benchmark/utils/fuse_helper.py) with the full
+attention matrix and with MODEL.DYHEAD.FUSE_CONFIG.BI_ATTN_CHUNK_SIZE, on the flattened FPN levels of an image.
+
+    python tools/benchmark_bi_attention.py --image-size 800 1333 --chunk-sizes 1024 4096
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+
+import torch
+
+from maskrcnn_benchmark.config import cfg
+from maskrcnn_benchmark.utils.fuse_helper import BiMultiHeadAttention
+
+FPN_STRIDES = (8, 16, 32, 64, 128)
+
+
+def num_image_tokens(height, width):
+    return sum(-(-height // stride) * -(-width // stride) for stride in FPN_STRIDES)
+
+
+def build_attention(args, chunk_size):
+    cfg.defrost()
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MIN_FOR_UNDERFLOW = True
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.CLAMP_MAX_FOR_OVERFLOW = True
+    cfg.MODEL.DYHEAD.FUSE_CONFIG.BI_ATTN_CHUNK_SIZE = chunk_size
+    torch.manual_seed(0)
+    return BiMultiHeadAttention(
+        v_dim=args.dim, l_dim=args.lang_dim, embed_dim=args.embed_dim, num_heads=args.num_heads, dropout=0.0, cfg=cfg
+    )
+
+
+def random_inputs(args):
+    torch.manual_seed(1)
+    v = torch.randn(args.batch_size, num_image_tokens(*args.image_size), args.dim)
+    l = torch.randn(args.batch_size, args.num_tokens, args.lang_dim)
+    attention_mask_l = torch.ones(args.batch_size, args.num_tokens, dtype=torch.long)
+    attention_mask_l[:, args.num_tokens // 2 :] = 0
+    return v, l, attention_mask_l
+
+
+def run(args, chunk_size, backward):
+    attention = build_attention(args, chunk_size)
+    attention.train(backward)
+    v, l, attention_mask_l = random_inputs(args)
+    v.requires_grad_(backward)
+    l.requires_grad_(backward)
+    with torch.set_grad_enabled(backward):
+        out_v, out_l = attention(v, l, attention_mask_l)
+        if backward:
+            (out_v.sum() + out_l.sum()).backward()
+            return out_v.detach(), out_l.detach(), v.grad, l.grad
+    return out_v, out_l
+
+
+def _measure(args, chunk_size, backward, queue):
+    # run in a fresh process, as the peak resident memory of a process never decreases
+    build_attention(args, chunk_size)
+    random_inputs(args)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    run(args, chunk_size, backward)
+    elapsed = time.perf_counter() - start
+    queue.put(((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024.0, elapsed))
+
+
+def measure(args, chunk_size, backward):
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_measure, args=(args, chunk_size, backward, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chunked BiMultiHeadAttention")
+    parser.add_argument("--image-size", type=int, nargs=2, default=[800, 1333], metavar=("HEIGHT", "WIDTH"))
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--num-tokens", type=int, default=256)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--lang-dim", type=int, default=768)
+    parser.add_argument("--embed-dim", type=int, default=2048)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[1024, 4096])
+    parser.add_argument("--backward", action="store_true", help="also run and check the backward pass")
+    args = parser.parse_args()
+
+    print("{} image tokens, {} text tokens".format(args.batch_size * num_image_tokens(*args.image_size), args.num_tokens))
+    torch.set_num_threads(1)
+    reference = run(args, 0, args.backward)
+    for chunk_size in args.chunk_sizes:
+        outputs = run(args, chunk_size, args.backward)
+        max_diff = max((a - b).abs().max().item() for a, b in zip(reference, outputs))
+        print("chunk size {}: max abs difference with the full attention {:.2e}".format(chunk_size, max_diff))
+
+    for chunk_size in [0] + args.chunk_sizes:
+        peak, elapsed = measure(args, chunk_size, args.backward)
+        print(
+            "chunk size {}: peak memory +{:.0f} MB, {:.2f} s".format(
+                chunk_size if chunk_size else "full", peak, elapsed
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
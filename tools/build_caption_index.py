@@ -0,0 +1,29 @@
+r"""
+Write the caption side file (.caption.tsv and its .lineidx.8b) of caption label TSVs. CaptionTSV samples its
+negative captions from this file whenever it exists next to the label file, instead of reading full rows.
+
+    python tools/build_caption_index.py DATASET/mixed_train/train.label.tsv
+"""
+import argparse
+import os.path as op
+
+from maskrcnn_benchmark.data.datasets.tsv import caption_index_file, create_caption_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the caption side files of caption label TSVs")
+    parser.add_argument("label_files", nargs="+", help="label TSV files")
+    parser.add_argument("--overwrite", action="store_true", help="rebuild existing caption files")
+    args = parser.parse_args()
+
+    for label_file in args.label_files:
+        caption_file = caption_index_file(label_file)
+        if op.isfile(caption_file) and not args.overwrite:
+            print("{} exists, skipping".format(caption_file))
+            continue
+        num_rows = create_caption_index(label_file, caption_file)
+        print("wrote {} ({} rows)".format(caption_file, num_rows))
+
+
+if __name__ == "__main__":
+    main()
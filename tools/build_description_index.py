@@ -0,0 +1,29 @@
+r"""
+Parse the GPT outputs of caption vocab files (caption augmentation) or description files (DescriptionConverter)
+once and write them next to the file (<file>.<version>.parsed.pkl), where they are loaded instead of being parsed
+at every start. The version is the last field of the augmentation / od-to-grounding version, e.g. v1.
+
+    python tools/build_description_index.py tools/files/llm_10K_noun_freq_mixed.json --version v1
+"""
+import argparse
+import pickle
+
+from maskrcnn_benchmark.data.datasets.parse_gpt import build_description_index, description_index_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-parse GPT description files")
+    parser.add_argument("source_files", nargs="+", help="caption vocab or description json files")
+    parser.add_argument("--version", required=True, help="GPTOutputParser version")
+    args = parser.parse_args()
+
+    for source_file in args.source_files:
+        index = build_description_index(source_file, args.version)
+        index_file = description_index_file(source_file, args.version)
+        with open(index_file, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        print("wrote {} ({} parsed descriptions)".format(index_file, len(index["parsed"])))
+
+
+if __name__ == "__main__":
+    main()
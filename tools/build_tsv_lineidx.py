@@ -0,0 +1,30 @@
+r"""
+Write the binary .lineidx.8b index of TSV files. TSVDataset reads a TSV through MMapTSVFile
+(memory-mapped rows and index) whenever this index exists next to it.
+
+    python tools/build_tsv_lineidx.py DATASET/Objects365/train.tsv DATASET/Objects365/train.label.tsv
+"""
+import argparse
+import os.path as op
+
+from maskrcnn_benchmark.data.datasets.tsv import create_lineidx_8b
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build binary line indexes of TSV files")
+    parser.add_argument("tsv_files", nargs="+", help="TSV files to index")
+    parser.add_argument("--overwrite", action="store_true", help="rebuild existing indexes")
+    parser.add_argument("--chunk-size", type=int, default=64 << 20, help="bytes read per chunk")
+    args = parser.parse_args()
+
+    for tsv_file in args.tsv_files:
+        idx_file = op.splitext(tsv_file)[0] + ".lineidx.8b"
+        if op.isfile(idx_file) and not args.overwrite:
+            print("{} exists, skipping".format(idx_file))
+            continue
+        create_lineidx_8b(tsv_file, idx_file, chunk_size=args.chunk_size)
+        print("wrote {} ({} rows)".format(idx_file, op.getsize(idx_file) // 8))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+r"""
+Parity check of the ATSS target assignment engines (MODEL.ATSS.TARGET_ASSIGNMENT "loop" and "batched",
+ATSSLossComputation.prepare_targets and prepare_targets_batched in maskrcnn_benchmark/modeling/rpn/loss.py), on the
+anchors of make_anchor_generator_complex and random targets. Half of the batches have integer-aligned boxes, whose
+centers tie in distance with several anchors. With --with-tokens the span -> token maps (proj_tokens / tokenized,
+built from the char -> token table) are checked as well; this loads the tokenizer of the config.
+
+    python tools/check_atss_target_assignment.py --num-batches 200 --with-tokens
+"""
+import argparse
+import random
+
+import torch
+
+from maskrcnn_benchmark.config import cfg
+from maskrcnn_benchmark.modeling.rpn.anchor_generator import make_anchor_generator_complex
+from maskrcnn_benchmark.modeling.rpn.atss import BoxCoder
+from maskrcnn_benchmark.modeling.rpn.loss import ATSSLossComputation
+from maskrcnn_benchmark.structures.bounding_box import BoxList
+from maskrcnn_benchmark.structures.image_list import ImageList
+
+WORDS = ["person", "dog", "traffic light", "cat", "red car", "bottle", "table", "chair", "umbrella", "surfboard"]
+
+
+def setup_cfg(args):
+    if args.config_file:
+        cfg.merge_from_file(args.config_file)
+    else:
+        # GLIP anchors: one anchor per location on P3 - P7
+        cfg.MODEL.RPN.USE_FPN = True
+        cfg.MODEL.RPN.ANCHOR_SIZES = (64, 128, 256, 512, 1024)
+        cfg.MODEL.RPN.ANCHOR_STRIDE = (8, 16, 32, 64, 128)
+        cfg.MODEL.RPN.ASPECT_RATIOS = (1.0,)
+        cfg.MODEL.RPN.SCALES_PER_OCTAVE = 1
+    cfg.merge_from_list(args.opts)
+
+
+def build_loss(target_assignment):
+    cfg.defrost()
+    cfg.MODEL.ATSS.TARGET_ASSIGNMENT = target_assignment
+    return ATSSLossComputation(cfg, BoxCoder(cfg))
+
+
+def random_caption(num_gt):
+    # "dog . cat . traffic light" and one span per gt; some spans start on the space before the word, which
+    # exercises the beg + 1 / end - 2 relaxation of the span -> token conversion
+    words = [random.choice(WORDS) for _ in range(max(num_gt, 1))]
+    caption = ""
+    spans = []
+    for i, word in enumerate(words):
+        if i > 0:
+            caption += " . "
+        beg = len(caption)
+        caption += word
+        if i > 0 and random.random() < 0.2:
+            beg -= 1
+        spans.append([[beg, len(caption)]])
+    return caption, spans[:num_gt]
+
+
+def random_targets(image_sizes, max_gts, integer, num_classes=80):
+    targets = []
+    captions = []
+    for height, width in image_sizes:
+        num_gt = random.randint(1, max_gts)
+        if integer:
+            # boxes on the stride 8 grid: their centers tie in distance with the surrounding anchors
+            xy = torch.randint(0, width // 8, (num_gt, 2)) * 8
+            xy[:, 1] = torch.randint(0, height // 8, (num_gt,)) * 8
+            wh = torch.randint(1, 32, (num_gt, 2)) * 8
+            boxes = torch.cat([xy, xy + wh], dim=1).float()
+        else:
+            xy = torch.rand(num_gt, 2) * torch.tensor([width, height])
+            wh = torch.rand(num_gt, 2) * torch.tensor([width, height]) / 2 + 4
+            boxes = torch.cat([xy, xy + wh], dim=1)
+        boxes[:, 0::2] = boxes[:, 0::2].clamp(max=width - 1)
+        boxes[:, 1::2] = boxes[:, 1::2].clamp(max=height - 1)
+        boxes = boxes[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]
+        if len(boxes) == 0:
+            boxes = torch.tensor([[0.0, 0.0, width / 2.0, height / 2.0]])
+        labels = torch.randint(1, num_classes, (len(boxes),))
+
+        target = BoxList(boxes, (width, height), mode="xyxy")
+        target.add_field("labels", labels)
+        caption, spans = random_caption(len(boxes))
+        target.add_field("tokens_positive", spans)
+        target.add_field("original_od_label", labels.clone())
+        target.add_field("positive_map_for_od_labels", torch.full((256,), -1.0))
+        targets.append(target)
+        captions.append(caption)
+    return targets, captions
+
+
+def random_batch(anchor_generator, args, integer):
+    image_sizes = [
+        (random.randint(args.min_size, args.max_size), random.randint(args.min_size, args.max_size))
+        for _ in range(args.batch_size)
+    ]
+    # padded to a multiple of the largest stride, as by the batch collator
+    stride = max(cfg.MODEL.RPN.ANCHOR_STRIDE)
+    padded_height = -(-max(h for h, _ in image_sizes) // stride) * stride
+    padded_width = -(-max(w for _, w in image_sizes) // stride) * stride
+    image_list = ImageList(torch.zeros(args.batch_size, 3, padded_height, padded_width), image_sizes)
+    feature_maps = [
+        torch.zeros(args.batch_size, 1, padded_height // s, padded_width // s) for s in cfg.MODEL.RPN.ANCHOR_STRIDE
+    ]
+    anchors = anchor_generator(image_list, feature_maps)
+    targets, captions = random_targets(image_sizes, args.max_gts, integer)
+    num_gts = sum(len(target) for target in targets)
+    positive_map = (torch.rand(num_gts, 256) < 0.02).float()
+    positive_map[torch.arange(num_gts), torch.randint(0, 255, (num_gts,))] = 1
+    positive_map = positive_map / positive_map.sum(-1, keepdim=True)
+    return anchors, targets, captions, positive_map
+
+
+def assign(loss, targets, anchors, tokenized, positive_map, proj_tokens):
+    # the engine selection of ATSSLossComputation.__call__
+    prepare_targets = loss.prepare_targets_batched if loss.target_assignment == "batched" else loss.prepare_targets
+    return prepare_targets(targets, anchors, tokenized, positive_map, proj_tokens)
+
+
+def check(reference, outputs, with_tokens):
+    cls_a, reg_a, token_a, map_a, gold_a, _, positive_a = reference
+    cls_b, reg_b, token_b, map_b, gold_b, _, positive_b = outputs
+    for im_i in range(len(cls_a)):
+        assert torch.equal(cls_a[im_i].long(), cls_b[im_i].long()), "cls_labels differ"
+        assert torch.equal(token_a[im_i], token_b[im_i]), "token_labels differ"
+        positive = cls_a[im_i] > 0
+        assert torch.equal(reg_a[im_i][positive], reg_b[im_i][positive]), "reg_targets of the positives differ"
+        if with_tokens:
+            assert positive_a[im_i] == positive_b[im_i], "positive_indices differ"
+            assert torch.equal(map_a[im_i], map_b[im_i]), "span -> token map labels differ"
+            assert torch.equal(gold_a[im_i], gold_b[im_i]), "original_od_label targets differ"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the batched ATSS target assignment against the loop")
+    parser.add_argument("--config-file", default="", metavar="FILE", help="anchors of this config instead of GLIP's")
+    parser.add_argument("--num-batches", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--max-gts", type=int, default=20)
+    parser.add_argument("--min-size", type=int, default=320)
+    parser.add_argument("--max-size", type=int, default=800)
+    parser.add_argument("--with-tokens", action="store_true", help="also check the proj_tokens / tokenized maps")
+    parser.add_argument("opts", default=None, nargs=argparse.REMAINDER, help="config overrides")
+    args = parser.parse_args()
+
+    setup_cfg(args)
+    anchor_generator = make_anchor_generator_complex(cfg)
+    losses = {target_assignment: build_loss(target_assignment) for target_assignment in ["loop", "batched"]}
+
+    random.seed(0)
+    torch.manual_seed(0)
+    num_positives = 0
+    for i in range(args.num_batches):
+        anchors, targets, captions, positive_map = random_batch(anchor_generator, args, integer=i % 2 == 1)
+        tokenized = proj_tokens = None
+        if args.with_tokens:
+            tokenized = losses["loop"].tokenizer(captions, padding="longest", return_tensors="pt")
+            proj_tokens = torch.zeros(args.batch_size, 256, 1)
+        reference = assign(losses["loop"], targets, anchors, tokenized, positive_map, proj_tokens)
+        outputs = assign(losses["batched"], targets, anchors, tokenized, positive_map, proj_tokens)
+        check(reference, outputs, args.with_tokens)
+        num_positives += sum(int((labels > 0).sum()) for labels in reference[0])
+    print("{} batches, {} positive anchors: the loop and batched assignments match".format(args.num_batches, num_positives))
+
+
+if __name__ == "__main__":
+    main()
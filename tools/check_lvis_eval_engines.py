@@ -0,0 +1,160 @@
+r"""
+Regression check of the vectorized LVIS evaluation engine (LVISEval(engine="vectorized", num_workers=...) in
+maskrcnn_benchmark/data/datasets/evaluation/lvis/lvis_eval.py) against the reference per-image loop, on generated
+LVIS-style ground truths and detections: negative and not exhaustive categories per image, crowd (ignored) gts,
+gts and detections in the three area ranges, duplicated boxes and tied scores. The eval_imgs are compared field by
+field and the accumulated precision / recall and the results exactly.
+
+    python tools/check_lvis_eval_engines.py --num-datasets 40 --num-workers 0 2
+"""
+import argparse
+import contextlib
+import copy
+import io
+import random
+
+import numpy as np
+
+from maskrcnn_benchmark.data.datasets.evaluation.lvis.lvis import LVIS
+from maskrcnn_benchmark.data.datasets.evaluation.lvis.lvis_eval import LVISEval, LVISResults
+
+FREQUENCIES = ["r", "c", "f"]
+
+
+def random_box(width, height):
+    # sizes across the small / medium / large area ranges, integer-aligned half of the time
+    size = random.choice([12, 48, 160])
+    w = random.uniform(size / 2, size * 2)
+    h = random.uniform(size / 2, size * 2)
+    x = random.uniform(0, max(width - w, 1))
+    y = random.uniform(0, max(height - h, 1))
+    if random.random() < 0.5:
+        x, y, w, h = round(x), round(y), max(round(w), 1), max(round(h), 1)
+    return [x, y, w, h]
+
+
+def jitter(box):
+    x, y, w, h = box
+    dx, dy = random.uniform(-0.2, 0.2) * w, random.uniform(-0.2, 0.2) * h
+    return [x + dx, y + dy, w * random.uniform(0.8, 1.2), h * random.uniform(0.8, 1.2)]
+
+
+def random_dataset(num_images, num_categories):
+    categories = [
+        {"id": cat_id, "name": "category_{}".format(cat_id), "frequency": random.choice(FREQUENCIES)}
+        for cat_id in range(1, num_categories + 1)
+    ]
+    images = []
+    annotations = []
+    for img_id in range(1, num_images + 1):
+        width, height = random.randint(200, 640), random.randint(200, 640)
+        present = random.sample(range(1, num_categories + 1), random.randint(0, min(4, num_categories)))
+        for cat_id in present:
+            for _ in range(random.randint(1, 4)):
+                box = random_box(width, height)
+                crowd = int(random.random() < 0.1)
+                annotations.append(
+                    {
+                        "id": len(annotations) + 1,
+                        "image_id": img_id,
+                        "category_id": cat_id,
+                        "bbox": box,
+                        "area": box[2] * box[3],
+                        "iscrowd": crowd,
+                        "ignore": crowd,
+                    }
+                )
+        absent = [cat_id for cat_id in range(1, num_categories + 1) if cat_id not in present]
+        images.append(
+            {
+                "id": img_id,
+                "width": width,
+                "height": height,
+                "neg_category_ids": random.sample(absent, random.randint(0, len(absent))),
+                "not_exhaustive_category_ids": random.sample(present, random.randint(0, len(present))),
+            }
+        )
+    gt = {"images": images, "annotations": annotations, "categories": categories}
+
+    detections = []
+    for image in images:
+        gts = [ann for ann in annotations if ann["image_id"] == image["id"]]
+        dets = []
+        for ann in gts:
+            for _ in range(random.randint(0, 3)):
+                dets.append({"category_id": ann["category_id"], "bbox": jitter(ann["bbox"])})
+            if random.random() < 0.2:
+                # a duplicate of the gt: ties in IoU
+                dets.append({"category_id": ann["category_id"], "bbox": list(ann["bbox"])})
+        for _ in range(random.randint(0, 10)):
+            box = random_box(image["width"], image["height"])
+            dets.append({"category_id": random.randint(1, num_categories), "bbox": box})
+        for det in dets:
+            det["image_id"] = image["id"]
+        detections.extend(dets)
+    for det in detections:
+        # scores on a coarse grid: ties in score
+        det["score"] = round(random.randint(1, 20) * 0.05, 2)
+    return gt, detections
+
+
+def run(gt, detections, engine, num_workers):
+    # LVIS and LVISEval.summarize print their progress and results
+    with contextlib.redirect_stdout(io.StringIO()):
+        lvis_gt = LVIS()
+        lvis_gt.dataset = copy.deepcopy(gt)
+        lvis_gt._create_index()
+        lvis_dt = LVISResults(lvis_gt, copy.deepcopy(detections))
+        lvis_eval = LVISEval(lvis_gt, lvis_dt, iou_type="bbox", engine=engine, num_workers=num_workers)
+        lvis_eval.run()
+    return lvis_eval
+
+
+def check_eval_imgs(reference, other):
+    assert len(reference) == len(other), "different number of eval_imgs"
+    for a, b in zip(reference, other):
+        assert (a is None) == (b is None), "eval_imgs differ on the (image, category) pairs evaluated"
+        if a is None:
+            continue
+        assert a.keys() == b.keys()
+        for key in a:
+            if isinstance(a[key], np.ndarray) or isinstance(b[key], np.ndarray):
+                same = np.array_equal(np.asarray(a[key]), np.asarray(b[key]))
+            else:
+                same = a[key] == b[key]
+            assert same, "eval_imgs differ in {} of image {} category {}".format(key, a["image_id"], a["category_id"])
+
+
+def check_results(reference, other):
+    for key in ["precision", "recall"]:
+        assert np.array_equal(reference.eval[key], other.eval[key], equal_nan=True), "{} differs".format(key)
+    assert list(reference.results.keys()) == list(other.results.keys())
+    for key, value in reference.results.items():
+        assert value == other.results[key] or (np.isnan(value) and np.isnan(other.results[key])), key
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the vectorized LVIS evaluation against the loop")
+    parser.add_argument("--num-datasets", type=int, default=40)
+    parser.add_argument("--num-images", type=int, default=30)
+    parser.add_argument("--num-categories", type=int, default=12)
+    parser.add_argument("--num-workers", type=int, nargs="+", default=[0, 2])
+    args = parser.parse_args()
+
+    random.seed(0)
+    for i in range(args.num_datasets):
+        gt, detections = random_dataset(args.num_images, args.num_categories)
+        reference = run(gt, detections, "loop", 0)
+        for num_workers in args.num_workers:
+            other = run(gt, detections, "vectorized", num_workers)
+            check_eval_imgs(reference.eval_imgs, other.eval_imgs)
+            check_results(reference, other)
+    print(
+        "{} datasets: the vectorized engine (num_workers {}) matches the loop".format(
+            args.num_datasets, ", ".join(str(n) for n in args.num_workers)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
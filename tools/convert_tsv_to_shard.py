@@ -0,0 +1,66 @@
+r"""
+Convert the TSV files of TSVYamlDataset style yaml configs (ODTSVDataset, CocoDetectionTSV, CaptionTSV, ...)
+to binary shards (see maskrcnn_benchmark/data/datasets/shard.py).
+
+For every yaml, the "img", "label" and "hw" TSVs are converted next to the originals (<name>.shard) and
+a <yaml name>.shard.yaml pointing to them is written next to the yaml. Datasets are then used by
+appending "_shard" to their name in DATASETS.TRAIN / DATASETS.TEST, e.g. object365_dt_train_shard.
+
+    python tools/convert_tsv_to_shard.py DATASET/Objects365/train.cas2000.yaml
+"""
+import argparse
+import base64
+import os.path as op
+
+import yaml
+
+from maskrcnn_benchmark.data.datasets.shard import ShardWriter
+from maskrcnn_benchmark.data.datasets.tsv import TSVFile, find_file_path_in_yaml, load_from_yaml_file
+
+COLUMNS = ("img", "label", "hw")
+
+
+def convert_tsv(tsv_file, shard_file, binary):
+    tsv = TSVFile(tsv_file, generate_lineidx=True)
+    with ShardWriter(shard_file, binary=binary) as writer:
+        for i in range(len(tsv)):
+            row = tsv.seek(i)
+            if binary:
+                # use -1 to support old format with multiple columns, as TSVDataset.get_image
+                writer.write(row[0], base64.b64decode(row[-1]))
+            else:
+                writer.write(row[0], "\t".join(row[1:]))
+    return len(tsv)
+
+
+def convert_yaml(yaml_file, overwrite=False):
+    cfg = load_from_yaml_file(yaml_file)
+    root = op.dirname(yaml_file)
+    for column in COLUMNS:
+        tsv_file = find_file_path_in_yaml(cfg.get(column, None), root)
+        if tsv_file is None:
+            continue
+        shard_file = op.splitext(tsv_file)[0] + ".shard"
+        if overwrite or not op.isfile(shard_file):
+            num_rows = convert_tsv(tsv_file, shard_file, binary=column == "img")
+            print("wrote {} ({} rows)".format(shard_file, num_rows))
+        cfg[column] = op.relpath(shard_file, root)
+
+    shard_yaml_file = op.splitext(yaml_file)[0] + ".shard.yaml"
+    with open(shard_yaml_file, "w") as fp:
+        yaml.dump(cfg, fp, default_flow_style=False)
+    print("wrote {}".format(shard_yaml_file))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert TSV datasets to binary shards")
+    parser.add_argument("yaml_files", nargs="+", help="dataset yaml files")
+    parser.add_argument("--overwrite", action="store_true", help="convert again existing shards")
+    args = parser.parse_args()
+
+    for yaml_file in args.yaml_files:
+        convert_yaml(yaml_file, overwrite=args.overwrite)
+
+
+if __name__ == "__main__":
+    main()